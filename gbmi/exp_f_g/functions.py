@@ -1,14 +1,54 @@
 import json
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Generic, List, Literal, Optional, TypeVar, cast
+from typing import (
+    Any,
+    Dict,
+    Generic,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    TypeVar,
+    cast,
+)
 
 import torch
+from jaxtyping import Integer
+from torch import Tensor
 
 from gbmi.utils.sequences import generate_all_sequences
 
 T = TypeVar("T")
 
 
+def agreeing_pairs(
+    results_1: Tensor, results_2: Tensor, *, chunk_size: Optional[int] = None
+) -> Iterable[Integer[Tensor, "n_agree"]]:  # noqa: F821
+    """
+    Yields, in increasing order, the flat indices i * len(results_2) + j of the pairs with results_1[i] == results_2[j],
+    in chunks covering at most chunk_size (default: all) values of i at a time.
+
+    The j agreeing with any i are a contiguous run of results_2 sorted stably (so by increasing j within a run), found
+    by binary search; the cost is linear in the size of the output.
+    """
+    values_2, order_2 = results_2.flatten().sort(stable=True)
+    results_1 = results_1.flatten()
+    chunk_size = chunk_size or max(1, len(results_1))
+    for start in range(0, len(results_1), chunk_size):
+        chunk = results_1[start : start + chunk_size]
+        begins = torch.searchsorted(values_2, chunk, side="left")
+        counts = torch.searchsorted(values_2, chunk, side="right") - begins
+        i = torch.repeat_interleave(
+            torch.arange(start, start + len(chunk), device=chunk.device), counts
+        )
+        # the position of each pair within the run of its i
+        offsets = torch.arange(len(i), device=chunk.device) - torch.repeat_interleave(
+            counts.cumsum(dim=0) - counts, counts
+        )
+        j = order_2[torch.repeat_interleave(begins, counts) + offsets]
+        yield i * len(results_2) + j
+
+
 class Fun(ABC, Generic[T]):
     @staticmethod
     @abstractmethod
@@ -31,8 +71,26 @@ class Fun(ABC, Generic[T]):
     @abstractmethod
     def op_2(self, a: T, b: T) -> T: ...
 
-    @abstractmethod
-    def agree_indices(self) -> List[int]: ...
+    def iter_agree_indices(
+        self, chunk_size: Optional[int] = None
+    ) -> Iterable[Integer[Tensor, "n_agree"]]:  # noqa: F821
+        """
+        Yields agree_indices in chunks covering at most chunk_size (default: all) sequences as the first half of the
+        pair at a time
+        """
+        data = generate_all_sequences(self.n, self.elements)
+        yield from agreeing_pairs(
+            self.reduce_1(data.T), self.reduce_2(data.T), chunk_size=chunk_size
+        )
+
+    def agree_indices(
+        self, chunk_size: Optional[int] = None
+    ) -> Integer[Tensor, "n_agree"]:  # noqa: F821
+        """
+        Returns, in increasing order, the indices i * n ** elements + j (the index of the concatenated sequence among
+        all sequences of 2 * elements elements) of the pairs of sequences i, j with reduce_1(i) == reduce_2(j)
+        """
+        return torch.cat(list(self.iter_agree_indices(chunk_size)))
 
     @abstractmethod
     def reduce_1(self, xs: T) -> T: ...
@@ -83,33 +141,6 @@ class max_min(Fun):
 
         return accumulator
 
-    def agree_indices(self):
-        data = generate_all_sequences(self.n, self.elements)
-        op_1_results = self.reduce_1(data.T)
-        op_2_results = self.reduce_2(data.T)
-        l = torch.tensor([])
-        for i in range(len(op_1_results)):
-            s = torch.nonzero(op_2_results == op_1_results[i])
-            if len(s) == 1:
-                b = s[0]
-            else:
-                b = s.squeeze()
-            l = torch.cat(
-                (
-                    l,
-                    ((i * ((self.n) ** (self.elements))) + b),
-                )
-            )
-
-        return l
-
-    """
-        for i in range(len(op_1_results)):
-            if torch.equal(op_1_results[i], op_2_results[i]):
-                l.append(i)
-        return torch.tensor(l)
-    """
-
 
 class min_max(Fun):
     def __init__(self, n: int, elements: int):
@@ -153,26 +184,6 @@ class min_max(Fun):
 
         return accumulator
 
-    def agree_indices(self):
-        data = generate_all_sequences(self.n, self.elements)
-        op_1_results = self.reduce_1(data.T)
-        op_2_results = self.reduce_2(data.T)
-        l = torch.tensor([])
-        for i in range(len(op_1_results)):
-            s = torch.nonzero(op_2_results == op_1_results[i])
-            if len(s) == 1:
-                b = s[0]
-            else:
-                b = s.squeeze()
-            l = torch.cat(
-                (
-                    l,
-                    ((i * ((self.n) ** (self.elements))) + b),
-                )
-            )
-
-        return l
-
 
 class add_sub(Fun):
     def __init__(self, n: int, elements: int):
@@ -211,27 +222,5 @@ class add_sub(Fun):
 
         return accumulator
 
-    def agree_indices(self):
-        data = generate_all_sequences(self.n, self.elements)
-        op_1_results = self.reduce_1(data.T)
-        op_2_results = self.reduce_2(data.T)
-        l = torch.tensor([])
-        for i in range(len(op_1_results)):
-            s = torch.nonzero(op_2_results == op_1_results[i])
-            if len(s) == 1:
-                b = s[0]
-            else:
-                b = s.squeeze()
-            l = torch.cat((l, ((i * ((self.n) ** (self.elements))) + b)))
-
-        return l
-
-    """
-        for i in range(len(op_1_results)):
-            if torch.equal(op_1_results[i], op_2_results[i]):
-                l.append(i)
-        return torch.tensor(l)
-    """
-
 
 FunDict = {"max_min": max_min, "add_sub": add_sub, "min_max": min_max}
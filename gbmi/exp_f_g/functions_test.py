@@ -0,0 +1,35 @@
+import itertools
+from functools import reduce
+
+import torch
+
+from gbmi.exp_f_g.functions import add_sub, agreeing_pairs, max_min
+from gbmi.utils.testing import TestCase
+
+
+class TestFunctions(TestCase):
+    def test_agreeing_pairs(self):
+        results_1, results_2 = torch.randint(
+            0, 4, (2, 30), generator=torch.Generator().manual_seed(0)
+        )
+        expected = [
+            i * 30 + j
+            for i, j in itertools.product(range(30), repeat=2)
+            if results_1[i] == results_2[j]
+        ]
+        for chunk_size in (None, 1, 7):
+            actual = torch.cat(
+                list(agreeing_pairs(results_1, results_2, chunk_size=chunk_size))
+            )
+            self.assertEqual(actual.tolist(), expected)
+
+    def test_agree_indices(self):
+        for fun in (max_min(4, 2), add_sub(3, 3)):
+            xs = list(itertools.product(range(fun.n), repeat=fun.elements))
+            expected = [
+                i * len(xs) + j
+                for (i, x), (j, y) in itertools.product(enumerate(xs), repeat=2)
+                if reduce(fun.op_1, map(torch.tensor, x))
+                == reduce(fun.op_2, map(torch.tensor, y))
+            ]
+            self.assertEqual(fun.agree_indices().tolist(), expected)
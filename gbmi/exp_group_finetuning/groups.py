@@ -1,15 +1,36 @@
+import hashlib
 import json
 import random
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Generic, List, Literal, Optional, TypeVar, cast
-
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    List,
+    Literal,
+    Optional,
+    TypeVar,
+    Union,
+    cast,
+)
+
+import numpy as np
 import torch
+from jaxtyping import Integer
+from torch import Tensor
 
 from gbmi import utils
+from gbmi.utils.model_store import atomic_write
 from gbmi.utils.sequences import generate_all_sequences
 
 T = TypeVar("T")
 
+# bump whenever the contents of the cached tables change
+CAYLEY_TABLE_CACHE_VERSION = 1
+CAYLEY_TABLE_CACHE_DIR = utils.CACHE_ROOT / "cayley_tables"
+
 
 class Group(ABC, Generic[T]):
     @abstractmethod
@@ -38,22 +59,170 @@ class Group(ABC, Generic[T]):
         return accumulator
 
 
-class DihedralGroup(Group):
-    def __init__(self, n: int):
+def encode_elements(
+    elements: Integer[Tensor, "n ..."], base: int  # noqa: F722
+) -> Integer[Tensor, "n"]:  # noqa: F821
+    """Encodes each element, whose entries are in range(base), as the base-base integer with its entries as digits"""
+    elements = elements.flatten(start_dim=1).long()
+    place_values = base ** torch.arange(
+        elements.shape[-1] - 1, -1, -1, dtype=torch.long, device=elements.device
+    )
+    return (elements * place_values).sum(dim=-1)
+
+
+def build_cayley_table(
+    elements: Integer[Tensor, "n ..."],  # noqa: F722
+    product: Callable[[Tensor, Tensor], Tensor],
+    *,
+    base: int,
+    batch_size: int = 2**20,
+    max_dense_codes: int = 2**24,
+) -> Integer[Tensor, "n n"]:  # noqa: F722
+    """
+    Returns the table whose [x, y] entry is the index in elements of the product of elements[x] and elements[y].
+
+    product(xs, ys) must return the [len(xs), len(ys), ...] tensor of the products of each of xs with each of ys; it is
+    called on about batch_size pairs at a time, on the device of elements.  The products are mapped back to indices
+    through encode_elements(elements, base): by direct lookup if there are at most max_dense_codes possible codes, and
+    by binary search otherwise.
+    """
+    n = elements.shape[0]
+    codes, order = encode_elements(elements, base).sort()
+    assert (codes[1:] != codes[:-1]).all(), "elements must be distinct"
+    num_codes = base ** elements[0].numel()
+    if num_codes <= max_dense_codes:
+        index_of_code = torch.full(
+            (num_codes,), -1, dtype=torch.long, device=elements.device
+        )
+        index_of_code[codes] = order
+
+        def lookup(product_codes: Tensor) -> Tensor:
+            return index_of_code[product_codes]
+
+    else:
+
+        def lookup(product_codes: Tensor) -> Tensor:
+            indices = torch.searchsorted(codes, product_codes).clamp(max=n - 1)
+            return torch.where(codes[indices] == product_codes, order[indices], -1)
+
+    table = torch.empty(
+        (n, n),
+        dtype=utils.smallest_dtype_holding(max(n - 1, 0)),
+        device=elements.device,
+    )
+    rows = max(1, batch_size // max(n, 1))
+    for start in range(0, n, rows):
+        products = product(elements[start : start + rows], elements)
+        indices = lookup(encode_elements(products.flatten(end_dim=1), base))
+        assert (indices >= 0).all(), "the elements are not closed under product"
+        table[start : start + rows] = indices.view(-1, n)
+    return table
+
+
+class CayleyTableGroup(Group):
+    """
+    A group of indexed elements whose operation is looked up in its Cayley table.
+
+    The table is built by build_cayley_table on first use, and is cached in cache_dir (unless it is None) under the
+    class name, index, and a digest of the elements, and on each device it is used on.
+    """
+
+    def __init__(self, cache_dir: Optional[Union[str, Path]] = CAYLEY_TABLE_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._lookups: Dict[torch.device, Tensor] = {}
+
+    @abstractmethod
+    def elements(self) -> Integer[Tensor, "n ..."]: ...  # noqa: F722
+
+    @abstractmethod
+    def product(self, x: Tensor, y: Tensor) -> Tensor: ...
+
+    @abstractmethod
+    def encoding_base(self) -> int: ...
+
+    def cache_path(self, elements: Tensor) -> Path:
+        assert self.cache_dir is not None
+        digest = hashlib.sha256(
+            encode_elements(elements, self.encoding_base()).cpu().numpy().tobytes()
+        ).hexdigest()
+        return (
+            Path(self.cache_dir)
+            / f"v{CAYLEY_TABLE_CACHE_VERSION}"
+            / f"{type(self).__name__}{self.index()}-{digest[:16]}.npy"
+        )
+
+    def build_lookup(self) -> Integer[Tensor, "n n"]:  # noqa: F722
+        elements = self.elements()
+        if self.cache_dir is None:
+            return build_cayley_table(
+                elements, self.product, base=self.encoding_base()
+            ).cpu()
+        path = self.cache_path(elements)
+        if not path.exists():
+            table = (
+                build_cayley_table(elements, self.product, base=self.encoding_base())
+                .cpu()
+                .numpy()
+            )
+
+            def write(tmp_path: Path) -> None:
+                with open(tmp_path, "wb") as f:
+                    np.save(f, table)
+
+            atomic_write(path, write)
+        return torch.from_numpy(np.load(path))
+
+    def lookup_on(
+        self, device: Optional[Union[str, torch.device]] = None
+    ) -> Integer[Tensor, "n n"]:  # noqa: F722
+        device = torch.device(device if device is not None else "cpu")
+        if device not in self._lookups:
+            cpu = torch.device("cpu")
+            if cpu not in self._lookups:
+                self._lookups[cpu] = self.build_lookup()
+            self._lookups[device] = self._lookups[cpu].to(device)
+        return self._lookups[device]
+
+    @property
+    def lookup(self) -> Integer[Tensor, "n n"]:  # noqa: F722
+        return self.lookup_on(torch.get_default_device())
+
+    def op(self, x, y):
+        x, y = torch.as_tensor(x), torch.as_tensor(y)
+        return self.lookup_on(x.device)[x.long(), y.to(x.device).long()].long()
+
+    def reduce(self, xs):
+        """Multiplies xs along its first dimension, by multiplying adjacent pairs until one element remains"""
+        xs = torch.as_tensor(xs).long()
+        if xs.shape[0] == 0:
+            return torch.full(xs.shape[1:], self.id(), device=xs.device)
+        lookup = self.lookup_on(xs.device)
+        while xs.shape[0] > 1:
+            paired = xs.shape[0] // 2 * 2
+            xs = torch.cat([lookup[xs[0:paired:2], xs[1:paired:2]].long(), xs[paired:]])
+        return xs[0]
+
+
+class DihedralGroup(CayleyTableGroup):
+    def __init__(
+        self, n: int, cache_dir: Optional[Union[str, Path]] = CAYLEY_TABLE_CACHE_DIR
+    ):
+        super().__init__(cache_dir)
         self.n = n
-        self.lookup = []
-        for x in range(2 * n):
-            self.lookup.append([])
-            for y in range(2 * n):
-                j = x % 2
-                if j == 0:
-                    result = (y % 2 + (2 * ((x // 2 + y // 2) % n))) % (2 * n)
-                else:
-                    result = ((y % 2 + 1) % 2 + (2 * ((x // 2 - y // 2) % n))) % (2 * n)
 
-                self.lookup[x].append(result)
+    def elements(self) -> Tensor:
+        return torch.arange(2 * self.n)[:, None]
 
-        self.lookup = torch.tensor(self.lookup).to("cuda")
+    def product(self, x: Tensor, y: Tensor) -> Tensor:
+        x, y = x[:, None], y[None, :]
+        return torch.where(
+            x % 2 == 0,
+            (y % 2 + (2 * ((x // 2 + y // 2) % self.n))) % (2 * self.n),
+            ((y % 2 + 1) % 2 + (2 * ((x // 2 - y // 2) % self.n))) % (2 * self.n),
+        )
+
+    def encoding_base(self) -> int:
+        return 2 * self.n
 
     def toJSON(self):
         return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
@@ -70,37 +239,36 @@ class DihedralGroup(Group):
     def id(self):
         return 0
 
-    def op(self, x, y):
-        rows = self.lookup[x]
-        if len(rows.shape) == 1:
-            rows = rows.unsqueeze(0)
-        diag = torch.diag(rows[:, y])
-        if len(diag.shape) == 2:
-            diag = torch.squeeze(diag)
-        return diag
-
 
-class GLN_p(Group):
-    def __init__(self, p: int):
+class GLN_p(CayleyTableGroup):
+    def __init__(
+        self, p: int, cache_dir: Optional[Union[str, Path]] = CAYLEY_TABLE_CACHE_DIR
+    ):
+        super().__init__(cache_dir)
         self.p = p
         self.matrices = generate_all_sequences(p, 4)
-        self.matrices = self.matrices.reshape((self.matrices.shape[0], 2, 2)).double()
-        self.invertible_matrices = self.matrices[
-            ((torch.det(self.matrices)).int() % p) != 0
-        ]
-        self.lookup = []
-        for x in range(len(self.invertible_matrices)):
-            self.lookup.append([])
-            for y in range(len(self.invertible_matrices)):
-                self.lookup[x].append(
-                    self.invertible_matrices.tolist().index(
-                        (
-                            (self.invertible_matrices[x] @ self.invertible_matrices[y])
-                            % p
-                        ).tolist()
-                    )
-                )
-        self.lookup = torch.tensor(self.lookup).to("cuda")
+        self.matrices = self.matrices.reshape((self.matrices.shape[0], 2, 2))
+        # compute the determinant exactly; torch.det rounds, and truncating it misclassifies matrices for p >= 4
+        det = (
+            self.matrices[:, 0, 0] * self.matrices[:, 1, 1]
+            - self.matrices[:, 0, 1] * self.matrices[:, 1, 0]
+        )
+        self.matrices = self.matrices.double()
+        self.invertible_matrices = self.matrices[det % p != 0]
+
+    def elements(self) -> Tensor:
+        return self.invertible_matrices.long()
+
+    def product(self, x: Tensor, y: Tensor) -> Tensor:
+        # float64 holds the entries exactly, and is supported by matmul on every device
+        return (
+            torch.einsum("xij,yjk->xyik", x.double(), y.double())
+            .remainder(self.p)
+            .long()
+        )
+
+    def encoding_base(self) -> int:
+        return self.p
 
     def toJSON(self):
         return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
@@ -115,20 +283,16 @@ class GLN_p(Group):
         return self.p
 
     def id(self):
-        return self.p * (self.p - 1) ** 2 + 1
-
-    def op(self, x, y):
-        rows = self.lookup[x]
-        if len(rows.shape) == 1:
-            rows = rows.unsqueeze(0)
-        diag = torch.diag(rows[:, y])
-        if len(diag.shape) == 2:
-            diag = torch.squeeze(diag)
-        return diag
+        # the invertible matrices before [[1, 0], [0, 1]] are the [[0, b], [c, d]] with b, c != 0, as [[1, 0], [0, 0]]
+        # is singular
+        return self.p * (self.p - 1) ** 2
 
 
-class PermutedCyclicGroup(Group):
-    def __init__(self, n: int):
+class PermutedCyclicGroup(CayleyTableGroup):
+    def __init__(
+        self, n: int, cache_dir: Optional[Union[str, Path]] = CAYLEY_TABLE_CACHE_DIR
+    ):
+        super().__init__(cache_dir)
         self.n = n
         print(n)
         self.permutation = [(i - 1) % n for i in range(n)]
@@ -137,16 +301,15 @@ class PermutedCyclicGroup(Group):
         self.permutation = [(i) % n for i in range(n)]
 
         self.permutation = [(i + 1) % n for i in range(n)]
-        self.lookup = []
-        for x in range(self.n):
-            self.lookup.append([])
-            for y in range(self.n):
-                self.lookup[x].append(
-                    self.permutation.index(
-                        (self.permutation[x] + self.permutation[y]) % self.n
-                    )
-                )
-        self.lookup = torch.tensor(self.lookup).to("cuda")
+
+    def elements(self) -> Tensor:
+        return torch.tensor(self.permutation, dtype=torch.long)[:, None]
+
+    def product(self, x: Tensor, y: Tensor) -> Tensor:
+        return (x[:, None] + y[None, :]) % self.n
+
+    def encoding_base(self) -> int:
+        return self.n
 
     def toJSON(self):
         return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
@@ -163,17 +326,6 @@ class PermutedCyclicGroup(Group):
     def id(self):
         return self.permutation.index(0)
 
-    def op(self, x, y):
-        rows = self.lookup[x]
-        if len(rows.shape) == 1:
-            rows = rows.unsqueeze(0)
-
-        diag = torch.diag(rows[:, y])
-        if len(diag.shape) == 2:
-            diag = torch.squeeze(diag)
-
-        return diag
-
 
 class CyclicGroup(Group):
     def __init__(self, n: int):
@@ -197,6 +349,9 @@ class CyclicGroup(Group):
     def op(self, x, y):
         return (x + y) % self.n
 
+    def reduce(self, xs):
+        return torch.as_tensor(xs).sum(dim=0) % self.n
+
 
 GroupDict = {
     "PermutedCyclicGroup": PermutedCyclicGroup,
@@ -0,0 +1,54 @@
+import tempfile
+from pathlib import Path
+
+import torch
+
+from gbmi.exp_group_finetuning.groups import (
+    DihedralGroup,
+    GLN_p,
+    build_cayley_table,
+)
+from gbmi.utils.testing import TestCase
+
+
+class TestGroups(TestCase):
+    def test_dihedral(self):
+        n = 5
+        group = DihedralGroup(n, cache_dir=None)
+        for x in range(2 * n):
+            for y in range(2 * n):
+                if x % 2 == 0:
+                    expected = (y % 2 + (2 * ((x // 2 + y // 2) % n))) % (2 * n)
+                else:
+                    expected = ((y % 2 + 1) % 2 + (2 * ((x // 2 - y // 2) % n))) % (
+                        2 * n
+                    )
+                self.assertEqual(group.op(x, y).item(), expected)
+
+        xs = torch.randint(
+            0, 2 * n, (7, 11), generator=torch.Generator().manual_seed(0)
+        )
+        accumulator = torch.full((11,), group.id())
+        for x in xs:
+            accumulator = group.op(accumulator, x)
+        self.assertTrue(group.reduce(xs).equal(accumulator))
+
+    def test_gln_p(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            group = GLN_p(3, cache_dir=cache_dir)
+            table = group.lookup_on("cpu").long()
+            self.assertEqual(len(list(Path(cache_dir).rglob("*.npy"))), 1)
+            self.assertTrue(GLN_p(3, cache_dir=cache_dir).lookup_on().equal(table))
+
+        self.assertEqual(group.size(), 48)
+        matrices = group.elements()
+        self.assertTrue(matrices[group.id()].equal(torch.eye(2, dtype=torch.long)))
+        x, y = torch.meshgrid(torch.arange(48), torch.arange(48), indexing="ij")
+        self.assertTrue(
+            matrices[table].equal((matrices[x] @ matrices[y]) % 3),
+        )
+        self.assertTrue(
+            build_cayley_table(matrices, group.product, base=3, max_dense_codes=0)
+            .long()
+            .equal(table)
+        )
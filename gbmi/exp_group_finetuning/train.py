@@ -5,6 +5,7 @@ import sys
 from abc import ABC, abstractmethod
 from collections.abc import Callable
 from dataclasses import dataclass, field
+from functools import cache
 from typing import (
     Any,
     Dict,
@@ -15,7 +16,6 @@ from typing import (
     Tuple,
     Type,
     TypeVar,
-    cast,
 )
 
 import numpy as np
@@ -44,16 +44,10 @@ from gbmi.model import (
     train_or_load_model,
     update_HookedTransformerConfig_from_args,
 )
-from gbmi.utils import (
-    SingleTensorDataset,
-    default_device,
-    reseed,
-    set_params,
-    shuffle_data,
-)
+from gbmi.utils import default_device, reseed, set_params, shuffle_data
 from gbmi.utils.sequences import generate_all_sequences
 
-torch.set_default_device("cuda")
+torch.set_default_device(default_device())
 
 
 @dataclass
@@ -217,16 +211,23 @@ class ModularFineTuningTrainingWrapper(TrainingWrapper[ModularFineTuning]):
         return alpha / attnscore.shape[-1] + (1 - alpha) * attnscore
 
     def run_batch(
-        self, x: Float[Tensor, "batch pos"], prefix: str  # noqa: F722
+        self,
+        x_y: Tuple[Integer[Tensor, "batch pos"], Integer[Tensor, "batch"]],  # noqa F722
+        prefix: str,
     ) -> Float[Tensor, ""]:  # noqa: F722
+        x, labels = x_y
         self.model.to(x.device, print_details=False)
 
-        labels = self.group.op(x[:, 0].T, x[:, 1].T)
         assert (
             len(labels.shape) == 1
         ), f"labels.shape == {labels.shape} != 1 (from x.shape == {x.shape})"
-        y_preds = self.model.run_with_hooks(
-            x, fwd_hooks=[("blocks.0.attn.hook_pattern", self.attention_hook)]
+        # the hook is the identity when the attention rate is 0
+        y_preds = (
+            self.model(x)
+            if self.config.experiment.attention_rate == 0
+            else self.model.run_with_hooks(
+                x, fwd_hooks=[("blocks.0.attn.hook_pattern", self.attention_hook)]
+            )
         )
         loss = self.loss_fn(y_preds, labels)
 
@@ -250,9 +251,36 @@ class ModularFineTuningTrainingWrapper(TrainingWrapper[ModularFineTuning]):
         )
 
 
+@cache
+def group_dataset(
+    group_family: str, group_index: int, n_elements: int
+) -> Tuple[
+    Integer[Tensor, "n_seqs n_ctx"], Integer[Tensor, "n_seqs"]  # noqa: F722, F821
+]:
+    """
+    Returns every sequence of n_elements elements of the group, followed by the '=' token, and the product of each.
+
+    The result only depends on the group and the sequence length, so it is computed once and shared by every model
+    (e.g. of every seed) trained on them.
+    """
+    group = GroupDict[group_family](group_index)
+    sequences = generate_all_sequences(group.size(), n_elements)
+    labels = group.reduce(sequences.T).to(sequences.device)
+    # concat a special token of value group.size() to the end of each sequence for '='
+    equals_token = group.size()
+    data = torch.cat(
+        [sequences, equals_token * torch.ones((len(sequences), 1))], dim=1
+    ).long()
+    return data, labels
+
+
 class ModularFineTuningDataModule(DataModule):
-    data_train: Dataset[Integer[Tensor, "seq_len"]]  # noqa: F821
-    data_test: Dataset[Integer[Tensor, "seq_len"]]  # noqa: F821
+    data_train: Dataset[
+        Tuple[Integer[Tensor, "seq_len"], Integer[Tensor, ""]]  # noqa: F821, F722
+    ]
+    data_test: Dataset[
+        Tuple[Integer[Tensor, "seq_len"], Integer[Tensor, ""]]  # noqa: F821, F722
+    ]
     batch_size: Optional[int]
 
     def __init__(self, config: Config[ModularFineTuning]):
@@ -265,27 +293,23 @@ class ModularFineTuningDataModule(DataModule):
     def setup(self, stage: str):
         # Full dataset
         rng = np.random.default_rng(self.dataset_seed)
-        pairs = generate_all_sequences(
-            self.config.experiment.group_size,
+        data, labels = group_dataset(
+            self.config.experiment.group_family,
+            self.config.experiment.group_index,
             self.model_config.n_ctx - 1,
         )
-        # concat a special token of value self.config.experiment.p to the end of each sequence for '='
-        equals_token = self.config.experiment.group_size
-        data = torch.cat(
-            [pairs, equals_token * torch.ones((len(pairs), 1))], dim=1
-        ).long()
-        data = shuffle_data(data, rng)
+        indices = shuffle_data(torch.arange(len(data), device=data.device), rng)
 
         split_idx = int(len(data) * self.config.experiment.training_ratio)
 
-        data_train = data[:split_idx]
-        data_test = data[split_idx:]
+        data_train = data[indices[:split_idx]]
+        data_test = data[indices[split_idx:]]
         print(
             f"data_train.shape: {data_train.shape}, data_test.shape: {data_test.shape}"
         )
 
-        self.data_train = cast(Dataset[Tensor], SingleTensorDataset(data_train))
-        self.data_test = cast(Dataset[Tensor], SingleTensorDataset(data_test))
+        self.data_train = TensorDataset(data_train, labels[indices[:split_idx]])
+        self.data_test = TensorDataset(data_test, labels[indices[split_idx:]])
 
     def train_dataloader(self):
         return DataLoader(self.data_train, batch_size=self.config.batch_size)
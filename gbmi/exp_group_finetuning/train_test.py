@@ -0,0 +1,70 @@
+import tempfile
+from functools import partial
+from pathlib import Path
+from unittest import mock
+
+import torch
+
+from gbmi.exp_group_finetuning.groups import (
+    CayleyTableGroup,
+    CyclicGroup,
+    DihedralGroup,
+    GroupDict,
+)
+from gbmi.exp_group_finetuning.train import (
+    ModularFineTuningDataModule,
+    group_dataset,
+    modular_addition_config,
+)
+from gbmi.utils.testing import TestCase
+
+
+class TestGroupFineTuningData(TestCase):
+    def setUp(self):
+        # the data module builds its groups by name, so point those with Cayley tables at a temporary cache
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_dir = cache_dir.name
+        patch = mock.patch.dict(
+            GroupDict,
+            {
+                name: partial(group_class, cache_dir=self.cache_dir)
+                for name, group_class in GroupDict.items()
+                if issubclass(group_class, CayleyTableGroup)
+            },
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+        group_dataset.cache_clear()
+        self.addCleanup(group_dataset.cache_clear)
+
+    def test_labels_match_group_op(self):
+        for group in (CyclicGroup(5), DihedralGroup(3, cache_dir=self.cache_dir)):
+            config = modular_addition_config(0, group, elements=2, epochs=1)
+            datamodule = ModularFineTuningDataModule(config)
+            datamodule.setup("fit")
+            xs, ys = (
+                torch.cat(tensors)
+                for tensors in zip(
+                    datamodule.data_train.tensors, datamodule.data_test.tensors
+                )
+            )
+            self.assertEqual(len(datamodule.data_train), len(xs) // 2)
+            self.assertTrue((xs[:, -1] == group.size()).all())
+            self.assertEqual(
+                sorted(map(tuple, xs[:, :-1].tolist())),
+                [(a, b) for a in range(group.size()) for b in range(group.size())],
+            )
+            for x, y in zip(xs.tolist(), ys.tolist()):
+                product = group.op(torch.tensor(x[0]), torch.tensor(x[1]))
+                self.assertEqual(int(product), y, msg=(group, x))
+
+            # the dataset is shared, and the split only depends on the seed
+            data, labels = group_dataset(type(group).__name__, group.index(), 2)
+            self.assertEqual(len(data), group.size() ** 2)
+            other = ModularFineTuningDataModule(config)
+            other.setup("fit")
+            self.assertTrue(
+                other.data_train.tensors[0].equal(datamodule.data_train.tensors[0])
+            )
+        self.assertTrue(any(Path(self.cache_dir).rglob("*.npy")))
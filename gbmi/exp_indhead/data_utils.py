@@ -154,29 +154,37 @@ class EnglishExactNgramTask:
         max_length: Optional[int],
         force_strong_signal: bool = True,
         ngram_counts_table: Float[Tensor, "num_tokens*"],  # noqa F722
+        batch_size: Optional[int] = None,
     ) -> Iterable[Integer[Tensor, "seq_length"]]:  # noqa F821
+        """
+        batch_size: if not None, sample this many sequences at a time; the default samples one at a time, which
+        reproduces the sequences generated before batching was supported
+        """
         default_device = torch.tensor([]).device
         assert all(
             i == num_tokens for i in ngram_counts_table.shape
         ), f"ngram_counts_table.shape={ngram_counts_table.shape} != num_tokens* = {num_tokens}*"
         generator = torch.Generator(device=default_device)
         generator.manual_seed(seed)
+        start = torch.empty((batch_size or 1, 0), dtype=torch.long)
         n_samples = 0
         while True:
-            yield (
-                sample_ngrams_with_at_least_one_unique(
+            yield from (
+                sample_ngrams_with_at_least_one_unique_batch(
+                    start,
                     num=seq_length,
                     ngram_counts_table=ngram_counts_table,
                     generator=generator,
                 )
                 if force_strong_signal
-                else sample_ngrams(
+                else sample_ngrams_batch(
+                    start,
                     num=seq_length,
                     ngram_counts_table=ngram_counts_table,
                     generator=generator,
                 )
-            )
-            n_samples += 1
+            )[: None if max_length is None else max_length - n_samples]
+            n_samples += start.shape[0]
             if max_length is not None and n_samples >= max_length:
                 return
 
@@ -192,6 +200,7 @@ class EnglishExactNgramTask:
         corpus: str = DEFAULT_CORPUS,
         allow_language_truncation: bool = True,
         alpha_mix_uniform: Optional[float] = None,
+        batch_size: Optional[int] = None,
     ) -> Iterable[Integer[Tensor, "seq_length"]]:  # noqa F821
         ngram_counts_table = construct_ngram_counts_table(
             num_tokens=num_tokens,
@@ -207,6 +216,7 @@ class EnglishExactNgramTask:
             max_length=max_length,
             force_strong_signal=force_strong_signal,
             ngram_counts_table=ngram_counts_table,
+            batch_size=batch_size,
         )
 
 
@@ -267,7 +277,12 @@ class ABCBCEnglishTask:
         a_unique: bool = True,
         b_unique: bool = False,
         ngram_counts_table: Float[Tensor, "num_tokens*"],  # noqa F722
+        batch_size: Optional[int] = None,
     ) -> Iterable[Integer[Tensor, "seq_length"]]:  # noqa F821
+        """
+        batch_size: if not None, sample this many sequences at a time (see sample_batch); the default samples one at a
+        time, which reproduces the sequences generated before batching was supported
+        """
         default_device = torch.tensor([]).device
         assert all(
             i == num_tokens for i in ngram_counts_table.shape
@@ -276,6 +291,20 @@ class ABCBCEnglishTask:
         generator.manual_seed(seed)
         n_samples = 0
         n_cs = seq_length - 3
+        while batch_size is not None:
+            xs = ABCBCEnglishTask.sample_batch(
+                batch_size=batch_size,
+                n_cs=n_cs,
+                skip_end=skip_end,
+                a_unique=a_unique,
+                b_unique=b_unique,
+                ngram_counts_table=ngram_counts_table,
+                generator=generator,
+            )
+            yield from xs[: None if max_length is None else max_length - n_samples]
+            n_samples += xs.shape[0]
+            if max_length is not None and n_samples >= max_length:
+                return
         while True:
             n_cs1 = int(torch.randint(0, n_cs + 1, (1,), generator=generator).item())
             n_cs2 = int(
@@ -341,6 +370,88 @@ class ABCBCEnglishTask:
             if max_length is not None and n_samples >= max_length:
                 return
 
+    @staticmethod
+    def sample_batch(
+        *,
+        batch_size: int,
+        n_cs: int,
+        skip_end: bool = False,
+        a_unique: bool = True,
+        b_unique: bool = False,
+        ngram_counts_table: Float[Tensor, "num_tokens*"],  # noqa F722
+        generator: torch.Generator,
+    ) -> Integer[Tensor, "batch n_cs+3"]:  # noqa F722
+        """
+        Samples batch_size sequences from the distribution of dist_generator, dropping the rejected ones.
+
+        Every row samples n_cs tokens for each of cs1, cs2, and cs3 and is then cut to its own lengths, which does not
+        change the distribution, as a prefix of a Markov chain is distributed the same however long the chain runs.
+        """
+        num_tokens = ngram_counts_table.shape[-1]
+        rows = torch.arange(batch_size)
+        n_cs1 = torch.randint(0, n_cs + 1, (batch_size,), generator=generator)
+        n_cs2 = (
+            torch.rand(batch_size, generator=generator, dtype=torch.float64)
+            * (n_cs - n_cs1 + 1)
+        ).long()
+        swap = torch.rand(batch_size, generator=generator) < 0.5
+        n_cs1, n_cs2 = torch.where(swap, n_cs2, n_cs1), torch.where(swap, n_cs1, n_cs2)
+        n_cs3 = n_cs - n_cs1 - n_cs2
+        assert (n_cs3 >= 0).all(), n_cs3
+
+        cs1 = sample_ngrams_batch(
+            torch.empty((batch_size, 0), dtype=torch.long),
+            num=n_cs + 2,
+            ngram_counts_table=ngram_counts_table,
+            generator=generator,
+        )
+        a, b = cs1[rows, n_cs1], cs1[rows, n_cs1 + 1]
+        cs1 = cs1[:, :n_cs]
+        in_cs1 = torch.arange(n_cs) < n_cs1[:, None]
+        reject = (a == b) & (a_unique or b_unique)
+        reject |= a_unique & ((cs1 == a[:, None]) & in_cs1).any(dim=-1)
+        reject |= b_unique & ((cs1 == b[:, None]) & in_cs1).any(dim=-1)
+
+        avoid = torch.zeros((batch_size, num_tokens), dtype=torch.bool)
+        if a_unique:
+            avoid[rows, a] = True
+        if b_unique:
+            avoid[rows, b] = True
+        ab = torch.stack([a, b], dim=-1)
+        cs2 = sample_ngrams_batch(
+            ab,
+            num=n_cs,
+            ngram_counts_table=ngram_counts_table,
+            avoid=avoid,
+            generator=generator,
+        )
+        before_cs3 = (
+            torch.cat([ab, cs2], dim=-1).gather(
+                -1, torch.stack([n_cs2, n_cs2 + 1], dim=-1)
+            )
+            if skip_end
+            else ab
+        )
+        cs3 = sample_ngrams_batch(
+            before_cs3,
+            num=n_cs,
+            ngram_counts_table=ngram_counts_table,
+            avoid=avoid,
+            generator=generator,
+        )
+
+        # [*cs1, a, b, *cs2, a, b, *cs3][:-1], or [*cs1, a, b, *cs2, *cs3, a, b][:-1] if skip_end
+        n_ab = torch.full((batch_size,), 2)
+        pieces = [(cs1, n_cs1), (ab, n_ab), (cs2, n_cs2), (ab, n_ab), (cs3, n_cs3)]
+        if skip_end:
+            pieces[3], pieces[4] = pieces[4], pieces[3]
+        xs = torch.cat([x for x, _ in pieces], dim=-1)
+        keep = torch.cat(
+            [torch.arange(x.shape[-1]) < n[:, None] for x, n in pieces], dim=-1
+        )
+        xs = xs[keep].view(batch_size, n_cs + 4)[:, :-1]
+        return xs[~reject]
+
     # based on https://github.com/TomFrederik/mvp_induction/blob/main/datasets.py
     @staticmethod
     def generator(
@@ -356,6 +467,7 @@ class ABCBCEnglishTask:
         corpus: str = DEFAULT_CORPUS,
         allow_language_truncation: bool = True,
         alpha_mix_uniform: Optional[float] = None,
+        batch_size: Optional[int] = None,
     ) -> Iterable[Integer[Tensor, "seq_length"]]:  # noqa F821
         ngram_counts_table = construct_ngram_counts_table(
             num_tokens=num_tokens,
@@ -373,6 +485,7 @@ class ABCBCEnglishTask:
             a_unique=a_unique,
             b_unique=b_unique,
             ngram_counts_table=ngram_counts_table,
+            batch_size=batch_size,
         )
 
 
@@ -561,9 +674,14 @@ class ABCABCEnglishTask:
         when_ngram_same_adjust_middle_tokens_to_match: bool = True,
         max_length: Optional[int] = None,
         ngram_counts_table: Float[Tensor, "num_tokens*"],  # noqa F722
+        batch_size: Optional[int] = None,
     ) -> Iterable[
         Tuple[Integer[Tensor, "seq_length"], Bool[Tensor, "seq_length"]]  # noqa F821
     ]:
+        """
+        batch_size: if not None, sample the ngrams this many at a time; the default samples one at a time, which
+        reproduces the sequences generated before batching was supported
+        """
         ngram = len(ngram_counts_table.shape)
         default_device = torch.tensor([]).device
         assert all(
@@ -574,13 +692,27 @@ class ABCABCEnglishTask:
 
         avoid_pat = [True] * (ngram - 1) + [False]
         ngrams = (
-            sample_ngrams(
-                num=ngram,
-                ngram_counts_table=ngram_counts_table,
-                avoid_duplicates_initial_pattern=avoid_pat,
-                generator=generator,
+            (
+                sample_ngrams(
+                    num=ngram,
+                    ngram_counts_table=ngram_counts_table,
+                    avoid_duplicates_initial_pattern=avoid_pat,
+                    generator=generator,
+                )
+                for _ in itertools.repeat(None)
+            )
+            if batch_size is None
+            else (
+                x
+                for _ in itertools.repeat(None)
+                for x in sample_ngrams_batch(
+                    torch.empty((batch_size, 0), dtype=torch.long),
+                    num=ngram,
+                    ngram_counts_table=ngram_counts_table,
+                    avoid_duplicates_initial_pattern=avoid_pat,
+                    generator=generator,
+                )
             )
-            for _ in itertools.repeat(None)
         )
 
         n_samples = 0
@@ -617,6 +749,7 @@ class ABCABCEnglishTask:
         corpus: str = DEFAULT_CORPUS,
         allow_language_truncation: bool = True,
         alpha_mix_uniform: Optional[float] = None,
+        batch_size: Optional[int] = None,
     ) -> Iterable[
         Tuple[Integer[Tensor, "seq_length"], Bool[Tensor, "seq_length"]]  # noqa F821
     ]:
@@ -634,28 +767,117 @@ class ABCABCEnglishTask:
             when_ngram_same_adjust_middle_tokens_to_match=when_ngram_same_adjust_middle_tokens_to_match,
             ngram_counts_table=ngram_counts_table,
             max_length=max_length,
+            batch_size=batch_size,
         )
 
 
+ALL_NGRAMS_CHUNK_SIZE = 2**16
+
+
+def product_chunks(
+    toks: Integer[Tensor, "num_toks"],  # noqa: F821
+    length: int,
+    *,
+    chunk_size: Optional[int] = None,
+) -> Iterable[Integer[Tensor, "batch length"]]:  # noqa: F722
+    """
+    Yields the sequences of length tokens drawn from toks, in lexicographic order of their indices into toks, as
+    tensors of at most chunk_size (default: all) rows
+    """
+    total = len(toks) ** length
+    chunk_size = chunk_size or max(1, total)
+    # always yield at least one (possibly empty) chunk
+    for start in range(0, max(1, total), chunk_size):
+        ids = torch.arange(start, min(start + chunk_size, total), dtype=torch.long)
+        digits = torch.empty((len(ids), length), dtype=torch.long)
+        for i in reversed(range(length)):
+            digits[:, i] = ids % len(toks)
+            ids = ids // len(toks)
+        yield toks[digits]
+
+
 def all_sequences_avoiding_iter(
     *,
     valid_toks: Tensor,
     length: int,
     generator: Optional[torch.Generator] = None,
 ) -> Iterable[Integer[Tensor, "length"]]:  # noqa: F821
+    """
+    Yields all sequences of length tokens from valid_toks.
+
+    If generator is not None, the order is randomized by shuffling the tokens of each position anew every time the
+    previous position advances.  The shuffles are drawn lazily, so taking only the first few sequences draws only the
+    shuffles they need.
+    """
+    if generator is None:
+        for chunk in product_chunks(
+            valid_toks, length, chunk_size=ALL_NGRAMS_CHUNK_SIZE
+        ):
+            yield from chunk
+        return
     if length == 0:
         yield torch.tensor([], dtype=torch.long)
         return
-    valid_toks = (
-        valid_toks
-        if generator is None
-        else valid_toks[torch.randperm(len(valid_toks), generator=generator)]
+
+    def shuffle(toks: Tensor) -> Tensor:
+        return toks[torch.randperm(len(toks), generator=generator)]
+
+    # levels[i] is the order of the tokens at position i, and indices[i] is our place in it
+    levels = [shuffle(valid_toks)]
+    if len(levels[0]) == 0:
+        return
+    while len(levels) < length:
+        levels.append(shuffle(levels[-1]))
+    indices = [0] * length
+    while True:
+        yield torch.tensor(
+            [int(level[i]) for level, i in zip(levels, indices)], dtype=torch.long
+        )
+        advance = length - 1
+        while advance >= 0 and indices[advance] + 1 >= len(levels[advance]):
+            advance -= 1
+        if advance < 0:
+            return
+        indices[advance] += 1
+        for i in range(advance + 1, length):
+            levels[i], indices[i] = shuffle(levels[i - 1]), 0
+
+
+def all_ngrams_chunks(
+    *,
+    num_tokens: int,
+    ngram: int,
+    avoid: Iterable[int] = tuple(),
+    avoid_nodup: Iterable[int] = tuple(),
+    avoid_duplicates_initial_pattern: Iterable[bool] = tuple(),
+    avoid_duplicates: bool = False,
+    chunk_size: Optional[int] = None,
+) -> Iterable[Integer[Tensor, "batch ngram"]]:  # noqa: F722
+    """
+    Yields, in lexicographic order and as tensors of at most chunk_size (default: all) rows, the ngrams of tokens not in
+    avoid such that, at the positions where avoid_duplicates_initial_pattern (and then avoid_duplicates) is True, the
+    token is neither an earlier token of the ngram nor in avoid_nodup.
+
+    Each chunk of the cartesian product is filtered with boolean masks; empty chunks are skipped.
+    """
+    avoid = set(avoid)
+    toks = torch.tensor(
+        [t for t in range(num_tokens) if t not in avoid], dtype=torch.long
     )
-    for t in valid_toks:
-        for ts in all_sequences_avoiding_iter(
-            valid_toks=valid_toks, length=length - 1, generator=generator
-        ):
-            yield torch.tensor([int(t.item()), *ts], dtype=torch.long)
+    avoid_nodup = torch.tensor(list(avoid_nodup), dtype=torch.long)
+    avoid_duplicates_pattern = list(
+        itertools.islice(
+            chain(avoid_duplicates_initial_pattern, cycle([avoid_duplicates])), ngram
+        )
+    )
+    for ngrams in product_chunks(toks, ngram, chunk_size=chunk_size):
+        keep = torch.ones(len(ngrams), dtype=torch.bool)
+        for i, avoid_duplicates_here in enumerate(avoid_duplicates_pattern):
+            if avoid_duplicates_here:
+                keep &= ~torch.isin(ngrams[:, i], avoid_nodup)
+                keep &= (ngrams[:, :i] != ngrams[:, i : i + 1]).all(dim=-1)
+        if keep.any() or chunk_size is None:
+            yield ngrams[keep]
 
 
 def all_ngrams_iter(
@@ -667,29 +889,16 @@ def all_ngrams_iter(
     avoid_duplicates_initial_pattern: Iterable[bool] = tuple(),
     avoid_duplicates: bool = False,
 ) -> Iterable[Integer[Tensor, "ngram"]]:  # noqa F821
-    if ngram == 0:
-        yield torch.tensor([], dtype=torch.long)
-        return
-    avoid, avoid_nodup = tuple(avoid), tuple(avoid_nodup)
-    avoid_duplicates_initial_pattern = list(avoid_duplicates_initial_pattern) + [
-        avoid_duplicates
-    ]
-    avoid_duplicates_here, avoid_duplicates_initial_pattern = (
-        avoid_duplicates_initial_pattern[0],
-        avoid_duplicates_initial_pattern[1:],
-    )
-    for t in range(num_tokens):
-        if t not in avoid and (not avoid_duplicates_here or t not in avoid_nodup):
-            t = torch.tensor([t], dtype=torch.long)
-            for ts in all_ngrams_iter(
-                num_tokens=num_tokens,
-                ngram=ngram - 1,
-                avoid=avoid,
-                avoid_nodup=[*avoid_nodup, int(t)],
-                avoid_duplicates_initial_pattern=avoid_duplicates_initial_pattern,
-                avoid_duplicates=avoid_duplicates,
-            ):
-                yield torch.cat([t, ts], dim=-1)
+    for chunk in all_ngrams_chunks(
+        num_tokens=num_tokens,
+        ngram=ngram,
+        avoid=avoid,
+        avoid_nodup=avoid_nodup,
+        avoid_duplicates_initial_pattern=avoid_duplicates_initial_pattern,
+        avoid_duplicates=avoid_duplicates,
+        chunk_size=ALL_NGRAMS_CHUNK_SIZE,
+    ):
+        yield from chunk
 
 
 def all_ngrams(
@@ -700,18 +909,14 @@ def all_ngrams(
     avoid_duplicates_initial_pattern: Iterable[bool] = tuple(),
     avoid_duplicates: bool = False,
 ) -> Integer[Tensor, "batch ngram"]:  # noqa F722
-    return torch.tensor(
-        list(
-            all_ngrams_iter(
-                num_tokens=num_tokens,
-                ngram=ngram,
-                avoid=avoid,
-                avoid_duplicates_initial_pattern=avoid_duplicates_initial_pattern,
-                avoid_duplicates=avoid_duplicates,
-            )
-        ),
-        dtype=torch.long,
+    (ngrams,) = all_ngrams_chunks(
+        num_tokens=num_tokens,
+        ngram=ngram,
+        avoid=avoid,
+        avoid_duplicates_initial_pattern=avoid_duplicates_initial_pattern,
+        avoid_duplicates=avoid_duplicates,
     )
+    return ngrams
 
 
 def construct_ngram_counts_table(
@@ -753,44 +958,103 @@ def increment_zero_counts(table: Tensor) -> Tensor:
         return table
 
 
-def sample_ngrams_iter(
-    *start: int,
+def avoid_mask(
+    avoid: Union[Iterable[int], Bool[Tensor, "batch num_tokens"]],  # noqa: F722
+    *,
+    batch: int,
+    num_tokens: int,
+    device: Optional[torch.device] = None,
+) -> Bool[Tensor, "batch num_tokens"]:  # noqa: F722
+    if isinstance(avoid, Tensor):
+        return avoid.to(device=device, dtype=torch.bool).expand(batch, num_tokens)
+    mask = torch.zeros((batch, num_tokens), dtype=torch.bool, device=device)
+    mask[:, list(avoid)] = True
+    return mask
+
+
+def sample_ngrams_batch(
+    start: Integer[Tensor, "batch n_start"],  # noqa: F722
+    *,
     num: int,
     ngram_counts_table: Tensor,
-    avoid: Iterable[int] = tuple(),
+    avoid: Union[
+        Iterable[int], Bool[Tensor, "batch num_tokens"]
+    ] = tuple(),  # noqa: F722
     avoid_duplicates_initial_pattern: Iterable[bool] = tuple(),
     avoid_duplicates: bool = False,
     generator: torch.Generator,
-) -> Iterable[int]:
-
-    def truncate(prev: Iterable[int]) -> list[int]:
-        if len(ngram_counts_table.shape) == 1:
-            return []
-        return list(prev)[-(len(ngram_counts_table.shape) - 1) :]
-
-    ngram_counts_table = increment_zero_counts(ngram_counts_table.clone())
-    prev = truncate(list(start))
-    ngram_counts_table[..., list(avoid)] = 0
-    ngram_counts_table_nodup = ngram_counts_table.clone()
+) -> Integer[Tensor, "batch num"]:  # noqa: F722
+    """
+    Continues each row of start by num tokens sampled from the ngram model, advancing all rows with a single
+    torch.multinomial per token.
+
+    avoid is either a collection of tokens or a per-row mask of tokens that are never sampled.  At the steps where
+    avoid_duplicates_initial_pattern (and then avoid_duplicates) is True, tokens already sampled in the same row are
+    not sampled either.  While a row has fewer than ngram - 1 tokens of context, its next token is sampled from the
+    marginal over the missing context.  With a single row, this draws exactly the tokens that sampling one token at a
+    time did.
+    """
+    ngram = len(ngram_counts_table.shape)
+    num_tokens = ngram_counts_table.shape[-1]
+    batch = start.shape[0]
+    device = ngram_counts_table.device
+    table = increment_zero_counts(ngram_counts_table)
+    keep = ~avoid_mask(avoid, batch=batch, num_tokens=num_tokens, device=device)
+    keep_nodup = keep.clone()
+    rows = torch.arange(batch, device=device)
+    prev = start.to(device=device, dtype=torch.long)
+    prev = prev[:, max(0, prev.shape[1] - (ngram - 1)) :]
+    marginals: dict[int, Tensor] = {}
+    result = torch.empty((batch, num), dtype=torch.long, device=device)
     avoid_duplicates_pattern = chain(
         avoid_duplicates_initial_pattern, cycle([avoid_duplicates])
     )
-    for _i, avoid_duplicates_here in zip(range(num), avoid_duplicates_pattern):
-        cur_table = (
-            ngram_counts_table_nodup if avoid_duplicates_here else ngram_counts_table
-        )
-        cur_table = cur_table[tuple(prev)]
-        if len(cur_table.shape) > 1:
-            cur_table = cur_table.sum(dim=tuple(range(1, len(cur_table.shape))))
+    for i, avoid_duplicates_here in zip(range(num), avoid_duplicates_pattern):
+        cur_keep = keep_nodup if avoid_duplicates_here else keep
+        n_prev = prev.shape[1]
+        if n_prev == ngram - 1:
+            cur_table = torch.where(cur_keep, table[tuple(prev.T)], 0)
+        else:
+            # sum out the middle of the missing context first, so that we only
+            # gather (batch, next token, last token) entries
+            if n_prev not in marginals:
+                marginals[n_prev] = (
+                    table.sum(dim=tuple(range(n_prev + 1, ngram - 1)))
+                    if n_prev + 2 < ngram
+                    else table
+                )
+            cur_table = marginals[n_prev][tuple(prev.T)]
+            cur_table = torch.where(cur_keep[:, None, :], cur_table, 0).sum(dim=-1)
+        totals = cur_table.sum(dim=-1, keepdim=True)
         assert (
-            cur_table.sum() != 0
-        ), f"Cannot avoid duplicates ({avoid_duplicates_initial_pattern}, {avoid_duplicates}; at {_i}, {avoid_duplicates_here}; avoiding {avoid}) with {prev}"
-        cur_table = cur_table / cur_table.sum()
-        next_token = int(torch.multinomial(cur_table, 1, generator=generator).item())
-        yield next_token
-        ngram_counts_table_nodup[..., next_token] = 0
-        prev.append(next_token)
-        prev = truncate(prev)
+            totals != 0
+        ).all(), f"Cannot avoid duplicates ({avoid_duplicates_initial_pattern}, {avoid_duplicates}; at {i}, {avoid_duplicates_here}; avoiding {avoid}) with {prev[(totals == 0).squeeze(-1)]}"
+        next_tokens = torch.multinomial(cur_table / totals, 1, generator=generator)
+        result[:, i] = next_tokens.squeeze(-1)
+        keep_nodup[rows, result[:, i]] = False
+        prev = torch.cat([prev, next_tokens], dim=-1)
+        prev = prev[:, max(0, prev.shape[1] - (ngram - 1)) :]
+    return result
+
+
+def sample_ngrams_iter(
+    *start: int,
+    num: int,
+    ngram_counts_table: Tensor,
+    avoid: Iterable[int] = tuple(),
+    avoid_duplicates_initial_pattern: Iterable[bool] = tuple(),
+    avoid_duplicates: bool = False,
+    generator: torch.Generator,
+) -> Iterable[int]:
+    yield from sample_ngrams(
+        *start,
+        num=num,
+        ngram_counts_table=ngram_counts_table,
+        avoid=avoid,
+        avoid_duplicates=avoid_duplicates,
+        avoid_duplicates_initial_pattern=avoid_duplicates_initial_pattern,
+        generator=generator,
+    ).tolist()
 
 
 def sample_ngrams(
@@ -802,20 +1066,72 @@ def sample_ngrams(
     avoid_duplicates: bool = False,
     generator: torch.Generator,
 ) -> Integer[Tensor, "num"]:  # noqa: F821
-    return torch.tensor(
-        list(
-            sample_ngrams_iter(
-                *start,
-                num=num,
+    return sample_ngrams_batch(
+        torch.tensor([start], dtype=torch.long).view(1, len(start)),
+        num=num,
+        ngram_counts_table=ngram_counts_table,
+        avoid=avoid,
+        avoid_duplicates=avoid_duplicates,
+        avoid_duplicates_initial_pattern=avoid_duplicates_initial_pattern,
+        generator=generator,
+    )[0]
+
+
+def sample_ngrams_with_at_least_one_unique_batch(
+    start: Integer[Tensor, "batch n_start"],  # noqa: F722
+    *,
+    num: int,
+    ngram_counts_table: Tensor,
+    avoid: Union[
+        Iterable[int], Bool[Tensor, "batch num_tokens"]
+    ] = tuple(),  # noqa: F722
+    generator: torch.Generator,
+) -> Integer[Tensor, "batch num"]:  # noqa: F722
+    """
+    Batched sample_ngrams_with_at_least_one_unique: the rejected rows are resampled together until every row has been
+    accepted.
+    """
+    num_tokens = ngram_counts_table.shape[-1]
+    device = ngram_counts_table.device
+    start = start.to(device=device, dtype=torch.long)
+    avoid = avoid_mask(
+        avoid, batch=start.shape[0], num_tokens=num_tokens, device=device
+    )
+    result = torch.empty((start.shape[0], num), dtype=torch.long, device=device)
+    pending = torch.arange(start.shape[0], device=device)
+    while len(pending) > 0:
+        ngrams = sample_ngrams_batch(
+            start[pending],
+            num=num,
+            ngram_counts_table=ngram_counts_table,
+            avoid=avoid[pending],
+            generator=generator,
+        )
+        accept = (
+            (calculate_batch_probabilities(ngrams, num_tokens) == 1)
+            .flatten(start_dim=1)
+            .any(dim=-1)
+        )
+        if num >= 2:
+            sorted_ngrams = ngrams.sort(dim=-1).values
+            unique = (sorted_ngrams[:, 1:] != sorted_ngrams[:, :-1]).all(dim=-1)
+            # resample the last character only to speed things up
+            prefix = ngrams[unique, :-1]
+            prefix_avoid = avoid[pending[unique]].clone()
+            prefix_avoid[
+                torch.arange(prefix.shape[0], device=device)[:, None], prefix
+            ] = True
+            ngrams[unique, -1:] = sample_ngrams_batch(
+                prefix,
+                num=1,
                 ngram_counts_table=ngram_counts_table,
-                avoid=avoid,
-                avoid_duplicates=avoid_duplicates,
-                avoid_duplicates_initial_pattern=avoid_duplicates_initial_pattern,
+                avoid=prefix_avoid,
                 generator=generator,
             )
-        ),
-        dtype=torch.long,
-    )
+            accept |= unique
+        result[pending[accept]] = ngrams[accept]
+        pending = pending[~accept]
+    return result
 
 
 def sample_ngrams_with_at_least_one_unique(
@@ -825,41 +1141,28 @@ def sample_ngrams_with_at_least_one_unique(
     avoid: Iterable[int] = tuple(),
     generator: torch.Generator,
 ) -> Integer[Tensor, "seq_length"]:  # noqa: F821
-    avoid = set(avoid)
-    while True:
-        ngram = sample_ngrams(
-            *start,
-            num=num,
-            ngram_counts_table=ngram_counts_table,
-            avoid=avoid,
-            generator=generator,
-        )
-        if num >= 2 and len(set(ngram.tolist())) == len(ngram):
-            # resample the last character only to speed things up
-            ngram = ngram[:-1]
-            avoid |= set(ngram.tolist())
-            return torch.cat(
-                [
-                    ngram,
-                    sample_ngrams(
-                        *ngram.tolist(),
-                        num=1,
-                        ngram_counts_table=ngram_counts_table,
-                        avoid=avoid,
-                        generator=generator,
-                    ),
-                ]
-            )
-        if (
-            calculate_batch_probabilities(ngram, ngram_counts_table.shape[0]) == 1
-        ).any():
-            return ngram
+    return sample_ngrams_with_at_least_one_unique_batch(
+        torch.tensor([start], dtype=torch.long).view(1, len(start)),
+        num=num,
+        ngram_counts_table=ngram_counts_table,
+        avoid=avoid,
+        generator=generator,
+    )[0]
 
 
 def calculate_batch_probabilities(
-    batch_input: Integer[Tensor, "... seq_length"], num_tokens: int  # noqa: F821, F722
+    batch_input: Integer[Tensor, "... seq_length"],  # noqa: F821, F722
+    num_tokens: int,
+    *,
+    batch_size: Optional[int] = None,
 ) -> Float[Tensor, "... seq_length num_tokens"]:  # noqa: F821, F722
-    # Convert batch input to a PyTorch tensor
+    """
+    Returns, at each position, the distribution of the tokens that followed the earlier occurrences of the current
+    token, or the uniform distribution if there are none (as at the first position).
+
+    The bigram counts of all positions are computed at once, as (earlier occurrences of the current token) @ (one-hot
+    following tokens); batch_size, if not None, bounds the number of sequences processed at once.
+    """
     # Convert batch input to a PyTorch tensor
     batch_tensor = (
         torch.tensor(batch_input, dtype=torch.long)
@@ -869,43 +1172,44 @@ def calculate_batch_probabilities(
 
     # Get the shape of the batch tensor
     batch_dims, seq_length = batch_tensor.shape[:-1], batch_tensor.shape[-1]
+    batch_tensor = batch_tensor.reshape(math.prod(batch_dims), seq_length)
+    device = batch_tensor.device
 
     # Initialize a tensor to store the probability distributions
     # Starting with a uniform distribution for the first position
     probability_distributions = (
-        torch.ones(batch_dims + (seq_length, num_tokens), dtype=torch.float)
+        torch.ones(
+            (batch_tensor.shape[0], seq_length, num_tokens),
+            dtype=torch.float,
+            device=device,
+        )
         / num_tokens
     )
 
-    # Create tensors to count occurrences and calculate cumulative probabilities
-    for i in range(1, seq_length):
-        # Count occurrences of each token in positions before the current one
-        tokens = torch.zeros(batch_dims)
-        tokens = batch_tensor[..., i]
-        token_occurrences = torch.zeros(batch_dims + (num_tokens,))
-        for next_token in range(num_tokens):
-            token_occurrences[..., next_token] = (
-                (
-                    (
-                        batch_tensor[..., :i]
-                        == tokens[...].unsqueeze(-1).expand_as(batch_tensor[..., :i])
-                    )
-                    & (batch_tensor[..., 1 : i + 1] == next_token)
-                )
-                .float()
-                .sum(dim=-1)
-            )
+    # earlier[i - 1, j] is whether j < i
+    earlier = torch.ones(
+        (max(0, seq_length - 1),) * 2, dtype=torch.bool, device=device
+    ).tril()
+    all_tokens = torch.arange(num_tokens, device=device)
+    dtype = torch.get_default_dtype()
+    batch_size = batch_size or max(1, batch_tensor.shape[0])
+    for start in range(0, batch_tensor.shape[0], batch_size):
+        xs = batch_tensor[start : start + batch_size]
+        # token_occurrences[:, i - 1, t] counts the j < i with xs[j] == xs[i], xs[j + 1] == t
+        same_token = (xs[:, 1:, None] == xs[:, None, :-1]) & earlier
+        next_tokens = xs[:, 1:, None] == all_tokens
+        token_occurrences = same_token.to(dtype) @ next_tokens.to(dtype)
         normalized_token_occurrences = token_occurrences / token_occurrences.sum(
             dim=-1, keepdim=True
         )
         normalized_token_occurrences[normalized_token_occurrences.isnan()] = (
             1 / num_tokens
         )
-        probability_distributions[..., i, :] = normalized_token_occurrences
-
-        # Normalize to get probabilities for positions from the second onwards
+        probability_distributions[start : start + xs.shape[0], 1:] = (
+            normalized_token_occurrences
+        )
 
-    return probability_distributions
+    return probability_distributions.reshape(batch_dims + (seq_length, num_tokens))
 
 
 def cat_bos_token(
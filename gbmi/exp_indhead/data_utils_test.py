@@ -0,0 +1,126 @@
+import itertools
+
+import torch
+
+from gbmi.exp_indhead.data_utils import (
+    ABCBCEnglishTask,
+    all_ngrams,
+    all_ngrams_chunks,
+    all_sequences_avoiding_iter,
+    calculate_batch_probabilities,
+    sample_ngrams,
+    sample_ngrams_batch,
+)
+from gbmi.utils.testing import TestCase
+
+
+class TestDataUtils(TestCase):
+    def test_all_ngrams(self):
+        expected = [
+            x
+            for x in itertools.product(range(5), repeat=4)
+            if 1 not in x and x[1] not in x[:1] and x[3] not in x[:3]
+        ]
+        kwargs = dict(
+            num_tokens=5,
+            ngram=4,
+            avoid=[1],
+            avoid_duplicates_initial_pattern=[False, True, False],
+            avoid_duplicates=True,
+        )
+        self.assertEqual(all_ngrams(**kwargs).tolist(), [list(x) for x in expected])
+        self.assertTrue(
+            torch.cat(list(all_ngrams_chunks(**kwargs, chunk_size=10))).equal(
+                all_ngrams(**kwargs)
+            )
+        )
+        sequences = list(
+            all_sequences_avoiding_iter(
+                valid_toks=torch.tensor([0, 2, 3]),
+                length=3,
+                generator=torch.Generator().manual_seed(0),
+            )
+        )
+        self.assertEqual(
+            sorted(x.tolist() for x in sequences),
+            [list(x) for x in itertools.product([0, 2, 3], repeat=3)],
+        )
+
+    def test_calculate_batch_probabilities(self):
+        xs = torch.randint(0, 4, (3, 5, 9), generator=torch.Generator().manual_seed(0))
+        probs = calculate_batch_probabilities(xs, 4)
+        self.assertTrue(probs.equal(calculate_batch_probabilities(xs, 4, batch_size=4)))
+        for x, p in zip(xs.flatten(0, 1).tolist(), probs.flatten(0, 1)):
+            for i in range(len(x)):
+                counts = torch.zeros(4)
+                for j in range(i):
+                    if x[j] == x[i]:
+                        counts[x[j + 1]] += 1
+                expected = (
+                    counts / counts.sum()
+                    if counts.sum() > 0
+                    else torch.full((4,), 1 / 4)
+                )
+                self.assertTrue(p[i].equal(expected), msg=(x, i))
+
+    def test_sample_ngrams_batch(self):
+        table = torch.rand(6, 6, 6, generator=torch.Generator().manual_seed(0))
+        start = torch.tensor([[0, 1], [2, 3], [4, 5], [1, 1]])
+        avoid = torch.eye(6, dtype=torch.bool)[[5, 4, 3, 2]]
+        sample = lambda seed: sample_ngrams_batch(
+            start,
+            num=5,
+            ngram_counts_table=table,
+            avoid=avoid,
+            avoid_duplicates=True,
+            generator=torch.Generator().manual_seed(seed),
+        )
+        xs = sample(1)
+        self.assertEqual(xs.shape, (4, 5))
+        self.assertTrue(xs.equal(sample(1)))
+        self.assertFalse(avoid.gather(-1, xs).any())
+        self.assertTrue(
+            (xs.sort(dim=-1).values[:, 1:] != xs.sort(dim=-1).values[:, :-1]).all()
+        )
+        self.assertTrue(
+            sample_ngrams(
+                2,
+                3,
+                num=5,
+                ngram_counts_table=table,
+                avoid=[4],
+                avoid_duplicates=True,
+                generator=torch.Generator().manual_seed(1),
+            ).equal(
+                sample_ngrams_batch(
+                    start[1:2],
+                    num=5,
+                    ngram_counts_table=table,
+                    avoid=avoid[1:2],
+                    avoid_duplicates=True,
+                    generator=torch.Generator().manual_seed(1),
+                )[0]
+            )
+        )
+
+    def test_abcab_english_batches(self):
+        table = torch.rand(8, 8, 8, generator=torch.Generator().manual_seed(0))
+        xs = torch.stack(
+            list(
+                ABCBCEnglishTask.dist_generator(
+                    seed=0,
+                    num_tokens=8,
+                    seq_length=8,
+                    max_length=100,
+                    skip_end=True,
+                    ngram_counts_table=table,
+                    batch_size=32,
+                )
+            )
+        )
+        self.assertEqual(xs.shape, (100, 8))
+        # the last token is a, which occurs exactly once before, followed by b
+        self.assertTrue(((xs == xs[:, -1:]).sum(dim=-1) == 2).all())
+        self.assertTrue(
+            (calculate_batch_probabilities(xs, 8)[:, -1] == 1).any(dim=-1).all()
+        )
@@ -13,7 +13,7 @@ from tqdm import tqdm
 import plotly.express as px
 from gbmi.utils.sequences import generate_all_sequences
 import pandas as pd
-from gbmi.utils import ein
+from gbmi.utils import ein, masked_max, masked_min
 from functools import partial
 from inspect import signature
 from typing import Callable, Optional, List
@@ -22,22 +22,27 @@ import numpy as np
 import plotly.express as px
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
-torch.set_default_device("cuda")
-runtime_model_1, model_1 = train_or_load_model(ABCAB8_1H, force="load")
-model_1.to(device)
 
-W_pos_1 = model_1.W_pos
-W_E_1 = model_1.W_E
-n_ctx = W_pos_1.shape[0]
-d_voc = W_E_1.shape[0]
-d_model = W_E_1.shape[1]
-attn_scale_0 = model_1.blocks[0].attn.attn_scale
-attn_scale_1 = model_1.blocks[1].attn.attn_scale
+# %%
+if __name__ == "__main__":
+    torch.set_default_device("cuda")
+    runtime_model_1, model_1 = train_or_load_model(ABCAB8_1H, force="load")
+    model_1.to(device)
+
+
+def shift_right(x, dim=-1):
+    # x.select(dim, i - 1) at index i (index 0 repeats index 0, and is never used)
+    return torch.cat([x.narrow(dim, 0, 1), x.narrow(dim, 0, x.shape[dim] - 1)], dim=dim)
 
 
 # %%
 def loss_bound(model, s, w):
 
+    n_ctx = model.cfg.n_ctx
+    d_voc = model.cfg.d_vocab
+    attn_scale_0 = model.blocks[0].attn.attn_scale
+    attn_scale_1 = model.blocks[1].attn.attn_scale
+
     W_pos = model.W_pos
     W_E = model.W_E
     W_K_1 = model.W_K[1, 0]
@@ -63,20 +68,30 @@ def loss_bound(model, s, w):
         )
         / attn_scale_0
     )
-    table = torch.zeros((d_voc, d_voc, n_ctx - 2, d_voc)) + float(
-        "nan"
-    )  # p Represents the position of 'b' at index + 1
-
-    for p in range(2, n_ctx):  #
-        tmp = torch.zeros((p, d_voc))
-        for t_q in range(d_voc):
-            tmp[-1, :] = everything[p - 1, t_q, p - 1, t_q]
-
-            for t_k in range(d_voc):
-                tmp[-2, :] = everything[p - 1, t_q, p - 2, t_k]
-                tmp[:-2, :] = everything[p - 1, t_q, : p - 2, :]
-                tmp_sm = tmp.softmax(dim=0)
-                table[t_q, t_k, p - 2, :] = tmp_sm[-2, :]
+    positions = torch.arange(n_ctx)
+    tokens = torch.arange(d_voc)
+
+    # p Represents the position of 'b' at index + 1
+    # For each p, the scores [p - 2, t_q, t_k, r, last] of query position p - 1 (holding t_q) against key positions
+    # r, with t_k at p - 2 and every earlier position holding last; positions r >= p are padding, masked to -inf
+    p = positions[2:]
+    r = positions[None, :]
+    scores = torch.where(
+        (r < p[:, None] - 2)[:, None, None, :, None],
+        everything[p - 1, :, None],
+        -torch.inf,
+    )
+    scores = torch.where(
+        (r == p[:, None] - 2)[:, None, None, :, None],
+        everything[p - 1, :, p - 2, :][..., None, None],
+        scores,
+    )
+    scores = torch.where(
+        (r == p[:, None] - 1)[:, None, None, :, None],
+        everything[p - 1, :, p - 1, :].diagonal(dim1=1, dim2=2)[..., None, None, None],
+        scores,
+    )
+    table = scores.softmax(dim=3)[p - 2, :, :, p - 2].permute(1, 2, 0, 3)
     # Table represents post softmax attention paid to t_k, if the final entry is spammed everywhere, and t_q is used as the first entry, at pth poisition
 
     # everything looks like EQKE, table looks like you're indexing by query, key, position (of key?), and other token in the sequence.
@@ -203,214 +218,103 @@ def loss_bound(model, s, w):
             ]
         ).max()
 
-    def diff_1(a, i_1, i_2, j, dic):
-
-        if j == i_1:
-            return 0
-        else:
-            return term_1[i_2, a, j, dic[j]].max() - term_1[i_2, a, i_1, dic[i_1]].min()
-
-    def diff_3(a, i_1, i_2, j, dic):
-
-        if j == i_1:
-            return 0
-        if j != 0 and j != 1:
-            c = term_3[i_2, dic[i_2], 0, dic[0]].max()
-            for i in range(1, j - 1):
-                c = torch.max(c, term_3[i_2, dic[i_2], i, dic[i]].max())
-            c = torch.max(c, term_3[i_2, dic[i_2], j, dic[j]].max())
-
-            t_3 = torch.where(c > 0, (1 - attn_1[dic[j], j - 1].min()) * c, 0)
-
-            """
-            if a != 0 and a != d_voc - 1:
-                c = torch.max(
-                    term_3[i_2, a, j - 1, :a].max(), term_3[i_2, a, j - 1, a + 1 :].max()
-                )
-            if a == 0:
-                c = term_3[i_2, a, j - 1, a + 1 :].max()
-
-            if a == d_voc - 1:
-                c = term_3[i_2, a, j - 1, :a].max()
-            """
-            c = term_3[i_2, a, j - 1, dic[j - 1]].max()
-            t_3 = torch.where(c > 0, t_3 + c, t_3 + (attn_1[dic[j], j - 1].min() * c))
-
-            # print(t_3)
-        if j == 1:
-            c = term_3[i_2, a, j, dic[j]].max()
-
-            t_3 = torch.where(c > 0, (1 - attn_1[dic[j], j - 1].min()) * c, 0)
-
-            """
-            if a != 0 and a != d_voc - 1:
-
-                c = torch.max(
-                    term_3[i_2, a, j - 1, :a].max(), term_3[i_2, a, j - 1, a + 1 :].max()
-                )
-
-            if a == 0:
-                c = term_3[i_2, a, j - 1, a + 1 :].max()
-
-            if a == d_voc - 1:
-                c = term_3[i_2, a, j - 1, :a].max()
-            """
-            c = term_3[i_2, a, j - 1, dic[j - 1]].max()
-
-            t_3 = torch.where(c > 0, t_3 + c, t_3 + (attn_1[dic[j], j - 1].min() * c))
-
-            # print(t_3)
-        if j == 0:
-
-            t_3 = term_3[i_2, a, j, dic[j]].max()
-            # print(t_3)
-        if i_1 != 1:
-            c = term_3[i_2, dic[i_2], 0, dic[0]].min()
-            for i in range(1, i_1 - 1):
-                c = torch.min(c, term_3[i_2, dic[i_2], i, dic[i]].min())
-            c = torch.min(c, term_3[i_2, dic[i_2], i_1, dic[i_1]].min())
-
-            # c = torch.min(term_3[i_2, a, : i_1 - 1, a].min(), term_3[i_2, a, i_1, b].min())
-
-            t_3 = torch.where(
-                c < 0, t_3 - (1 - attn_1[dic[i_1], i_1 - 1].min()) * c, t_3
-            )
-
-            c = term_3[i_2, a, i_1 - 1, a]
-
-            t_3 = torch.where(c < 0, t_3 - c, t_3 - attn_1[dic[i_1], i_1 - 1].min() * c)
-
-            # print(t_3)
-        if i_1 == 1:
-            c = term_3[i_2, a, i_1, dic[i_1]].min()
-
-            torch.where(c < 0, t_3 - (1 - attn_1[dic[i_1], i_1 - 1].min()) * c, t_3)
-
-            c = term_3[i_2, a, i_1 - 1, a]
-
-            torch.where(c < 0, t_3 - c, t_3 - attn_1[dic[i_1], i_1 - 1].min() * c)
-
-            # print(t_3)
-
-        return t_3
-
-    def diff_2_4(a, i_1, i_2, j, dic):
-        if j == i_1:
-            return 0
-        for k in range(i_2 + 1):
-            if j != 0 and j != 1:
-
-                c = term_4[k, dic[k], 0][..., dic[0]].max()
-                for i in range(1, j - 1):
-
-                    c = torch.max(c, term_4[k, dic[k], i][..., dic[i]].max())
-                c = torch.max(c, term_4[k, dic[k], j][..., dic[j]].max())
-
-                d = torch.where(c > 0, (1 - attn_1[dic[j], j - 1].min()) * c, 0)
-
-                c = term_4[k, dic[k], j - 1][..., dic[j - 1]].max()
-
-                d = torch.where(c > 0, d + c, d + attn_1[dic[j], j - 1].min() * c)
-
-            if j == 0:
-
-                d = term_4[k, dic[k], j][..., dic[j]].max()
-
-            if j == 1:
-                c = term_4[k, dic[k], j][..., dic[j]].max()
-
-                d = torch.where(c > 0, (1 - attn_1[dic[j], j - 1].min()) * c, 0)
-
-                c = term_4[k, dic[k], j - 1][..., dic[j - 1]].max()
-
-                d = torch.where(c > 0, d + c, d + attn_1[dic[j], j - 1].min() * c)
-
-            # print(d)
-            if i_1 != 1:
-
-                c = term_4[k, dic[k], 0][..., dic[0]].min()
-
-                for i in range(1, i_1 - 1):
-
-                    c = torch.min(c, term_4[k, dic[k], i][..., dic[i]].min())
-                c = torch.min(c, term_4[k, dic[k], i_1][..., dic[i_1]].min())
-
-                d = torch.where(c < 0, d - (1 - attn_1[dic[i_1], i_1 - 1].min()) * c, d)
-
-                c = term_4[k, dic[k], i_1 - 1, a].min()
-
-                d = torch.where(c < 0, d - c, d - attn_1[dic[i_1], i_1 - 1].min() * c)
-
-            if i_1 == 1:
-                c = term_4[k, dic[k], i_1][..., dic[i_1]].min()
-
-                d = torch.where(c < 0, d - (1 - attn_1[dic[i_1], i_1 - 1].min()) * c, d)
-
-                c = term_4[k, dic[k], i_1 - 1, a].min()
-
-                d = torch.where(c < 0, d - c, d - attn_1[dic[i_1], i_1 - 1].min() * c)
-
-            # print(d)
-
-            if type(dic[j]) == int:
-                d += (
-                    term_2[k, dic[k], j][..., dic[j]]
-                    - term_2[k, dic[k], i_1][..., dic[i_1]].min(dim=-1).values
-                ).max()
-
-            else:
-                d += (
-                    term_2[k, dic[k], j][..., dic[j]].max(dim=-1).values
-                    - term_2[k, dic[k], i_1][..., dic[i_1]].min(dim=-1).values
-                ).max()
-
-            if k == 0:
-
-                f = d
-
-            if k != 0 and k != i_2 - 1:
-                f = torch.max(f, d)
-
-            if k == i_2 - 1:
-
-                g = d
-
-        t_4 = torch.where(f > 0, (1 - attn_1[dic[i_2], i_2 - 1]) * f, 0)
-
-        t_4 = torch.where(g > 0, t_4 + g, t_4 + g * attn_1[dic[i_2], i_2 - 1])
-
-        return t_4
-
-    def least_attention(a, i_1, i_2, j, dic):
-        e = diff_2_4(a, i_1, i_2, j, dic)
-
-        return diff_1(a, i_1, i_2, j, dic) + diff_3(a, i_1, i_2, j, dic) + e
-
-    bound = (
-        torch.zeros(
-            (
-                e_p.shape[1],
-                e_p.shape[0],
-                e_p.shape[0],
-                e_p.shape[0],
-            )
-        )
-        - torch.inf
+    # Every tuple (a, i_2, i_1, j) is evaluated at once, with dimensions in that order.  For each tuple, positions
+    # i_2 and i_1 - 1 hold a, and every other position holds one of the first 8 tokens other than a; in_dic[a, i_2,
+    # i_1, pos, t] says whether position pos may hold token t.
+    free = tokens < 8
+    pinned = (positions[None, None, :] == positions[:, None, None]) | (
+        positions[None, None, :] == positions[None, :, None] - 1
+    )
+    is_a = tokens[:, None] == tokens[None, :]
+    in_dic = torch.where(
+        pinned[None, :, :, :, None],
+        is_a[:, None, None, None, :],
+        (~is_a & free)[:, None, None, None, :],
+    )
+    # before_j[j, pos]: pos is j, or comes before j - 1
+    before_j = (positions[None, :] <= positions[:, None] - 2) | (
+        positions[None, :] == positions[:, None]
+    )
+    j = positions
+    later_i_1 = (positions >= 2)[:, None]
+    # attn_pos[t, pos] = attn_1[t, pos - 1], padded with 1 at positions 0 and n_ctx - 1, which are never read
+    pad = torch.ones((d_voc, 1))
+    attn_pos = torch.cat([pad, attn_1, pad], dim=1)
+    # least attention paid to position pos - 1 by the token at pos
+    attn_least = masked_min(attn_pos.T, in_dic, -1)
+    attn_least_i_1 = attn_least.diagonal(dim1=2, dim2=3)[..., None]
+
+    # diff_1
+    t_1 = term_1.transpose(0, 1)[:, :, None]
+    t_1 = (
+        masked_max(t_1, in_dic, -1)
+        - masked_min(t_1, in_dic, -1).diagonal(dim1=2, dim2=3)[..., None]
     )
 
-    for a in range(e_p.shape[1]):
+    # diff_3
+    t_3_by_pos = term_3.transpose(0, 1)
+    hi = masked_max(t_3_by_pos[:, :, None], in_dic, -1)
+    lo = masked_min(t_3_by_pos[:, :, None], in_dic, -1)
+    c = masked_max(hi[..., None, :], before_j, -1)
+    t_3 = torch.where(c > 0, (1 - attn_least) * c, 0)
+    t_3 = torch.where(j == 0, c, t_3)
+    c = shift_right(hi)
+    t_3 = torch.where(j == 0, t_3, torch.where(c > 0, t_3 + c, t_3 + (attn_least * c)))
+    # as in the per-tuple version, the i_1 == 1 terms are not subtracted
+    c = masked_min(lo[..., None, :], before_j, -1).diagonal(dim1=2, dim2=3)[..., None]
+    t_3 = torch.where(later_i_1 & (c < 0), t_3 - (1 - attn_least_i_1) * c, t_3)
+    c = shift_right(t_3_by_pos.diagonal(dim1=0, dim2=3).permute(2, 0, 1))[..., None]
+    t_3 = torch.where(
+        later_i_1,
+        torch.where(c < 0, t_3 - c, t_3 - attn_least_i_1 * c),
+        t_3,
+    )
 
-        for i_2 in range(e_p.shape[0] - 1):
-            for i_1 in range(i_2):
-                for j in range(i_2 + 1):
-                    if (i_1 < i_2) & (i_1 > 0) & (i_2 + 1 > j):
-                        dic = {
-                            i_2: a,
-                            i_1 - 1: a,
-                        }
-                        for i in range(8):
-                            dic.setdefault(i, torch.arange(8)[torch.arange(8) != a])
-                        bound[a, i_2, i_1, j] = least_attention(a, i_1, i_2, j, dic)
+    # diff_2_4; d is indexed by [a, i_2, i_1, k, j], for the query at position k
+    in_k = in_dic[..., None]
+    in_pos = in_dic[:, :, :, None, None]
+    hi = masked_max(masked_max(term_4, in_pos, -1), in_k, -2)
+    lo = masked_min(masked_min(term_4, in_pos, -1), in_k, -2)
+    attn_least_k = attn_least[:, :, :, None, :]
+    attn_least_i_1_k = attn_least_i_1[..., None]
+    c = masked_max(hi[..., None, :], before_j, -1)
+    d = torch.where(c > 0, (1 - attn_least_k) * c, 0)
+    d = torch.where(j == 0, c, d)
+    c = shift_right(hi)
+    d = torch.where(j == 0, d, torch.where(c > 0, d + c, d + attn_least_k * c))
+    c = (
+        masked_min(lo[..., None, :], before_j, -1)
+        .diagonal(dim1=2, dim2=4)
+        .movedim(-1, 2)[..., None]
+    )
+    d = torch.where(c < 0, d - (1 - attn_least_i_1_k) * c, d)
+    c = masked_min(
+        shift_right(term_4.permute(3, 0, 1, 2)).permute(0, 3, 1, 2)[:, None],
+        in_dic,
+        -1,
+    )[..., None]
+    d = torch.where(c < 0, d - c, d - attn_least_i_1_k * c)
+    hi = masked_max(term_2, in_pos, -1)
+    lo = masked_min(term_2, in_pos, -1).diagonal(dim1=2, dim2=5).movedim(-1, 2)
+    d = d + masked_max(hi - lo[..., None], in_k, -2)
+
+    # f is the worst case over k <= i_2 other than i_2 - 1, and g is the case k = i_2 - 1
+    not_prev = (positions[None, :] <= positions[:, None]) & (
+        positions[None, :] != positions[:, None] - 1
+    )
+    f = masked_max(d, not_prev[:, None, :, None], 3)
+    g = shift_right(d, dim=3).diagonal(dim1=1, dim2=3).movedim(-1, 1)
+    attn_i_2 = attn_pos[:, :, None, None]
+    t_4 = torch.where(f > 0, (1 - attn_i_2) * f, 0)
+    t_4 = torch.where(g > 0, t_4 + g, t_4 + g * attn_i_2)
+
+    i_2 = positions[:, None, None]
+    i_1 = positions[None, :, None]
+    bound = torch.where(
+        (0 < i_1) & (i_1 < i_2) & (i_2 < n_ctx - 1) & (j <= i_2),
+        torch.where(j == i_1, 0, t_1 + t_3 + t_4),
+        -torch.inf,
+    )
 
     bound_soft = bound.softmax(dim=-1)
     bound_2 = einops.einsum(
@@ -421,246 +325,162 @@ def loss_bound(model, s, w):
     if s == 2:
         return (attn_1, bound, bound_2)
 
-    def loss_diff_1(b, i_1, i_2, dic):
-
-        n = torch.arange(d_voc)[torch.arange(d_voc) != b]
-
-        return (term_5[i, :, n] - term_5[i, :, b].unsqueeze(dim=-1)).max()
-
-    def loss_diff_2(b, i_1, i_2, dic):
-
-        n = torch.arange(d_voc)[torch.arange(d_voc) != b]
-
-        c = (term_6[0, dic[0]][..., n] - term_6[0, dic[0], b].unsqueeze(dim=-1)).max()
-
-        for i in range(i_2 - 1):
-            c = torch.max(
-                c,
-                (
-                    term_6[i, dic[i]][..., n] - term_6[i, dic[i], b].unsqueeze(dim=-1)
-                ).max(),
-            )
-        c = torch.max(
-            c,
-            (
-                term_6[i_2, dic[i_2]][..., n]
-                - term_6[i_2, dic[i_2], b].unsqueeze(dim=-1)
-            ).max(),
-        )
-        ld_2 = torch.where(c > 0, (1 - attn_1[dic[i_2], i_2 - 1].min()) * c, 0)
-
-        c = (
-            term_6[i_2 - 1, dic[i_2 - 1]][..., n]
-            - term_6[i_2 - 1, dic[i_2 - 1], b].unsqueeze(dim=-1)
-        ).max()
-        ld_2 = torch.where(
-            c > 0, ld_2 + c, ld_2 + (c * attn_1[dic[i_2], i_2 - 1].min())
-        )
-        return ld_2
-
-    def loss_diff_3(b, i_1, i_2, dic):
-        n = torch.arange(d_voc)[torch.arange(d_voc) != b]
-        c = (term_7[0, dic[0]][..., n] - term_7[0, dic[0], b].unsqueeze(dim=-1)).max()
-        for i in range(i_1):
-            c = torch.max(
-                c,
-                (
-                    term_7[i, dic[i]][..., n] - term_7[i, dic[i], b].unsqueeze(dim=-1)
-                ).max(),
-            )
-        for i in range(i_2, i_1, -1):
-            c = torch.max(
-                c,
-                (
-                    term_7[i, dic[i]][..., n] - term_7[i, dic[i], b].unsqueeze(dim=-1)
-                ).max(),
-            )
-
-        ld_3 = torch.where(c > 0, (1 - bound_2[dic[i_2], i_2, i_1].min()) * c, 0)
-
-        c = (
-            term_7[i_1, dic[i_1]][..., n] - term_7[i_1, dic[i_1], b].unsqueeze(dim=-1)
-        ).max()
-        ld_3 = torch.where(
-            c > 0, ld_3 + c, ld_3 + (c * bound_2[dic[i_2], i_2, i_1].min())
-        )
-        return ld_3
-
-    def loss_diff_4(b, i_1, i_2, dic):
-
-        n = torch.arange(d_voc)[torch.arange(d_voc) != b]
-
-        for k in range(i_2 + 1):
-            if k != 0 and k != 1:
-                c = (
-                    term_8[0, dic[0]][..., n] - term_8[0, dic[0], b].unsqueeze(dim=-1)
-                ).max()
-                for i in range(k - 1):
-                    c = torch.max(
-                        c,
-                        (
-                            term_8[i, dic[i]][..., n]
-                            - term_8[i, dic[i], b].unsqueeze(dim=-1)
-                        ).max(),
-                    )
-                c = torch.max(
-                    c,
-                    (
-                        term_8[k, dic[k]][..., n]
-                        - term_8[k, dic[k], b].unsqueeze(dim=-1)
-                    ).max(),
-                )
-                d = torch.where(c > 0, (1 - attn_1[dic[k], k - 1].min()) * c, 0)
-                c = (
-                    term_8[k - 1, dic[k - 1]][..., n]
-                    - term_8[k - 1, dic[k - 1], b].unsqueeze(dim=-1)
-                ).max()
-                d = torch.where(c > 0, d + c, d + c * attn_1[dic[k], k - 1].min())
-
-            if k == 0:
-                d = (
-                    term_8[0, dic[0]][..., n] - term_8[0, dic[0], b].unsqueeze(dim=-1)
-                ).max()
-
-            if k == 1:
-                c = (
-                    term_8[1, dic[1]][..., n] - term_8[1, dic[1], b].unsqueeze(dim=-1)
-                ).max()
-                d = torch.where(c > 0, (1 - attn_1[dic[k], k - 1].min()) * c, 0)
-                c = (
-                    term_8[0, dic[0]][..., n] - term_8[0, dic[0], b].unsqueeze(dim=-1)
-                ).max()
-                d = torch.where(c > 0, d + c, d + c * attn_1[dic[k], k - 1].min())
-            if k == 0:
-                f = d
-            if k != 0 and k != i_1:
-                f = torch.max(f, d)
-            if k == i_1:
-                g = d
-
-        ld_4 = torch.where(f > 0, (1 - bound_2[dic[i_2], i_2, i_1].min()) * f, 0)
-        ld_4 = torch.where(
-            g > 0, ld_4 + g, ld_4 + g * (bound_2[dic[i_2], i_2, i_1].min())
-        )
-        return ld_4
-
-    def total_bound(b, i_1, i_2, dic):
-        return (
-            loss_diff_1(b, i_1, i_2, dic)
-            + loss_diff_2(b, i_1, i_2, dic)
-            + loss_diff_3(b, i_1, i_2, dic)
-            + loss_diff_4(b, i_1, i_2, dic)
-        )
-
-    out = torch.zeros((d_voc, n_ctx, n_ctx)) + torch.inf
+    # Every (b, i_2, i_1) is evaluated at once, with dimensions in that order.  Position i_1 holds b, and every other
+    # position holds one of the first 8 tokens; in_out[b, i_1, pos, t] says whether position pos may hold token t.
+    i_2 = positions[:, None]
+    i_1 = positions[None, :]
+    valid = (0 < i_1) & (i_1 < i_2) & (i_2 < n_ctx - 1)
+    in_out = torch.where(
+        (positions[:, None] == positions[None, :])[None, :, :, None],
+        is_a[:, None, None, :],
+        free[None, None, None, :],
+    )
+    attn_least = masked_min(attn_pos.T, in_out, -1)
+    # rows of bound_2 outside valid are nan, and must not reach the gradient
+    bound_least = torch.where(valid, bound_2[free], 1).amin(dim=0)
+    # not_i_1[i_2, i_1, pos]: the positions up to i_2 other than i_1
+    not_i_1 = (positions <= i_2[..., None]) & (positions != i_1[..., None])
+    others = ~is_a
+
+    def logit_diff(term):
+        # worst logit difference [b, i_1, pos] between any other token and b, from the token at pos
+        diff = masked_max(term[:, :, None, :] - term[:, :, :, None], others, -1)
+        return masked_max(diff.permute(2, 0, 1)[:, None], in_out, -1)
+
+    # loss_diff_1; as in the per-tuple version, this is read off at the last position
+    ld_1 = masked_max(
+        term_5[n_ctx - 1, :, None, :] - term_5[n_ctx - 1, :, :, None], others, -1
+    ).amax(dim=0)[:, None, None]
+
+    # loss_diff_2
+    diff = logit_diff(term_6)
+    attn_i_2 = attn_least.transpose(1, 2)
+    c = masked_max(diff[:, None], before_j[:, None, :], -1)
+    ld_2 = torch.where(c > 0, (1 - attn_i_2) * c, 0)
+    c = shift_right(diff).transpose(1, 2)
+    ld_2 = torch.where(c > 0, ld_2 + c, ld_2 + (c * attn_i_2))
+
+    # loss_diff_3
+    diff = logit_diff(term_7)
+    c = masked_max(diff[:, None], not_i_1, -1)
+    ld_3 = torch.where(c > 0, (1 - bound_least) * c, 0)
+    c = diff.diagonal(dim1=1, dim2=2)[:, None, :]
+    ld_3 = torch.where(c > 0, ld_3 + c, ld_3 + (c * bound_least))
+
+    # loss_diff_4, with the query position k in the last dimension
+    diff = logit_diff(term_8)
+    c = masked_max(diff[:, :, None, :], before_j, -1)
+    d = torch.where(c > 0, (1 - attn_least) * c, 0)
+    d = torch.where(positions == 0, c, d)
+    c = shift_right(diff)
+    d = torch.where(positions == 0, d, torch.where(c > 0, d + c, d + c * attn_least))
+    f = masked_max(d[:, None], not_i_1, -1)
+    g = d.diagonal(dim1=1, dim2=2)[:, None, :]
+    ld_4 = torch.where(f > 0, (1 - bound_least) * f, 0)
+    ld_4 = torch.where(g > 0, ld_4 + g, ld_4 + g * bound_least)
+
+    out = torch.where(valid, ld_1 + ld_2 + ld_3 + ld_4, torch.inf)
     # b i_2 i_1
 
-    for b in range(e_p.shape[1]):
-
-        for i_2 in range(e_p.shape[0] - 1):
-            for i_1 in range(1, i_2):
-
-                if (i_1 < i_2) & (i_1 > 0):
-                    dic = {i_1: b}
-                    for i in range(8):
-                        dic.setdefault(i, torch.arange(8))
-
-                    out[b, i_2, i_1] = total_bound(b, i_1, i_2, dic)
-
-    out_2 = 1 / (1 + ((d_voc - 1) * torch.exp(out)))
+    # 1 / (1 + (d_voc - 1) * exp(out)), without overflowing exp in the gradient
+    out_2 = torch.sigmoid(-out - log(d_voc - 1))
 
     return (attn_1, bound, bound_2, out, out_2)
 
 
 # %%
-optimiser = torch.optim.AdamW(
-    model_1.parameters(), lr=5e-3, betas=(0.9, 0.999), weight_decay=1.0
-)
+if __name__ == "__main__":
+    optimiser = torch.optim.AdamW(
+        model_1.parameters(), lr=5e-3, betas=(0.9, 0.999), weight_decay=1.0
+    )
 
-counter = 0
+    counter = 0
 # %%
-loss = loss_bound(model_1, 0, 5)
-for i in range(100):
-    print(loss)
-    loss.backward()
-    optimiser.step()
-    optimiser.zero_grad()
+if __name__ == "__main__":
     loss = loss_bound(model_1, 0, 5)
-    counter += 1
-    print(counter)
+    for i in range(100):
+        print(loss)
+        loss.backward()
+        optimiser.step()
+        optimiser.zero_grad()
+        loss = loss_bound(model_1, 0, 5)
+        counter += 1
+        print(counter)
 
 
 # %%
-loss = 1 - loss_bound(model_1, 1, 5).min()
-while loss > 0.02:
-    print(1 - loss)
-    loss.backward()
-    optimiser.step()
-    optimiser.zero_grad()
+if __name__ == "__main__":
     loss = 1 - loss_bound(model_1, 1, 5).min()
-    counter += 1
-    print(counter)
+    while loss > 0.02:
+        print(1 - loss)
+        loss.backward()
+        optimiser.step()
+        optimiser.zero_grad()
+        loss = 1 - loss_bound(model_1, 1, 5).min()
+        counter += 1
+        print(counter)
 # %%
-
-a = loss_bound(model_1, 2, 6)[2]
-loss = 1 - a[~torch.isnan(a)].mean()
-while loss > 0.1:
-    print(1 - loss)
-    loss.backward()
-    optimiser.step()
-    optimiser.zero_grad()
+if __name__ == "__main__":
     a = loss_bound(model_1, 2, 6)[2]
     loss = 1 - a[~torch.isnan(a)].mean()
-    counter += 1
-    print(counter)
+    while loss > 0.1:
+        print(1 - loss)
+        loss.backward()
+        optimiser.step()
+        optimiser.zero_grad()
+        a = loss_bound(model_1, 2, 6)[2]
+        loss = 1 - a[~torch.isnan(a)].mean()
+        counter += 1
+        print(counter)
 # %%
-a = loss_bound(model_1, 2, 8)[2]
-loss = 1 - a[~torch.isnan(a)].min()
-while loss > 0.5:
-    print(1 - loss)
-    loss.backward()
-    optimiser.step()
-    optimiser.zero_grad()
+if __name__ == "__main__":
     a = loss_bound(model_1, 2, 8)[2]
     loss = 1 - a[~torch.isnan(a)].min()
-    counter += 1
-    print(counter)
+    while loss > 0.5:
+        print(1 - loss)
+        loss.backward()
+        optimiser.step()
+        optimiser.zero_grad()
+        a = loss_bound(model_1, 2, 8)[2]
+        loss = 1 - a[~torch.isnan(a)].min()
+        counter += 1
+        print(counter)
 
 
 # %%
-counter = 0
-optimiser = torch.optim.AdamW(
-    model_1.parameters(), lr=5e-1, betas=(0.9, 0.999), weight_decay=1.0
-)
+if __name__ == "__main__":
+    counter = 0
+    optimiser = torch.optim.AdamW(
+        model_1.parameters(), lr=5e-1, betas=(0.9, 0.999), weight_decay=1.0
+    )
 
-a = loss_bound(model_1, 3, 8)[4]
-loss = 1 - a[a != 0].mean()
-for i in range(1):
-    print(a[a != 0].mean())
-    loss.backward()
-    optimiser.step()
-    optimiser.zero_grad()
-    a = loss_bound(model_1, 3, 8)[4][5]
+    a = loss_bound(model_1, 3, 8)[4]
     loss = 1 - a[a != 0].mean()
-    counter += 1
-    print(counter)
-
-
-optimiser = torch.optim.AdamW(
-    model_1.parameters(), lr=5e-3, betas=(0.9, 0.999), weight_decay=1.0
-)
+    for i in range(1):
+        print(a[a != 0].mean())
+        loss.backward()
+        optimiser.step()
+        optimiser.zero_grad()
+        a = loss_bound(model_1, 3, 8)[4][5]
+        loss = 1 - a[a != 0].mean()
+        counter += 1
+        print(counter)
+
+    optimiser = torch.optim.AdamW(
+        model_1.parameters(), lr=5e-3, betas=(0.9, 0.999), weight_decay=1.0
+    )
 
-a = loss_bound(model_1, 3, 8)[4]
-loss = 1 - a[a != 0].mean()
-for i in range(30):
-    print(a[a != 0].mean())
-    loss.backward()
-    optimiser.step()
-    optimiser.zero_grad()
-    a = loss_bound(model_1, 3, 8)[4][5]
+    a = loss_bound(model_1, 3, 8)[4]
     loss = 1 - a[a != 0].mean()
-    counter += 1
-    print(counter)
+    for i in range(30):
+        print(a[a != 0].mean())
+        loss.backward()
+        optimiser.step()
+        optimiser.zero_grad()
+        a = loss_bound(model_1, 3, 8)[4][5]
+        loss = 1 - a[a != 0].mean()
+        counter += 1
+        print(counter)
 
 # %%
 '''
@@ -1260,24 +1080,25 @@ def diff_4_2(a, b, i_1, i_2, j):
 """
 
 # %%
-import torch
-import matplotlib.pyplot as plt
+if __name__ == "__main__":
+    import torch
+    import matplotlib.pyplot as plt
 
-# Example tensor with more than 2 dimensions
-# Create a 3x4x5 tensor with random elements from a normal distribution
+    # Example tensor with more than 2 dimensions
+    # Create a 3x4x5 tensor with random elements from a normal distribution
 
-# Flatten the tensor to 1D so that we can plot the histogram of all elements
-flattened_tensor = (bound_2[mask]).flatten().detach().cpu().numpy()
+    # Flatten the tensor to 1D so that we can plot the histogram of all elements
+    flattened_tensor = (bound_2[mask]).flatten().detach().cpu().numpy()
 
-# Plot the histogram
-plt.hist(flattened_tensor, bins=1000, edgecolor="black")
+    # Plot the histogram
+    plt.hist(flattened_tensor, bins=1000, edgecolor="black")
 
-# Add labels and title
-plt.xlabel("Value")
-plt.ylabel("Frequency")
-plt.title("Histogram of Tensor Elements")
+    # Add labels and title
+    plt.xlabel("Value")
+    plt.ylabel("Frequency")
+    plt.title("Histogram of Tensor Elements")
 
-# Show the plot
-plt.show()
+    # Show the plot
+    plt.show()
 
 # %%
@@ -0,0 +1,186 @@
+import torch
+
+from gbmi.exp_indhead.finetunebound import loss_bound
+from gbmi.exp_indhead.testing import random_model
+from gbmi.utils.testing import TestCase
+
+
+def loop_loss_bound(model):
+    # the per-tuple loops that loss_bound(model, 3, w) used to run, for comparison
+    n_ctx, d_voc = model.cfg.n_ctx, model.cfg.d_vocab
+    e_p = model.W_E[None] + model.W_pos[:, None]
+
+    def term(*mats):
+        out = e_p
+        for mat in mats:
+            out = out @ mat
+        return out
+
+    def qk(layer, left, right):
+        # [q_pos, q_val, k_pos, k_val] scores through the given stacks of matrices
+        q = term(*left, model.W_Q[layer, 0])
+        k = term(*right, model.W_K[layer, 0])
+        return torch.einsum("abh,cdh->abcd", q, k) / model.blocks[layer].attn.attn_scale
+
+    ov_0 = (model.W_V[0, 0], model.W_O[0, 0])
+    ov_1 = (model.W_V[1, 0], model.W_O[1, 0])
+    everything = qk(0, (), ())
+    term_1 = qk(1, (), ())
+    term_2 = qk(1, ov_0, ())
+    term_3 = qk(1, (), ov_0)
+    term_4 = qk(1, ov_0, ov_0)
+    term_5 = term(model.W_U)
+    term_6 = term(*ov_0, model.W_U)
+    term_7 = term(*ov_1, model.W_U)
+    term_8 = term(*ov_0, *ov_1, model.W_U)
+
+    table = torch.full((d_voc, d_voc, n_ctx - 2, d_voc), torch.nan)
+    for p in range(2, n_ctx):
+        tmp = torch.zeros((p, d_voc))
+        for t_q in range(d_voc):
+            tmp[-1, :] = everything[p - 1, t_q, p - 1, t_q]
+            for t_k in range(d_voc):
+                tmp[-2, :] = everything[p - 1, t_q, p - 2, t_k]
+                tmp[:-2, :] = everything[p - 1, t_q, : p - 2, :]
+                table[t_q, t_k, p - 2, :] = tmp.softmax(dim=0)[-2, :]
+    attn_1 = table.min(dim=1).values.min(dim=2).values
+
+    def attn(dic, pos):
+        return attn_1[dic[pos], pos - 1].min()
+
+    def diff_1(a, i_1, i_2, j, dic):
+        return term_1[i_2, a, j, dic[j]].max() - term_1[i_2, a, i_1, dic[i_1]].min()
+
+    def diff_3(a, i_1, i_2, j, dic):
+        if j == 0:
+            t_3 = term_3[i_2, a, j, dic[j]].max()
+        else:
+            c = term_3[i_2, dic[i_2], j, dic[j]].max()
+            for i in range(j - 1):
+                c = torch.max(c, term_3[i_2, dic[i_2], i, dic[i]].max())
+            t_3 = torch.where(c > 0, (1 - attn(dic, j)) * c, 0)
+            c = term_3[i_2, a, j - 1, dic[j - 1]].max()
+            t_3 = torch.where(c > 0, t_3 + c, t_3 + attn(dic, j) * c)
+        if i_1 != 1:
+            c = term_3[i_2, dic[i_2], i_1, dic[i_1]].min()
+            for i in range(i_1 - 1):
+                c = torch.min(c, term_3[i_2, dic[i_2], i, dic[i]].min())
+            t_3 = torch.where(c < 0, t_3 - (1 - attn(dic, i_1)) * c, t_3)
+            c = term_3[i_2, a, i_1 - 1, a]
+            t_3 = torch.where(c < 0, t_3 - c, t_3 - attn(dic, i_1) * c)
+        return t_3
+
+    def diff_2_4(a, i_1, i_2, j, dic):
+        for k in range(i_2 + 1):
+            if j == 0:
+                d = term_4[k, dic[k], j][..., dic[j]].max()
+            else:
+                c = term_4[k, dic[k], j][..., dic[j]].max()
+                for i in range(j - 1):
+                    c = torch.max(c, term_4[k, dic[k], i][..., dic[i]].max())
+                d = torch.where(c > 0, (1 - attn(dic, j)) * c, 0)
+                c = term_4[k, dic[k], j - 1][..., dic[j - 1]].max()
+                d = torch.where(c > 0, d + c, d + attn(dic, j) * c)
+            c = term_4[k, dic[k], i_1][..., dic[i_1]].min()
+            for i in range(i_1 - 1):
+                c = torch.min(c, term_4[k, dic[k], i][..., dic[i]].min())
+            d = torch.where(c < 0, d - (1 - attn(dic, i_1)) * c, d)
+            c = term_4[k, dic[k], i_1 - 1, a].min()
+            d = torch.where(c < 0, d - c, d - attn(dic, i_1) * c)
+            hi = term_2[k, dic[k], j][..., dic[j]]
+            if not isinstance(dic[j], int):
+                hi = hi.max(dim=-1).values
+            d = (
+                d
+                + (hi - term_2[k, dic[k], i_1][..., dic[i_1]].min(dim=-1).values).max()
+            )
+            if k == 0:
+                f = d
+            if k != 0 and k != i_2 - 1:
+                f = torch.max(f, d)
+            if k == i_2 - 1:
+                g = d
+        t_4 = torch.where(f > 0, (1 - attn_1[dic[i_2], i_2 - 1]) * f, 0)
+        return torch.where(g > 0, t_4 + g, t_4 + g * attn_1[dic[i_2], i_2 - 1])
+
+    bound = torch.full((d_voc, n_ctx, n_ctx, n_ctx), -torch.inf)
+    for a in range(d_voc):
+        for i_2 in range(n_ctx - 1):
+            for i_1 in range(1, i_2):
+                dic = {i_2: a, i_1 - 1: a}
+                for i in range(8):
+                    dic.setdefault(i, torch.arange(8)[torch.arange(8) != a])
+                for j in range(i_2 + 1):
+                    if j == i_1:
+                        bound[a, i_2, i_1, j] = 0
+                    else:
+                        bound[a, i_2, i_1, j] = (
+                            diff_1(a, i_1, i_2, j, dic)
+                            + diff_3(a, i_1, i_2, j, dic)
+                            + diff_2_4(a, i_1, i_2, j, dic)
+                        )
+    bound_2 = bound.softmax(dim=-1).diagonal(dim1=2, dim2=3)
+
+    def logit_diff(term, pos, dic, b):
+        n = torch.arange(d_voc)[torch.arange(d_voc) != b]
+        return (term[pos, dic[pos]][..., n] - term[pos, dic[pos]][..., b, None]).max()
+
+    def total_bound(b, i_1, i_2, dic):
+        least = bound_2[dic[i_2], i_2, i_1].min()
+        n = torch.arange(d_voc)[torch.arange(d_voc) != b]
+        ld_1 = (term_5[n_ctx - 1][:, n] - term_5[n_ctx - 1][:, b, None]).max()
+        c = logit_diff(term_6, i_2, dic, b)
+        for i in range(i_2 - 1):
+            c = torch.max(c, logit_diff(term_6, i, dic, b))
+        ld_2 = torch.where(c > 0, (1 - attn(dic, i_2)) * c, 0)
+        c = logit_diff(term_6, i_2 - 1, dic, b)
+        ld_2 = torch.where(c > 0, ld_2 + c, ld_2 + c * attn(dic, i_2))
+        c = max(logit_diff(term_7, i, dic, b) for i in range(i_2 + 1) if i != i_1)
+        ld_3 = torch.where(c > 0, (1 - least) * c, 0)
+        c = logit_diff(term_7, i_1, dic, b)
+        ld_3 = torch.where(c > 0, ld_3 + c, ld_3 + c * least)
+        for k in range(i_2 + 1):
+            if k == 0:
+                d = logit_diff(term_8, 0, dic, b)
+            else:
+                c = logit_diff(term_8, k, dic, b)
+                for i in range(k - 1):
+                    c = torch.max(c, logit_diff(term_8, i, dic, b))
+                d = torch.where(c > 0, (1 - attn(dic, k)) * c, 0)
+                c = logit_diff(term_8, k - 1, dic, b)
+                d = torch.where(c > 0, d + c, d + c * attn(dic, k))
+            if k == 0:
+                f = d
+            if k != 0 and k != i_1:
+                f = torch.max(f, d)
+            if k == i_1:
+                g = d
+        ld_4 = torch.where(f > 0, (1 - least) * f, 0)
+        ld_4 = torch.where(g > 0, ld_4 + g, ld_4 + g * least)
+        return ld_1 + ld_2 + ld_3 + ld_4
+
+    out = torch.full((d_voc, n_ctx, n_ctx), torch.inf)
+    for b in range(d_voc):
+        for i_2 in range(n_ctx - 1):
+            for i_1 in range(1, i_2):
+                dic = {i_1: b}
+                for i in range(8):
+                    dic.setdefault(i, torch.arange(8))
+                out[b, i_2, i_1] = total_bound(b, i_1, i_2, dic)
+
+    return attn_1, bound, bound_2, out
+
+
+class TestLossBound(TestCase):
+    @torch.no_grad()
+    def test_matches_loop(self):
+        # unpinned positions range over the first 8 tokens, and loss_diff_1 reads position 7
+        model = random_model(8, 10, seed=0)
+        attn_1, bound, bound_2, out, out_2 = loss_bound(model, 3, 8)
+        expected = loop_loss_bound(model)
+        self.assertAllClose(attn_1, expected[0])
+        self.assertAllClose(bound, expected[1])
+        valid = ~expected[2].isnan()
+        self.assertAllClose(bound_2[valid], expected[2][valid])
+        self.assertAllClose(out, expected[3])
+        self.assertAllClose(out_2, 1 / (1 + 9 * torch.exp(expected[3])))
@@ -13,7 +13,7 @@ from tqdm import tqdm
 import plotly.express as px
 from gbmi.utils.sequences import generate_all_sequences
 import pandas as pd
-from gbmi.utils import ein
+from gbmi.utils import ein, masked_max, masked_min
 from functools import partial
 from inspect import signature
 from typing import Callable, Optional, List
@@ -22,402 +22,295 @@ import numpy as np
 import plotly.express as px
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
-torch.set_default_device("cuda")
-runtime_model_1, model = train_or_load_model(ABCAB8_1H, force="load")
-model.to(device)
-
-
-attn_scale_0 = model.blocks[0].attn.attn_scale
-attn_scale_1 = model.blocks[1].attn.attn_scale
-W_pos = model.W_pos
-W_E = model.W_E
-W_K_1 = model.W_K[1, 0]
-W_U = model.W_U
-W_V_1 = model.W_V[1, 0]
-W_K_0 = model.W_K[0, 0]
-W_V_0 = model.W_V[0, 0]
-W_O_0 = model.W_O[0, 0]
-W_Q_1 = model.W_Q[1, 0]
-W_Q_0 = model.W_Q[0, 0]
-W_O_1 = model.W_O[1, 0]
-W_Q_0 = model.W_Q[0, 0]
-n_ctx = W_pos.shape[0]
-d_voc = W_E.shape[0]
-d_model = W_E.shape[1]
 
 
-# %%
-e_p = W_E.unsqueeze(dim=0) + W_pos.unsqueeze(dim=1)
-
-everything = (
-    einops.einsum(
-        e_p,
-        W_Q_0,
-        W_K_0,
-        e_p,
-        "q_pos q_val k, k l, m l, k_pos k_val m -> q_pos q_val k_pos k_val",
-    )
-    / attn_scale_0
-)
-table = torch.zeros((d_voc, d_voc, n_ctx - 2, d_voc)) + float(
-    "nan"
-)  # p Represents the position of 'b' at index + 1
-for p in range(2, n_ctx):  #
-    tmp = torch.zeros((p, d_voc))
-    for t_q in range(d_voc):
-        tmp[-1, :] = everything[p - 1, t_q, p - 1, t_q]
-
-        for t_k in range(d_voc):
-            tmp[-2, :] = everything[p - 1, t_q, p - 2, t_k]
-            tmp[:-2, :] = everything[p - 1, t_q, : p - 2, :]
-            tmp_sm = tmp.softmax(dim=0)
-            table[t_q, t_k, p - 2, :] = tmp_sm[
-                -2, :
-            ]  # Table represents post softmax attention paid to t_k, if the final entry is spammed everywhere, and t_q is used as the first entry, at pth poisition
-
-# everything looks like EQKE, table looks like you're indexing by query, key, position (of key?), and other token in the sequence.
-# They you're computing softmax of d_voc - 2 copies of the other token, one copy of t_k in p-2, and the query in p-1.
-# Then you store the post-softmax attention paid to t_k.
-#
-#
-#
-##       xEQKE^tx^t
-#
-##
-#                               t_q vocab paying attention to t_k another letter, if other one gets spammed
-#
-##
-#
-#
-#
-##
-#
-#
-#
-#
-#
-#
-#
-#
-attn_1 = table.min(dim=1).values.min(dim=2).values
-
-
-# %%
-
-# attn_1=torch.ones(attn_1.shape)
-term_1 = (
-    einops.einsum(
-        e_p,
-        W_Q_1,
-        W_K_1,
-        e_p,
-        "q_pos q_val k, k l, m l, k_pos k_val m -> q_pos q_val k_pos k_val",
-    )
-    / attn_scale_1
-)
-term_2 = (
-    einops.einsum(
-        e_p,
-        W_V_0,
-        W_O_0,
-        W_Q_1,
-        W_K_1,
-        e_p,
-        "q_pos q_val k, k l, l m, m n, o n, k_pos k_val o -> q_pos q_val k_pos k_val",
-    )
-    / attn_scale_1
-)
-
-term_3 = (
-    einops.einsum(
-        e_p,
-        W_Q_1,
-        W_K_1,
-        W_O_0,
-        W_V_0,
-        e_p,
-        "q_pos q_val k, k l, m l, n m, o n, k_pos k_val o -> q_pos q_val k_pos k_val",
-    )
-    / attn_scale_1
-)
-
-term_4 = (
-    einops.einsum(
-        e_p,
-        W_V_0,
-        W_O_0,
-        W_Q_1,
-        W_K_1,
-        W_O_0,
-        W_V_0,
-        e_p,
-        "q_pos q_val k, k l, l m, m n, o n, p o, q p, k_pos k_val q -> q_pos q_val k_pos k_val",
-    )
-    / attn_scale_1
-)
-
-
-def diff_1(a, b, i_1, i_2, j, dic):
-
-    if j == i_1:
-        return 0
-    else:
-        return term_1[i_2, a, j, dic[j]] - term_1[i_2, a, i_1, b]
-
-
-def diff_3(a, b, i_1, i_2, j, dic):
-    if j == i_1:
-        return 0
-    if j != 0 and j != 1:
-        c = term_3[i_2, dic[i_2], 0, dic[0]].max()
-        for i in range(1, j - 1):
-            c = torch.max(c, term_3[i_2, dic[i_2], i, dic[i]].max())
-        c = torch.max(c, term_3[i_2, dic[i_2], j, dic[j]])
-
-        if c > 0:
-            t_3 = (1 - attn_1[dic[j], j - 1]) * c
-        else:
-            t_3 = 0
-
-        """
-        if a != 0 and a != d_voc - 1:
-            c = torch.max(
-                term_3[i_2, a, j - 1, :a].max(), term_3[i_2, a, j - 1, a + 1 :].max()
+def take(x, index):
+    # x[i, index[i]] for each row i of the batch
+    return x.gather(1, index[:, None]).squeeze(1)
+
+
+class InductionBound:
+    """
+    Bounds on the attention paid by the induction head to the induction position, for batches of candidate sequences.
+
+    The einsum terms and the layer-0 attention table are computed once, from the model passed in.  Every method takes
+    a batch of candidates: a, b, i_1, i_2 and j are integer tensors of shape [batch], and dic is a boolean tensor of
+    shape [batch, n_ctx, d_voc], with dic[k, pos, t] saying whether position pos of candidate k may hold token t.  a is
+    the query token (at position i_2), b is the token to be copied (at position i_1), and j is the key position whose
+    attention is compared with that paid to i_1.
+    """
+
+    def __init__(self, model):
+        W_pos = model.W_pos
+        W_E = model.W_E
+        W_K_1 = model.W_K[1, 0]
+        W_K_0 = model.W_K[0, 0]
+        W_V_0 = model.W_V[0, 0]
+        W_O_0 = model.W_O[0, 0]
+        W_Q_1 = model.W_Q[1, 0]
+        W_Q_0 = model.W_Q[0, 0]
+        attn_scale_0 = model.blocks[0].attn.attn_scale
+        attn_scale_1 = model.blocks[1].attn.attn_scale
+        self.n_ctx = n_ctx = W_pos.shape[0]
+        self.d_voc = d_voc = W_E.shape[0]
+        self.positions = positions = torch.arange(n_ctx, device=W_E.device)
+
+        e_p = W_E.unsqueeze(dim=0) + W_pos.unsqueeze(dim=1)
+
+        everything = (
+            einops.einsum(
+                e_p,
+                W_Q_0,
+                W_K_0,
+                e_p,
+                "q_pos q_val k, k l, m l, k_pos k_val m -> q_pos q_val k_pos k_val",
             )
-        if a == 0:
-            c = term_3[i_2, a, j - 1, a + 1 :].max()
+            / attn_scale_0
+        )
+        # p Represents the position of 'b' at index + 1
+        # For each p, the scores [p - 2, t_q, t_k, r, last] of query position p - 1 (holding t_q) against key
+        # positions r, with t_k at p - 2 and every earlier position holding last; positions r >= p are padding
+        p = positions[2:]
+        r = positions[None, :]
+        scores = torch.where(
+            (r < p[:, None] - 2)[:, None, None, :, None],
+            everything[p - 1, :, None],
+            -torch.inf,
+        )
+        scores = torch.where(
+            (r == p[:, None] - 2)[:, None, None, :, None],
+            everything[p - 1, :, p - 2, :][..., None, None],
+            scores,
+        )
+        scores = torch.where(
+            (r == p[:, None] - 1)[:, None, None, :, None],
+            everything[p - 1, :, p - 1, :].diagonal(dim1=1, dim2=2)[
+                ..., None, None, None
+            ],
+            scores,
+        )
+        # Table represents post softmax attention paid to t_k, if the final entry is spammed everywhere, and t_q is
+        # used as the first entry, at pth poisition
+        self.table = scores.softmax(dim=3)[p - 2, :, :, p - 2].permute(1, 2, 0, 3)
+        self.attn_1 = self.table.min(dim=1).values.min(dim=2).values
+        # attn_pos[t, pos] = attn_1[t, pos - 1], padded with 1 at positions 0 and n_ctx - 1
+        pad = torch.ones((d_voc, 1), device=W_E.device)
+        self.attn_pos = torch.cat([pad, self.attn_1, pad], dim=1)
+
+        self.term_1 = (
+            einops.einsum(
+                e_p,
+                W_Q_1,
+                W_K_1,
+                e_p,
+                "q_pos q_val k, k l, m l, k_pos k_val m -> q_pos q_val k_pos k_val",
+            )
+            / attn_scale_1
+        )
+        self.term_2 = (
+            einops.einsum(
+                e_p,
+                W_V_0,
+                W_O_0,
+                W_Q_1,
+                W_K_1,
+                e_p,
+                "q_pos q_val k, k l, l m, m n, o n, k_pos k_val o -> q_pos q_val k_pos k_val",
+            )
+            / attn_scale_1
+        )
+        self.term_3 = (
+            einops.einsum(
+                e_p,
+                W_Q_1,
+                W_K_1,
+                W_O_0,
+                W_V_0,
+                e_p,
+                "q_pos q_val k, k l, m l, n m, o n, k_pos k_val o -> q_pos q_val k_pos k_val",
+            )
+            / attn_scale_1
+        )
+        self.term_4 = (
+            einops.einsum(
+                e_p,
+                W_V_0,
+                W_O_0,
+                W_Q_1,
+                W_K_1,
+                W_O_0,
+                W_V_0,
+                e_p,
+                "q_pos q_val k, k l, l m, m n, o n, p o, q p, k_pos k_val q -> q_pos q_val k_pos k_val",
+            )
+            / attn_scale_1
+        )
 
-        if a == d_voc - 1:
-            c = term_3[i_2, a, j - 1, :a].max()
+    def dic(self, a, pins):
         """
-        c = term_3[i_2, a, j - 1, dic[j - 1]]
-        if c > 0:
-            t_3 += c
-        else:
-            t_3 += attn_1[dic[j], j - 1] * c
-        # print(t_3)
-    if j == 1:
-        c = term_3[i_2, a, j, dic[j]]
-        if c > 0:
-            t_3 = (1 - attn_1[dic[j], j - 1]) * c
-        else:
-            t_3 = 0
+        Returns the dic in which every position holds one of the first 8 tokens other than a, except that for each
+        (pos, token) in pins (pairs of [batch] tensors, later pairs overriding earlier ones), pos holds token.
+        Positions outside [0, n_ctx) are ignored.
         """
-        if a != 0 and a != d_voc - 1:
-
-            c = torch.max(
-                term_3[i_2, a, j - 1, :a].max(), term_3[i_2, a, j - 1, a + 1 :].max()
-            )
-
-        if a == 0:
-            c = term_3[i_2, a, j - 1, a + 1 :].max()
+        tokens = torch.arange(self.d_voc, device=a.device)
+        batch = torch.arange(a.shape[0], device=a.device)
+        dic = ((tokens < 8) & (tokens != a[:, None]))[:, None, :].repeat(
+            1, self.n_ctx, 1
+        )
+        for pos, token in pins:
+            pos, token = torch.broadcast_tensors(pos, token)
+            keep = (pos >= 0) & (pos < self.n_ctx)
+            dic[batch[keep], pos[keep]] = tokens == token[keep, None]
+        return dic
+
+    def attention(self, dic, pos):
+        """The least attention paid to position pos - 1 by any token dic allows at pos"""
+        batch = torch.arange(pos.shape[0], device=pos.device)
+        return masked_min(self.attn_pos[:, pos].T, dic[batch, pos], -1)
+
+    def before(self, j):
+        """The positions before j - 1, and j itself"""
+        return (self.positions <= j[:, None] - 2) | (self.positions == j[:, None])
+
+    def diff_1(self, a, b, i_1, i_2, j, dic):
+        batch = torch.arange(a.shape[0], device=a.device)
+        c = masked_max(self.term_1[i_2, a, j], dic[batch, j], -1)
+        return torch.where(j == i_1, 0, c - self.term_1[i_2, a, i_1, b])
+
+    def diff_3(self, a, b, i_1, i_2, j, dic):
+        term_3 = self.term_3[i_2, a]
+        hi = masked_max(term_3, dic, -1)
+        lo = masked_min(term_3, dic, -1)
+        attn_j = self.attention(dic, j)
+        attn_i_1 = self.attention(dic, i_1)
+
+        c = masked_max(hi, self.before(j), -1)
+        t_3 = torch.where(c > 0, (1 - attn_j) * c, 0)
+        c_prev = take(hi, (j - 1).clamp(min=0))
+        t_3 = torch.where(c_prev > 0, t_3 + c_prev, t_3 + attn_j * c_prev)
+        t_3 = torch.where(j == 0, c, t_3)
+
+        c = masked_min(lo, self.before(i_1), -1)
+        t_3 = torch.where(c < 0, t_3 - (1 - attn_i_1) * c, t_3)
+        # At j == 0, i_1 == 1 this is the same entry t_3 started from.  The per-tuple version held t_3 as a view of
+        # it, so its in-place updates also changed c (and term_3); here c is the unmodified entry, as written.
+        c = self.term_3[i_2, a, i_1 - 1, a]
+        t_3 = torch.where(c < 0, t_3 - c, t_3 - attn_i_1 * c)
+        return torch.where(j == i_1, 0, t_3)
+
+    def diff_2_4(self, a, b, i_1, i_2, j, dic):
+        # everything below is indexed by [batch, k], where k is the position of the query
+        batch = torch.arange(a.shape[0], device=a.device)
+        diff = masked_max(
+            self.term_2[:, :, j].permute(2, 0, 1, 3), dic[batch, j][:, None, None], -1
+        ) - self.term_2[:, :, i_1, b].permute(2, 0, 1)
+        term_4 = self.term_4[None]
+        hi = masked_max(masked_max(term_4, dic[:, None, None], -1), dic[..., None], -2)
+        lo = masked_min(masked_min(term_4, dic[:, None, None], -1), dic[..., None], -2)
+        attn_j = self.attention(dic, j)[:, None]
+        attn_i_1 = self.attention(dic, i_1)[:, None]
+
+        c = masked_max(hi, self.before(j)[:, None], -1)
+        d = torch.where(c > 0, (1 - attn_j) * c, 0)
+        c_prev = hi[batch, :, (j - 1).clamp(min=0)]
+        d = torch.where(c_prev > 0, d + c_prev, d + attn_j * c_prev)
+        d = torch.where(j[:, None] == 0, c, d)
+
+        c = masked_min(lo, self.before(i_1)[:, None], -1)
+        d = torch.where(c < 0, d - (1 - attn_i_1) * c, d)
+        c = masked_min(self.term_4[:, :, i_1 - 1, a].permute(2, 0, 1), dic, -1)
+        d = torch.where(c < 0, d - c, d - attn_i_1 * c)
+
+        d = d + masked_max(diff, dic, -1)
+
+        # the worst case over k <= i_2 other than i_2 - 1, and the case k = i_2 - 1
+        c = masked_max(
+            d,
+            (self.positions <= i_2[:, None]) & (self.positions != i_2[:, None] - 1),
+            -1,
+        )
+        attn_i_2 = self.attention(dic, i_2)
+        t_4 = torch.where(c > 0, (1 - attn_i_2) * c, 0)
+        c = take(d, i_2 - 1)
+        t_4 = torch.where(c > 0, t_4 + c, t_4 + c * attn_i_2)
+        return torch.where(j == i_1, 0, t_4)
 
-        if a == d_voc - 1:
-            c = term_3[i_2, a, j - 1, :a].max()
+    def least_attention(self, a, b, i_1, i_2, j, dic, batch_size=None):
         """
-        c = term_3[i_2, a, j - 1, dic[j - 1]]
-        if c > 0:
-            t_3 += c
-        else:
-            t_3 += attn_1[dic[j], j - 1] * c
-        # print(t_3)
-    if j == 0:
-
-        t_3 = term_3[i_2, a, j, dic[j]]
-        # print(t_3)
-    if i_1 != 1:
-        c = term_3[i_2, dic[i_2], 0, dic[0]].min()
-        for i in range(1, i_1 - 1):
-            c = torch.min(c, term_3[i_2, dic[i_2], i, dic[i]].min())
-        c = torch.min(c, term_3[i_2, dic[i_2], i_1, dic[i_1]])
-
-        # c = torch.min(term_3[i_2, a, : i_1 - 1, a].min(), term_3[i_2, a, i_1, b].min())
-        if c < 0:
-            t_3 -= (1 - attn_1[dic[i_1], i_1 - 1]) * c
-
-        c = term_3[i_2, a, i_1 - 1, a]
-        if c < 0:
-            t_3 -= c
-        else:
-            t_3 -= attn_1[dic[i_1], i_1 - 1] * c
-        # print(t_3)
-    if i_1 == 1:
-        c = term_3[i_2, a, i_1, b]
-        if c < 0:
-            t_3 -= (1 - attn_1[dic[i_1], i_1 - 1]) * c
-
-        c = term_3[i_2, a, i_1 - 1, a]
-        if c < 0:
-            t_3 -= c
-        else:
-            t_3 -= attn_1[dic[i_1], i_1 - 1] * c
-        # print(t_3)
-    return t_3
-
-
-def diff_2_4(a, b, i_1, i_2, j, dic):
-    if j == i_1:
-        return 0
-    diff = term_2[:, :, j, dic[j]] - term_2[:, :, i_1, b]
-    f = []
-    for k in range(i_2 + 1):
-        if j != 0 and j != 1:
-
-            c = term_4[k, dic[k], 0][..., dic[0]].max()
-            for i in range(1, j - 1):
-
-                c = torch.max(c, term_4[k, dic[k], i][..., dic[i]].max())
-            c = torch.max(c, term_4[k, dic[k], j, dic[j]].max())
-
-            if c > 0:
-                d = (1 - attn_1[dic[j], j - 1]) * c
-            else:
-                d = 0
-
-            c = term_4[k, dic[k], j - 1, dic[j - 1]].max()
-
-            if c > 0:
-                d += c
-            else:
-                d += attn_1[dic[j], j - 1] * c
-        if j == 0:
-
-            d = term_4[k, dic[k], j, dic[j]].max()
-
-        if j == 1:
-            c = term_4[k, dic[k], j, dic[j]].max()
-            if c > 0:
-                d = (1 - attn_1[dic[j], j - 1]) * c
-            else:
-                d = 0
-
-            c = term_4[k, dic[k], j - 1, dic[j - 1]].max()
-
-            if c > 0:
-                d += c
-            else:
-                d += attn_1[dic[j], j - 1] * c
-        # print(d)
-        if i_1 != 1:
-
-            c = term_4[k, dic[k], 0][..., dic[0]].min()
-
-            for i in range(1, i_1 - 1):
-
-                c = torch.min(c, term_4[k, dic[k], i][..., dic[i]].min())
-            c = torch.min(c, term_4[k, dic[k], i_1, dic[i_1]].min())
-
-            if c < 0:
-                d -= (1 - attn_1[dic[i_1], i_1 - 1]) * c
-
-            c = term_4[k, dic[k], i_1 - 1, a].min()
-
-            if c < 0:
-                d -= c
-            else:
-                d -= attn_1[dic[i_1], i_1 - 1] * c
-        if i_1 == 1:
-            c = term_4[k, dic[k], i_1, b].min()
-            if c < 0:
-                d -= (1 - attn_1[dic[i_1], i_1 - 1]) * c
-
-            c = term_4[k, dic[k], i_1 - 1, a].min()
-
-            if c < 0:
-                d -= c
-            else:
-                d -= attn_1[dic[i_1], i_1 - 1] * c
-        # print(d)
-
-        d += diff[k, dic[k]].max()
-
-        f.append(d)
-    f = torch.tensor(f)
-    # print(f)
-    c = torch.max(f[: i_2 - 1].max(), f[i_2])
-    if c > 0:
-        t_4 = (1 - attn_1[dic[i_2], i_2 - 1]) * c
-    else:
-        t_4 = 0
-    c = f[i_2 - 1]
-    if c > 0:
-        t_4 += c
-    else:
-        t_4 += c * attn_1[dic[i_2], i_2 - 1]
-    return t_4
+        Returns an upper bound on how much more pre-softmax attention position j gets than position i_1.
 
+        If batch_size is given, candidates are evaluated batch_size at a time, to bound the memory used by diff_2_4,
+        which is O(batch * n_ctx^2 * d_voc^2).
+        """
+        if batch_size is not None and a.shape[0] > batch_size:
+            return torch.cat(
+                [
+                    self.least_attention(*args)
+                    for args in zip(
+                        *(x.split(batch_size) for x in (a, b, i_1, i_2, j, dic))
+                    )
+                ]
+            )
+        e = self.diff_2_4(a, b, i_1, i_2, j, dic)
+        return (
+            self.diff_1(a, b, i_1, i_2, j, dic)
+            + self.diff_3(a, b, i_1, i_2, j, dic)
+            + e
+        )
 
-def least_attention(a, b, i_1, i_2, j, dic):
-    e = diff_2_4(a, b, i_1, i_2, j, dic)
-    return diff_1(a, b, i_1, i_2, j, dic) + diff_3(a, b, i_1, i_2, j, dic) + e
 
+# %%
+if __name__ == "__main__":
+    torch.set_default_device("cuda")
+    runtime_model_1, model = train_or_load_model(ABCAB8_1H, force="load")
+    model.to(device)
+    induction_bound = InductionBound(model)
+    n_ctx, d_voc = induction_bound.n_ctx, induction_bound.d_voc
 
 # %%
-bound = (
-    torch.zeros(
-        (
-            e_p.shape[1],
-            e_p.shape[1],
-            e_p.shape[1],
-            e_p.shape[0],
-            e_p.shape[0],
-            e_p.shape[0],
-        )
+if __name__ == "__main__":
+    a, b, i_2, i_1 = 5, 8, 6, 5
+    x_j, p, n, j = torch.meshgrid(
+        *(torch.arange(size) for size in (d_voc, d_voc, d_voc, i_2 + 1)),
+        indexing="ij",
+    )
+    x_j, p, n, j = (x.flatten() for x in (x_j, p, n, j))
+    keep = (
+        (n != a)
+        & ((i_2 - 1 != i_1) | (n == b))
+        & ((j != i_2) | (p == n))
+        & ((j != i_2 + 1) | (p == a))
+        & ((j != i_1 + 1) | (p == b))
+        & ((j != i_1) | (p == a))
+        & ((p != a) | (j == i_1) | (j == i_2 + 1))
+        & (i_1 < i_2)
+        & (i_1 > 0)
+        & (i_2 + 1 > j)
+        & (a != b)
+        & ((j != i_2) | (x_j == a))
+        & ((j != i_1) | (x_j == b))
+        & ((j != i_1 - 1) | (x_j == a))
+        & ((j != i_2 - 1) | (x_j == n))
+        & ((x_j != a) | (j == i_1 - 1) | (j == i_2))
+    )
+    x_j, p, n, j = x_j[keep], p[keep], n[keep], j[keep]
+    a_, b_, i_1_, i_2_ = (torch.full_like(j, value) for value in (a, b, i_1, i_2))
+    dic = induction_bound.dic(
+        a_,
+        [(i_2_, a_), (i_1_, b_), (i_1_ - 1, a_), (j, x_j), (j - 1, p), (i_2_ - 1, n)],
+    )
+    bound = torch.zeros((d_voc, d_voc, d_voc, n_ctx, n_ctx, n_ctx)) - torch.inf
+    bound[x_j, p, n, i_2, i_1, j] = induction_bound.least_attention(
+        a_, b_, i_1_, i_2_, j, dic, batch_size=1024
     )
-    - torch.inf
-)
-
 
-for a in [5]:
-    for b in [8]:
-        for x_j in tqdm(range(e_p.shape[1])):
-            for p in tqdm(range(e_p.shape[1])):
-                for n in range(e_p.shape[1]):
-                    for i_2 in [6]:
-                        for i_1 in [5]:
-                            for j in range(i_2 + 1):
-                                if (
-                                    (n != a)
-                                    & ((i_2 - 1 != i_1) or n == b)
-                                    & ((j != i_2) or p == n)
-                                    & ((j != i_2 + 1) or p == a)
-                                    & ((j != i_1 + 1) or p == b)
-                                    & ((j != i_1) or p == a)
-                                    & (p != a or (j in [i_1, i_2 + 1]))
-                                    & (i_1 < i_2)
-                                    & (i_1 > 0)
-                                    & (i_2 + 1 > j)
-                                    & (a != b)
-                                    & ((j != i_2) or x_j == a)
-                                    & ((j != i_1) or x_j == b)
-                                    & ((j != i_1 - 1) or x_j == a)
-                                    & ((j != i_2 - 1) or x_j == n)
-                                    & (x_j != a or (j in [i_1 - 1, i_2]))
-                                ):
-                                    dic = {
-                                        i_2: a,
-                                        i_1: b,
-                                        i_1 - 1: a,
-                                        j: x_j,
-                                        j - 1: p,
-                                        i_2 - 1: n,
-                                    }
-                                    for i in range(8):
-                                        dic.setdefault(
-                                            i, torch.arange(8)[torch.arange(8) != a]
-                                        )
-
-                                    bound[x_j, p, n, i_2, i_1, j] = least_attention(
-                                        a, b, i_1, i_2, j, dic
-                                    )
-
-
-bound_soft = bound.max(dim=0).values.max(dim=0).values.max(dim=0).values.softmax(dim=-1)
-bound_2 = einops.einsum(
-    bound_soft,
-    "i_2 i_1 i_1 -> i_2 i_1",
-)
-# %%
+    bound_soft = (
+        bound.max(dim=0).values.max(dim=0).values.max(dim=0).values.softmax(dim=-1)
+    )
+    bound_2 = einops.einsum(
+        bound_soft,
+        "i_2 i_1 i_1 -> i_2 i_1",
+    )
 
 
 # %%
@@ -1018,24 +911,25 @@ def diff_4_2(a, b, i_1, i_2, j):
 """
 
 # %%
-import torch
-import matplotlib.pyplot as plt
+if __name__ == "__main__":
+    import torch
+    import matplotlib.pyplot as plt
 
-# Example tensor with more than 2 dimensions
-# Create a 3x4x5 tensor with random elements from a normal distribution
+    # Example tensor with more than 2 dimensions
+    # Create a 3x4x5 tensor with random elements from a normal distribution
 
-# Flatten the tensor to 1D so that we can plot the histogram of all elements
-flattened_tensor = (bound_2[mask]).flatten().detach().cpu().numpy()
+    # Flatten the tensor to 1D so that we can plot the histogram of all elements
+    flattened_tensor = (bound_2[mask]).flatten().detach().cpu().numpy()
 
-# Plot the histogram
-plt.hist(flattened_tensor, bins=1000, edgecolor="black")
+    # Plot the histogram
+    plt.hist(flattened_tensor, bins=1000, edgecolor="black")
 
-# Add labels and title
-plt.xlabel("Value")
-plt.ylabel("Frequency")
-plt.title("Histogram of Tensor Elements")
+    # Add labels and title
+    plt.xlabel("Value")
+    plt.ylabel("Frequency")
+    plt.title("Histogram of Tensor Elements")
 
-# Show the plot
-plt.show()
+    # Show the plot
+    plt.show()
 
 # %%
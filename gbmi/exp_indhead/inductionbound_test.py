@@ -0,0 +1,78 @@
+import itertools
+
+import torch
+
+from gbmi.exp_indhead.inductionbound import InductionBound
+from gbmi.exp_indhead.testing import random_model
+from gbmi.utils.testing import TestCase
+
+
+class TestInductionBound(TestCase):
+    def test_table_matches_loop(self):
+        model = random_model(6, 5, seed=0)
+        bound = InductionBound(model)
+        e_p = model.W_E[None] + model.W_pos[:, None]
+        everything = (
+            e_p @ model.W_Q[0, 0] @ model.W_K[0, 0].T @ e_p.flatten(0, 1).T
+        ).unflatten(-1, e_p.shape[:2]) / model.blocks[0].attn.attn_scale
+        for p, t_q, t_k, last in itertools.product(
+            range(2, 6), range(5), range(5), range(5)
+        ):
+            scores = torch.cat(
+                [
+                    everything[p - 1, t_q, : p - 2, last],
+                    everything[p - 1, t_q, p - 2, t_k, None],
+                    everything[p - 1, t_q, p - 1, t_q, None],
+                ]
+            )
+            self.assertAllClose(
+                bound.table[t_q, t_k, p - 2, last], scores.softmax(dim=0)[-2]
+            )
+
+    @torch.no_grad()
+    def test_least_attention_batches(self):
+        bound = InductionBound(random_model(8, 10, seed=1))
+        a, b, i_1, i_2 = 5, 8, 3, 6
+        x_j, p, j = (
+            x.flatten()
+            for x in torch.meshgrid(
+                torch.arange(8), torch.arange(8), torch.arange(i_2 + 1), indexing="ij"
+            )
+        )
+        full = lambda value: torch.full_like(j, value)
+        a, b, i_1, i_2 = full(a), full(b), full(i_1), full(i_2)
+        dic = bound.dic(a, [(i_2, a), (i_1, b), (i_1 - 1, a), (j, x_j), (j - 1, p)])
+        self.assertTrue((dic[(j != 3) & (j != 4), 3] == (torch.arange(10) == 8)).all())
+        self.assertEqual(dic[j == 4, 0].sum(dim=-1).tolist(), [7] * 64)
+
+        expected = bound.least_attention(a, b, i_1, i_2, j, dic)
+        self.assertTrue(
+            bound.least_attention(a, b, i_1, i_2, j, dic, batch_size=50).equal(expected)
+        )
+        self.assertTrue((expected[j == i_1] == 0).all())
+        self.assertAllClose(
+            bound.diff_1(a, b, i_1, i_2, j, dic),
+            torch.where(
+                j == i_1,
+                0,
+                bound.term_1[i_2, a, j, x_j] - bound.term_1[i_2, a, i_1, b],
+            ),
+        )
+
+    @torch.no_grad()
+    def test_diff_3_at_first_positions(self):
+        # j == 0, i_1 == 1, where the per-tuple version updated term_3 in place through a view
+        bound = InductionBound(random_model(8, 10, seed=2))
+        a, b, i_2 = 5, 8, 6
+        full = lambda value: torch.tensor([value])
+        a_, b_, i_1_, i_2_, j_ = full(a), full(b), full(1), full(i_2), full(0)
+        dic = bound.dic(a_, [(i_2_, a_), (i_1_, b_), (i_1_ - 1, a_)])
+        attn = bound.attn_1[b, 0]
+        first = bound.term_3[i_2, a, 0, a].clone()
+        expected = first
+        c = bound.term_3[i_2, a, 1, b]
+        if c < 0:
+            expected = expected - (1 - attn) * c
+        expected = expected - (first if first < 0 else attn * first)
+        self.assertAllClose(bound.diff_3(a_, b_, i_1_, i_2_, j_, dic), expected[None])
+        self.assertAllClose(bound.term_3[i_2, a, 0, a], first)
@@ -0,0 +1,16 @@
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+
+def random_model(n_ctx: int, d_vocab: int, seed: int) -> HookedTransformer:
+    """A randomly initialized two-layer, one-head, attention-only model, the shape the induction bounds expect"""
+    cfg = HookedTransformerConfig(
+        n_layers=2,
+        n_heads=1,
+        d_model=16,
+        d_head=16,
+        n_ctx=n_ctx,
+        d_vocab=d_vocab,
+        attn_only=True,
+        seed=seed,
+    )
+    return HookedTransformer(cfg)
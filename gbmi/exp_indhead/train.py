@@ -65,6 +65,8 @@ class IndHead(ExperimentConfig):
     n_train_samples: int = 4096
     n_test_samples: int = 1
     n_validate_samples: int = 1024
+    # sample English datasets in batches of this size; None reproduces the old datasets
+    sample_batch_size: Optional[int] = None
 
     optimizer_kwargs: Dict[str, Any] = field(
         default_factory=lambda: {"lr": 1e-3, "betas": (0.9, 0.999), "weight_decay": 1.0}
@@ -177,6 +179,8 @@ class IndHeadMLP(ExperimentConfig):
     n_train_samples: int = 4096
     n_test_samples: int = 1
     n_validate_samples: int = 1024
+    # sample English datasets in batches of this size; None reproduces the old datasets
+    sample_batch_size: Optional[int] = None
 
     optimizer_kwargs: Dict[str, Any] = field(
         default_factory=lambda: {"lr": 1e-3, "betas": (0.9, 0.999), "weight_decay": 1.0}
@@ -739,6 +743,7 @@ class IndHeadDataModule(DataModule):
     seq_length: int
     bos: Optional[int]
     dataset_seed: int
+    sample_batch_size: Optional[int]
     num_tokens: int
 
     def __init__(self, config: Config[IndHead]):
@@ -759,6 +764,7 @@ class IndHeadDataModule(DataModule):
         self.other_tokens_distinct_from_predicted_token = (
             config.experiment.other_tokens_distinct_from_predicted_token
         )
+        self.sample_batch_size = config.experiment.sample_batch_size
         self.dataset_seed = reseed(config.seed, "dataset_seed")
 
     def build_dataset(
@@ -798,6 +804,7 @@ class IndHeadDataModule(DataModule):
                     corpus=self.corpus,
                     ngram=self.ngram,
                     alpha_mix_uniform=self.alpha_mix_uniform,
+                    batch_size=self.sample_batch_size,
                 )
             case "abcab":
                 generator = (
@@ -808,6 +815,7 @@ class IndHeadDataModule(DataModule):
                         corpus=self.corpus,
                         ngram=self.ngram,
                         alpha_mix_uniform=self.alpha_mix_uniform,
+                        batch_size=self.sample_batch_size,
                     )
                 )
                 generator = partial(
@@ -825,6 +833,7 @@ class IndHeadDataModule(DataModule):
                         corpus=self.corpus,
                         alpha_mix_uniform=self.alpha_mix_uniform,
                         when_ngram_same_adjust_middle_tokens_to_match=False,
+                        batch_size=self.sample_batch_size,
                     )
                 )
 
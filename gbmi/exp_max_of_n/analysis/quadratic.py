@@ -1,8 +1,8 @@
 import time
-from typing import Optional, Tuple, Union
+from typing import Optional, Sequence, Tuple, Union
 
 import torch
-from jaxtyping import Float, Integer
+from jaxtyping import Bool, Float, Integer
 from torch import Tensor
 from tqdm.auto import tqdm
 from transformer_lens import HookedTransformer
@@ -13,6 +13,7 @@ from gbmi.exp_max_of_n.analysis import (
     find_size_and_query_direction,
 )
 from gbmi.exp_max_of_n.verification import LargestWrongLogitQuadraticConfig
+from gbmi.exp_max_of_n.verification.brute_force import DEFAULT_MAX_MEMORY_BYTES
 from gbmi.exp_max_of_n.verification.quadratic import (
     compute_extreme_right_attention_quadratic,
     compute_extreme_softmaxed_right_attention_quadratic,
@@ -22,6 +23,165 @@ from gbmi.exp_max_of_n.verification.quadratic import (
 from gbmi.utils import compress_int_tensor
 
 
+@torch.no_grad()
+def compute_largest_wrong_logit_quadratic_for_gaps(
+    gaps: Union[Sequence[int], Integer[Tensor, "n_gaps"]],  # noqa: F821
+    *,
+    EQKE: Float[Tensor, "d_vocab_q d_vocab_k"],  # noqa: F722
+    EQKE_err_upper_bound: Union[
+        Float[Tensor, "1"], Float[Tensor, "d_vocab_q"]  # noqa: F722, F821
+    ],
+    EQKE_pos_err: Float[Tensor, "d_vocab_q n_ctx"],  # noqa: F722
+    attn_scale: Union[Float[Tensor, ""], float],  # noqa: F722
+    W_EP: Float[Tensor, "d_vocab_q d_model"],  # noqa: F722
+    W_U: Float[Tensor, "d_model d_vocab_out"],  # noqa: F722
+    EVOU: Float[Tensor, "d_vocab_k d_vocab_out"],  # noqa: F722
+    PVOU: Float[Tensor, "n_ctx d_vocab_out"],  # noqa: F722
+    W_EP_direction: Optional[Float[Tensor, "d_model"]] = None,  # noqa F722
+    tricks: LargestWrongLogitQuadraticConfig = LargestWrongLogitQuadraticConfig(),
+) -> Float[Tensor, "n_gaps d_vocab_q d_vocab_max n_ctx_nonmax_copies"]:  # noqa: F722
+    """
+    Computes, for every min_gap in gaps at once, the largest_wrong_logit that find_min_gaps gets by running
+    compute_extreme_right_attention_quadratic, compute_extreme_softmaxed_right_attention_quadratic, and
+    compute_largest_wrong_logit_quadratic with that (scalar) min_gap.
+
+    The gap is a leading batch dimension, and the per-(query, max, copies) loops are replaced with masked broadcasts;
+    the results agree with the loop versions up to floating point summation order.
+
+    Memory: O(n_gaps * d_vocab^2 * n_ctx^2)
+    """
+    device = EQKE.device
+    gaps = torch.as_tensor(gaps, dtype=torch.long, device=device)
+    d_vocab_q, d_vocab_max = EQKE.shape
+    n_ctx = EQKE_pos_err.shape[-1]
+    nan = float("nan")
+    q_toks = torch.arange(d_vocab_q, device=device)
+    max_toks = torch.arange(d_vocab_max, device=device)
+    n_copies_nonmax = torch.arange(n_ctx, device=device)
+    is_diag: Bool[Tensor, "d_vocab_q d_vocab_max"] = (  # noqa: F722
+        q_toks[:, None] == max_toks[None, :]
+    )
+    # lowest_nonmax[gap, max_tok] = max_tok - gap, the largest allowed non-max token
+    lowest_nonmax = max_toks[None, :] - gaps[:, None]
+    # O(n_gaps * d_vocab_q * d_vocab_max), indexed [gap, q_tok, max_tok]
+    gap_q_max = gaps[:, None, None]
+    too_close: Bool[Tensor, "n_gaps d_vocab_q d_vocab_max"] = ~is_diag & (  # noqa: F722
+        max_toks[None, None, :] - q_toks[None, :, None] < gap_q_max
+    )
+    max_too_small: Bool[Tensor, "n_gaps d_vocab_max"] = lowest_nonmax < 0  # noqa: F722
+
+    # compute_extreme_right_attention_quadratic; running extrema are [max, min], flipped by the subtraction
+    running_extrema = torch.stack(
+        [EQKE.cummax(dim=-1).values, EQKE.cummin(dim=-1).values]
+    )
+    extreme_right_attention: Float[
+        Tensor, "n_gaps minmax=2 d_vocab_q d_vocab_max"  # noqa: F722
+    ] = EQKE - running_extrema[:, :, lowest_nonmax.clamp(min=0)].permute(2, 0, 1, 3)
+    extreme_right_attention = extreme_right_attention.masked_fill(
+        max_too_small[:, None, None, :], 0
+    ).masked_fill(too_close[:, None], nan)
+    extreme_right_attention[:, 0] -= EQKE_err_upper_bound[:, None]
+    extreme_right_attention[:, 1] += EQKE_err_upper_bound[:, None]
+
+    # compute_extreme_softmaxed_right_attention_quadratic
+    EQKE_pos_err = EQKE_pos_err - EQKE_pos_err[:, -1].unsqueeze(-1)
+    EQKE_pos_err = EQKE_pos_err[:, :-1].sort(dim=-1).values
+    pos_attention = torch.zeros((2, d_vocab_q, n_ctx), device=device)
+    pos_attention[0, :, :-1] = EQKE_pos_err
+    pos_attention[1, :, :-1] = EQKE_pos_err.flip(dims=[-1])
+    positions = torch.arange(n_ctx, device=device)
+    n_copies_max = (n_ctx - n_copies_nonmax)[:, None]
+    # the max tokens go in the least favored slots; a max-token query goes in the query position
+    is_max_position: Bool[Tensor, "d_vocab_q d_vocab_max n_ctx_copies_nonmax n_ctx"] = (
+        torch.where(  # noqa: F722
+            is_diag[:, :, None, None],
+            (positions[None, :] < n_copies_max - 1) | (positions[None, :] == n_ctx - 1),
+            positions[None, :] < n_copies_max,
+        )
+    )
+    pre_softmax = torch.where(
+        is_max_position,
+        pos_attention[:, :, None, None, :] + extreme_right_attention[..., None, None],
+        pos_attention[:, :, None, None, :],
+    )
+    valid: Bool[
+        Tensor, "n_gaps d_vocab_q d_vocab_max n_ctx_copies_nonmax"
+    ] = (  # noqa: F722
+        (q_toks[:, None] <= max_toks[None, :])[None, :, :, None]
+        & ~((n_copies_nonmax == 0)[None, None, None, :] & ~is_diag[None, :, :, None])
+        & ~(max_too_small[:, None, :, None] & (n_copies_nonmax != 0))
+        & ~too_close[..., None]
+    )
+    extreme_softmaxed_right_attention: Float[
+        Tensor,
+        "n_gaps minmax=2 d_vocab_q d_vocab_max n_ctx_copies_nonmax",  # noqa: F722
+    ] = (
+        (pre_softmax / attn_scale)
+        .softmax(dim=-1)
+        .where(is_max_position, 0)
+        .sum(dim=-1)
+        .where(valid[:, None], nan)
+    )
+    del pre_softmax
+
+    # compute_largest_wrong_logit_quadratic
+    EVOU_max_logit_diff: Float[Tensor, "d_vocab_k"] = (  # noqa: F821
+        EVOU.max(dim=-1).values - EVOU.min(dim=-1).values
+    )
+    EUPU_mean_query, EUPU_per_query_max_gap = tricks.split_EPU(
+        W_EP=W_EP, W_U=W_U, W_EP_mean_query=W_EP_direction
+    )
+    EVOU = EVOU - EVOU.diag()[:, None]
+    logits = torch.zeros((d_vocab_max, EVOU.shape[-1]), device=device)
+    logits_only_max = torch.zeros((d_vocab_max,), device=device)
+    # the centering is cumulative across max tokens, so we replay it in order
+    for max_tok in range(d_vocab_max):
+        PVOU = PVOU - PVOU[:, max_tok].unsqueeze(-1)
+        EUPU_mean_query = EUPU_mean_query - EUPU_mean_query[max_tok].item()
+        cur_PVOU: Float[Tensor, "d_vocab_out"] = PVOU.max(dim=0).values  # noqa: F821
+        cur_logits_only_max = W_EP[max_tok, :] @ W_U + EVOU[max_tok, :] + cur_PVOU
+        cur_logits_only_max -= cur_logits_only_max[max_tok].item()
+        cur_logits_only_max[max_tok] = float("-inf")
+        logits_only_max[max_tok] = cur_logits_only_max.max()
+        logits[max_tok] = EUPU_mean_query + cur_PVOU
+    is_max_out: Bool[Tensor, "d_vocab_max d_vocab_out"] = (  # noqa: F722
+        max_toks[:, None] == torch.arange(EVOU.shape[-1], device=device)[None, :]
+    )
+    right_attention_logits_max: Float[Tensor, "d_vocab_max"] = (  # noqa: F821
+        EVOU[:d_vocab_max].masked_fill(is_max_out, float("-inf")).max(dim=-1).values
+    )
+    wrong_attention_logits: Float[Tensor, "n_gaps d_vocab_max"] = (  # noqa: F722
+        EVOU_max_logit_diff.cummax(dim=0).values[lowest_nonmax.clamp(min=0)]
+    )
+    use_min_attention = right_attention_logits_max[None, :] < wrong_attention_logits
+    cur_extreme_softmaxed_right_attention = torch.where(
+        use_min_attention[:, None, :, None],
+        extreme_softmaxed_right_attention[:, 0],
+        extreme_softmaxed_right_attention[:, 1],
+    )
+    # invalid queries are nan, so they are left out of the average
+    (
+        average_right_attention,
+        extra_right_attention,
+    ) = tricks.split_extreme_softmaxed_right_attention(
+        cur_extreme_softmaxed_right_attention, dim=1
+    )
+    cur_copies_logits = (
+        logits[None, :, None, :]
+        + average_right_attention[..., None] * EVOU[None, :d_vocab_max, None, :]
+    ).masked_fill(is_max_out[None, :, None, :], float("-inf"))
+    average_wrong_logit = (
+        cur_copies_logits.max(dim=-1).values
+        + (1 - average_right_attention) * wrong_attention_logits[..., None]
+    )
+    results = average_wrong_logit[:, None] + EUPU_per_query_max_gap[None, :, None, None]
+    results += extra_right_attention * right_attention_logits_max[None, None, :, None]
+    results += -extra_right_attention * wrong_attention_logits[:, None, :, None]
+    results = results.where(valid & (n_copies_nonmax != 0), nan)
+    results[:, max_toks, max_toks, 0] = logits_only_max
+    return results
+
+
 @torch.no_grad()
 def find_min_gaps(
     *,
@@ -35,11 +195,17 @@ def find_min_gaps(
     leave: Optional[bool] = None,
     desc: Optional[str] = None,
     pbar: Optional[tqdm] = None,
+    batched: bool = True,
+    gap_batch_size: Optional[int] = None,
+    max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES,
     **compute_largest_wrong_logit_quadratic_kwargs,
 ) -> Integer[Tensor, "d_vocab_q d_vocab_max n_ctx_nonmax_copies"]:  # noqa: F722
     """
     Run the argument across all possible min_gaps, and return the min_gap that works for each query token and max token.
 
+    If batched, gap_batch_size gaps at a time (default: as many as fit in max_memory_bytes) are evaluated in a
+    single pass by compute_largest_wrong_logit_quadratic_for_gaps, rather than one loop-based pass per gap.
+
     Since here we are finding the argument/proof rather than verifying it, the complexity does not matter.
     """
     d_vocab_q, d_vocab_k = EQKE.shape
@@ -50,6 +216,39 @@ def find_min_gaps(
     if EQKE_err_upper_bound.ndim < 1:
         EQKE_err_upper_bound = EQKE_err_upper_bound[None]
     min_gap_list = list(reversed(range(1, d_vocab_k)))
+    if batched:
+        if gap_batch_size is None:
+            # the pre-softmax attention, [minmax=2, d_vocab_q, d_vocab_max, n_ctx, n_ctx] per gap, dominates
+            bytes_per_gap = 2 * d_vocab_q * d_vocab_k * n_ctx**2 * EQKE.element_size()
+            gap_batch_size = max(1, max_memory_bytes // bytes_per_gap)
+        if pbar is None:
+            pbar = tqdm(
+                total=len(min_gap_list), position=position, leave=leave, desc=desc
+            )
+        # smallest working gap so far, with d_vocab_k meaning that no gap works yet
+        smallest_gaps = torch.full_like(min_gaps, d_vocab_k).to(EQKE.device)
+        for start in range(0, len(min_gap_list), gap_batch_size):
+            gaps = torch.tensor(
+                min_gap_list[start : start + gap_batch_size], device=EQKE.device
+            )
+            largest_wrong_logit = compute_largest_wrong_logit_quadratic_for_gaps(
+                gaps,
+                EQKE=EQKE,
+                EQKE_err_upper_bound=EQKE_err_upper_bound.to(EQKE.device),
+                EQKE_pos_err=EQKE_pos_err,
+                attn_scale=attn_scale,
+                **compute_largest_wrong_logit_quadratic_kwargs,
+            )
+            # if the largest wrong logit is negative, then this gap works
+            working_gaps = torch.where(
+                largest_wrong_logit < 0, gaps[:, None, None, None], d_vocab_k
+            )
+            smallest_gaps = torch.minimum(smallest_gaps, working_gaps.amin(dim=0))
+            pbar.update(gaps.shape[0])
+        smallest_gaps = smallest_gaps.cpu()
+        min_gaps[smallest_gaps < d_vocab_k] = smallest_gaps[smallest_gaps < d_vocab_k]
+        return compress_int_tensor(min_gaps, allow_negative=False)
+
     if pbar is None:
         min_gap_list = tqdm(
             min_gap_list,
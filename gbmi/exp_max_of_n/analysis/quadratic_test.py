@@ -0,0 +1,99 @@
+import torch
+from tqdm.auto import tqdm
+
+from gbmi.exp_max_of_n.analysis.quadratic import (
+    compute_largest_wrong_logit_quadratic_for_gaps,
+    find_min_gaps,
+)
+from gbmi.exp_max_of_n.verification import LargestWrongLogitQuadraticConfig
+from gbmi.exp_max_of_n.verification.quadratic import (
+    compute_extreme_right_attention_quadratic,
+    compute_extreme_softmaxed_right_attention_quadratic,
+    compute_largest_wrong_logit_quadratic,
+)
+from gbmi.utils.testing import TestCase
+
+
+def random_find_min_gaps_kwargs(
+    d_vocab: int, n_ctx: int, d_model: int, generator: torch.Generator
+) -> dict:
+    # make attention increase with the key token, and EVOU copy, so that many gaps work
+    return dict(
+        EQKE=torch.arange(d_vocab).float()[None, :] * 3
+        + torch.randn(d_vocab, d_vocab, generator=generator),
+        EQKE_err_upper_bound=torch.rand(d_vocab, generator=generator),
+        EQKE_pos_err=torch.randn(d_vocab, n_ctx, generator=generator),
+        attn_scale=2.0,
+        W_EP=torch.randn(d_vocab, d_model, generator=generator) * 0.3,
+        W_U=torch.randn(d_model, d_vocab, generator=generator) * 0.3,
+        EVOU=torch.eye(d_vocab) * 8
+        + torch.randn(d_vocab, d_vocab, generator=generator),
+        PVOU=torch.randn(n_ctx, d_vocab, generator=generator),
+    )
+
+
+class TestQuadratic(TestCase):
+    def test_largest_wrong_logit_for_gaps_matches_loop(self):
+        generator = torch.Generator().manual_seed(0)
+        kwargs = random_find_min_gaps_kwargs(7, 4, 8, generator)
+        EQKE, err, EQKE_pos_err, attn_scale = (
+            kwargs.pop(k)
+            for k in ("EQKE", "EQKE_err_upper_bound", "EQKE_pos_err", "attn_scale")
+        )
+        gaps = list(range(1, 7))
+        actual = compute_largest_wrong_logit_quadratic_for_gaps(
+            gaps,
+            EQKE=EQKE,
+            EQKE_err_upper_bound=err,
+            EQKE_pos_err=EQKE_pos_err,
+            attn_scale=attn_scale,
+            **kwargs,
+        )
+        for i, min_gap in enumerate(gaps):
+            extreme_right_attention = compute_extreme_right_attention_quadratic(
+                EQKE, min_gap=min_gap
+            )
+            extreme_right_attention[0] -= err[:, None, None]
+            extreme_right_attention[1] += err[:, None, None]
+            expected = compute_largest_wrong_logit_quadratic(
+                compute_extreme_softmaxed_right_attention_quadratic(
+                    extreme_right_attention,
+                    EQKE_pos_err,
+                    min_gap=min_gap,
+                    attn_scale=attn_scale,
+                ),
+                min_gap=min_gap,
+                **kwargs,
+            )
+            self.assertTrue(
+                torch.equal(actual[i].isnan(), expected.isnan()),
+                msg=f"nan mismatch for min_gap={min_gap}",
+            )
+            self.assertAllClose(actual[i].nan_to_num(), expected.nan_to_num())
+
+    def test_find_min_gaps_batched_matches_loop(self):
+        generator = torch.Generator().manual_seed(0)
+        for d_vocab, n_ctx in [(2, 2), (6, 3), (10, 4)]:
+            for tricks in (
+                LargestWrongLogitQuadraticConfig(),
+                LargestWrongLogitQuadraticConfig.OFF(),
+            ):
+                kwargs = random_find_min_gaps_kwargs(d_vocab, n_ctx, 8, generator)
+                expected = find_min_gaps(
+                    batched=False, pbar=tqdm(disable=True), tricks=tricks, **kwargs
+                )
+                for batch_kwargs in (
+                    {},
+                    {"gap_batch_size": 3},
+                    {"max_memory_bytes": 2**12},
+                ):
+                    actual = find_min_gaps(
+                        pbar=tqdm(disable=True),
+                        tricks=tricks,
+                        **batch_kwargs,
+                        **kwargs,
+                    )
+                    self.assertTrue(
+                        torch.equal(actual, expected),
+                        msg=f"min_gaps mismatch for {(d_vocab, n_ctx, tricks, batch_kwargs)}",
+                    )
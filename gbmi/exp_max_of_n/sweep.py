@@ -0,0 +1,241 @@
+import copy
+import csv
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterable, Mapping, Optional, Sequence, Union
+
+import pandas as pd
+import torch
+import torch.multiprocessing
+from tqdm.auto import tqdm
+from transformer_lens import HookedTransformer
+
+import gbmi.exp_max_of_n.analysis.subcubic as analysis_subcubic
+import gbmi.exp_max_of_n.verification.cubic as cubic
+import gbmi.exp_max_of_n.verification.subcubic as subcubic
+from gbmi.exp_max_of_n.verification import LargestWrongLogitQuadraticConfig
+
+ProofTask = Callable[
+    [HookedTransformer, Optional[LargestWrongLogitQuadraticConfig]], dict[str, Any]
+]
+
+SWEEP_COLUMNS: tuple[str, ...] = ("seed", "tricks", "status", "duration-wall")
+SUBCUBIC_PROOF_COLUMNS: tuple[str, ...] = (
+    "accuracy-bound",
+    "correct-count",
+    "duration-proof-search",
+    "duration",
+    "err-upper-bound",
+    "err-upper-bound-is-max",
+    "total-sequences",
+    "dropped-sequences",
+    "dropped-sequences-frac",
+    "max-gap",
+)
+CUBIC_PROOF_COLUMNS: tuple[str, ...] = (
+    "accuracy-bound",
+    "correct-count",
+    "total-sequences",
+    "duration",
+)
+
+
+@torch.no_grad()
+def subcubic_proof_row(
+    model: HookedTransformer, tricks: Optional[LargestWrongLogitQuadraticConfig]
+) -> dict[str, Any]:
+    """Finds and verifies the subcubic proof for one model and proof strategy"""
+    assert tricks is not None
+    proof_args, proof_search_duration = analysis_subcubic.find_proof(
+        model, tricks, record_time=True, sub_pbar=tqdm(disable=True)
+    )
+    results = subcubic.verify_proof(
+        model,
+        **proof_args,
+        sanity_check=False,
+        print_complexity=False,
+        print_results=False,
+    )
+    err_upper_bound = results["err_upper_bound"]
+    err_upper_bound_is_max = err_upper_bound.numel() != 1
+    return {
+        "accuracy-bound": results["accuracy_lower_bound"],
+        "correct-count": results["correct_count_lower_bound"],
+        "duration-proof-search": proof_search_duration,
+        "duration": results["prooftime"],
+        "err-upper-bound": err_upper_bound.max().item(),
+        "err-upper-bound-is-max": err_upper_bound_is_max,
+        "total-sequences": results["total_sequences"],
+        "dropped-sequences": results["left_behind"],
+        "dropped-sequences-frac": results["left_behind"] / results["total_sequences"],
+        "max-gap": proof_args["min_gaps"].max().item(),
+    }
+
+
+@torch.no_grad()
+def cubic_proof_row(
+    model: HookedTransformer, tricks: Optional[LargestWrongLogitQuadraticConfig]
+) -> dict[str, Any]:
+    """Verifies the cubic proof for one model; the cubic proof has no strategies, so sweep it with strategies=(None,)"""
+    results = cubic.verify_proof(
+        model,
+        cubic.find_proof(model),
+        print_complexity=False,
+        print_results=False,
+        sanity_check=False,
+        pbar=tqdm(disable=True),
+    )
+    return {
+        "accuracy-bound": results["accuracy_lower_bound"],
+        "correct-count": results["correct_count_lower_bound"],
+        "total-sequences": results["total_sequences"],
+        "duration": results["prooftime"],
+    }
+
+
+def strategy_key(tricks: Optional[LargestWrongLogitQuadraticConfig]) -> str:
+    return "" if tricks is None else tricks.short_description(latex=True)
+
+
+_worker_models: dict[int, HookedTransformer] = {}
+
+
+def _init_worker(models: dict[int, HookedTransformer], num_threads: int) -> None:
+    # the models arrive as handles to the parent's shared-memory tensors, not copies
+    _worker_models.update(models)
+    torch.set_num_threads(num_threads)
+
+
+@contextmanager
+def _time_limit(seconds: Optional[float]):
+    """Raises TimeoutError in the (main thread of the) current process after seconds"""
+    if seconds is None or not hasattr(signal, "setitimer"):
+        yield
+        return
+
+    def handler(signum, frame):
+        raise TimeoutError(f"timed out after {seconds}s")
+
+    old_handler = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old_handler)
+
+
+def _run_task(
+    task: ProofTask,
+    seed: int,
+    tricks: Optional[LargestWrongLogitQuadraticConfig],
+    timeout: Optional[float],
+) -> dict[str, Any]:
+    row: dict[str, Any] = {"seed": seed, "tricks": strategy_key(tricks)}
+    start = time.time()
+    try:
+        with _time_limit(timeout):
+            row |= task(_worker_models[seed], tricks)
+        row["status"] = "ok"
+    except TimeoutError:
+        row["status"] = "timeout"
+    except Exception as e:
+        row["status"] = f"error: {e!r}"
+    row["duration-wall"] = time.time() - start
+    return row
+
+
+def completed_tasks(output_path: Union[str, Path]) -> set[tuple[int, str]]:
+    """Returns the (seed, strategy_key) pairs already recorded in output_path"""
+    output_path = Path(output_path)
+    if not output_path.exists() or output_path.stat().st_size == 0:
+        return set()
+    with open(output_path, newline="", encoding="utf-8") as f:
+        return {(int(row["seed"]), row["tricks"]) for row in csv.DictReader(f)}
+
+
+def run_proof_sweep(
+    models: Mapping[int, HookedTransformer],
+    output_path: Union[str, Path],
+    *,
+    strategies: Optional[Iterable[Optional[LargestWrongLogitQuadraticConfig]]] = None,
+    task: ProofTask = subcubic_proof_row,
+    columns: Sequence[str] = SUBCUBIC_PROOF_COLUMNS,
+    max_workers: Optional[int] = None,
+    threads_per_worker: int = 1,
+    timeout: Optional[float] = None,
+    retry_failed: bool = False,
+    parquet_path: Optional[Union[str, Path]] = None,
+    mp_start_method: str = "spawn",
+    pbar: Optional[tqdm] = None,
+) -> pd.DataFrame:
+    """
+    Runs task(model, tricks) for every (seed, tricks) in models × strategies on a process pool.
+
+    - The model weights are moved into shared memory once and handed to each worker at startup, so
+      workers do not each hold a private copy.
+    - Rows are appended to the CSV at output_path as soon as each task finishes; tasks already present in
+      output_path are skipped, so an interrupted sweep resumes where it left off.  Tasks that timed out or
+      raised are recorded with their status, and are rerun only if retry_failed is True.
+    - timeout (in seconds) bounds each individual task.
+    - If parquet_path is given, the full CSV is also written there at the end.
+
+    strategies defaults to LargestWrongLogitQuadraticConfig.all_values().  Returns the contents of output_path.
+    """
+    output_path = Path(output_path)
+    if strategies is None:
+        strategies = LargestWrongLogitQuadraticConfig.all_values()
+    strategies = tuple(strategies)
+    fieldnames = list(SWEEP_COLUMNS) + [c for c in columns if c not in SWEEP_COLUMNS]
+
+    if retry_failed and output_path.exists():
+        # drop the failed rows, so that the file holds at most one row per task
+        existing = pd.read_csv(output_path)
+        existing[existing["status"] == "ok"].to_csv(output_path, index=False)
+    done = completed_tasks(output_path)
+    todo = [
+        (seed, tricks)
+        for seed in models
+        for tricks in strategies
+        if (seed, strategy_key(tricks)) not in done
+    ]
+
+    if todo:
+        shared_models = {}
+        for seed in {seed for seed, _ in todo}:
+            # copied, so that the caller's model is neither moved nor put into shared memory
+            model = copy.deepcopy(models[seed]).to("cpu", print_details=False)
+            model.share_memory()
+            shared_models[seed] = model
+        write_header = not output_path.exists() or output_path.stat().st_size == 0
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with (
+            open(output_path, "a", newline="", encoding="utf-8") as f,
+            ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=torch.multiprocessing.get_context(mp_start_method),
+                initializer=_init_worker,
+                initargs=(shared_models, threads_per_worker),
+            ) as executor,
+        ):
+            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+            if write_header:
+                writer.writeheader()
+            futures = [
+                executor.submit(_run_task, task, seed, tricks, timeout)
+                for seed, tricks in todo
+            ]
+            for future in as_completed(futures):
+                writer.writerow(future.result())
+                f.flush()
+                if pbar is not None:
+                    pbar.update(1)
+
+    results = pd.read_csv(output_path)
+    results["tricks"] = results["tricks"].fillna("")
+    if parquet_path is not None:
+        results.to_parquet(parquet_path)
+    return results
@@ -0,0 +1,64 @@
+import tempfile
+from pathlib import Path
+
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from gbmi.exp_max_of_n.sweep import run_proof_sweep
+from gbmi.exp_max_of_n.verification import LargestWrongLogitQuadraticConfig
+from gbmi.utils.testing import TestCase
+
+
+def embedding_sum_row(model, tricks):
+    return {"accuracy-bound": model.W_E.sum().item(), "correct-count": 0}
+
+
+def random_model(seed: int) -> HookedTransformer:
+    cfg = HookedTransformerConfig(
+        n_layers=1,
+        attn_only=True,
+        d_vocab=4,
+        n_ctx=2,
+        d_model=8,
+        d_head=8,
+        n_heads=1,
+        normalization_type=None,
+        seed=seed,
+        device="cpu",
+    )
+    return HookedTransformer(cfg)
+
+
+class TestSweep(TestCase):
+    def test_sweep_resumes(self):
+        models = {seed: random_model(seed) for seed in (1, 2)}
+        strategies = LargestWrongLogitQuadraticConfig.all_values()[:2]
+        sweep = lambda output_path, strategies: run_proof_sweep(
+            models,
+            output_path,
+            strategies=strategies,
+            task=embedding_sum_row,
+            columns=("accuracy-bound", "correct-count"),
+            max_workers=1,
+            mp_start_method="fork",
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_path = Path(tmpdir) / "sweep.csv"
+            first = sweep(output_path, strategies[:1])
+            self.assertEqual(len(first), 2)
+            # the already-recorded tasks are skipped, not rerun
+            results = sweep(output_path, strategies)
+            self.assertEqual(len(results), 4)
+            self.assertTrue(results.iloc[:2].equals(first))
+            self.assertEqual(set(results["status"]), {"ok"})
+            self.assertEqual(
+                len(set(zip(results["seed"], results["tricks"]))), len(results)
+            )
+            for seed, model in models.items():
+                rows = results[results["seed"] == seed]
+                self.assertAllClose(
+                    torch.tensor(rows["accuracy-bound"].tolist()),
+                    model.W_E.sum().expand(2),
+                )
+                # the caller's models are left untouched
+                self.assertFalse(model.W_E.is_shared())
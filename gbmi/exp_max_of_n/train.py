@@ -2,6 +2,8 @@
 from __future__ import annotations
 
 import argparse
+import copy
+import math
 import sys
 from dataclasses import dataclass, field
 from functools import cache
@@ -12,7 +14,13 @@ import torch
 import torch.nn.functional as F
 from jaxtyping import Bool, Float, Integer
 from torch import Tensor
-from torch.utils.data import DataLoader, Dataset, IterableDataset, TensorDataset
+from torch.utils.data import (
+    DataLoader,
+    Dataset,
+    IterableDataset,
+    TensorDataset,
+    get_worker_info,
+)
 from transformer_lens import HookedTransformer, HookedTransformerConfig
 
 import gbmi.utils as utils
@@ -38,6 +46,8 @@ from gbmi.utils.sequences import generate_all_sequences
 class IterableDatasetCfg:
     n_samples: Optional[int] = None
     pick_max_first: bool = False
+    # generate whole batches at once; None rather than False so that existing config hashes are unchanged
+    batched: Optional[bool] = None
 
 
 @dataclass
@@ -397,10 +407,17 @@ class MaxOfNIterableDataset(
         config: Config[MaxOfN],
         max_length: Optional[int] = None,
         pick_max_first: bool = False,
+        batch_size: Optional[int] = None,
     ):
+        """
+        If batch_size is not None, the dataset yields whole (xs, ys) batches of batch_size samples (the last one
+        possibly shorter), and should be loaded with DataLoader(..., batch_size=None).  Each batch is generated from
+        its own seed, so the stream is the same however many DataLoader workers it is sharded across.
+        """
         self.config = config
         self.seed = seed
         self.pick_max_first = pick_max_first
+        self.batch_size = batch_size
         if max_length is None:
             n, unit = config.train_for
             assert unit == "steps"
@@ -409,9 +426,64 @@ class MaxOfNIterableDataset(
             self.max_length = max_length
 
     def __len__(self):
+        if self.batch_size is not None:
+            return math.ceil(self.max_length / self.batch_size)
         return self.max_length
 
+    def with_batch_size(self, batch_size: Optional[int]) -> MaxOfNIterableDataset:
+        dataset = copy.copy(self)
+        dataset.batch_size = batch_size
+        return dataset
+
+    def generate_batch(
+        self, batch_size: int, *, generator: torch.Generator
+    ) -> Tuple[Integer[Tensor, "batch n_ctx"], Integer[Tensor, "batch"]]:  # noqa: F722
+        d_vocab_out, seq_len = (
+            self.config.experiment.d_vocab_out,
+            self.config.experiment.seq_len,
+        )
+        if self.pick_max_first:
+            max_val = torch.randint(0, d_vocab_out, (batch_size,), generator=generator)
+            # the modulo bias from 2**62 is negligible
+            val = torch.randint(
+                0, 2**62, (batch_size, seq_len), generator=generator
+            ) % (max_val[:, None] + 1)
+            # put the max in a random position of every sequence that doesn't already contain it
+            missing_max = ~(val == max_val[:, None]).any(dim=-1)
+            rows = torch.arange(batch_size)
+            max_pos = torch.randint(0, seq_len, (batch_size,), generator=generator)
+            val[rows, max_pos] = torch.where(missing_max, max_val, val[rows, max_pos])
+        else:
+            val = torch.randint(
+                0, d_vocab_out, (batch_size, seq_len), generator=generator
+            )
+
+        eos_token = self.config.experiment.get_eos_token()
+        if eos_token is not None:
+            val = torch.cat(
+                [val, torch.full((batch_size, 1), eos_token, dtype=val.dtype)], dim=-1
+            )
+        return val, self.config.experiment.get_ground_truth(val)
+
+    def _iter_batches(self):
+        assert self.batch_size is not None
+        worker_info = get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        )
+        g = torch.Generator()
+        # DataLoader takes batches from its workers round-robin, so this preserves the order of the batches
+        for batch_idx in range(worker_id, len(self), num_workers):
+            g.manual_seed(reseed(self.seed, f"batch{batch_idx}"))
+            start = batch_idx * self.batch_size
+            yield self.generate_batch(
+                min(self.batch_size, self.max_length - start), generator=g
+            )
+
     def __iter__(self):
+        if self.batch_size is not None:
+            return self._iter_batches()
+
         def generator():
             g = torch.Generator()
             g.manual_seed(self.seed)
@@ -507,6 +579,8 @@ class MaxOfNDataModule(DataModule):
                 self.config,
                 max_length=cfg.n_samples,
                 pick_max_first=cfg.pick_max_first,
+                # the dataloaders rebatch this to their own batch sizes
+                batch_size=self.config.batch_size if cfg.batched else None,
             )
         elif isinstance(cfg, FullDatasetCfg):
             data_train, data_test = self.get_full_dataset(
@@ -537,14 +611,24 @@ class MaxOfNDataModule(DataModule):
             self.config.experiment.test_dataset_cfg, "test"
         )
 
+    @staticmethod
+    def dataloader(dataset: Dataset, batch_size: Optional[int]) -> DataLoader:
+        if (
+            isinstance(dataset, MaxOfNIterableDataset)
+            and dataset.batch_size is not None
+        ):
+            # the dataset generates whole batches itself
+            return DataLoader(dataset.with_batch_size(batch_size), batch_size=None)
+        return DataLoader(dataset, batch_size=batch_size)
+
     def train_dataloader(self):
-        return DataLoader(self.data_train, batch_size=self.config.batch_size)
+        return self.dataloader(self.data_train, self.config.batch_size)
 
     def val_dataloader(self):
-        return DataLoader(self.data_test, batch_size=self.config.validation_batch_size)
+        return self.dataloader(self.data_test, self.config.validation_batch_size)
 
     def test_dataloader(self):
-        return DataLoader(self.data_test, batch_size=self.config.batch_size)
+        return self.dataloader(self.data_test, self.config.batch_size)
 
 
 def config_of_argv(argv=sys.argv) -> tuple[Config[MaxOfN], dict]:
@@ -1,8 +1,11 @@
 # %%
+from dataclasses import replace
+
 import plotly.express as px
 import torch
+from torch.utils.data import DataLoader
 
-from gbmi.exp_max_of_n.train import MAX_OF_10_SINGLE_CONFIG
+from gbmi.exp_max_of_n.train import MAX_OF_10_SINGLE_CONFIG, MaxOfNIterableDataset
 from gbmi.model import train_or_load_model
 from gbmi.utils import ein
 from gbmi.utils.testing import TestCase
@@ -30,6 +33,42 @@ class TestMaxOfN(TestCase):
             cfg.experiment.get_ground_truth(data), """tensor([2, 3])"""
         )
 
+    def test_batched_iterable_dataset(self):
+        for use_end_of_sequence in (False, True):
+            cfg = replace(
+                MAX_OF_10_SINGLE_CONFIG,
+                experiment=replace(
+                    MAX_OF_10_SINGLE_CONFIG.experiment,
+                    use_end_of_sequence=use_end_of_sequence,
+                ),
+            )
+            for pick_max_first in (False, True):
+                dataset = MaxOfNIterableDataset(
+                    1234,
+                    cfg,
+                    max_length=100,
+                    pick_max_first=pick_max_first,
+                    batch_size=32,
+                )
+                batches = list(DataLoader(dataset, batch_size=None))
+                self.assertEqual(len(batches), len(dataset))
+                self.assertEqual([xs.shape[0] for xs, _ in batches], [32, 32, 32, 4])
+                xs = torch.cat([xs for xs, _ in batches])
+                ys = torch.cat([ys for _, ys in batches])
+                self.assertEqual(
+                    xs.shape[-1], cfg.experiment.seq_len + int(use_end_of_sequence)
+                )
+                self.assertTrue(torch.equal(ys, cfg.experiment.get_ground_truth(xs)))
+                if use_end_of_sequence:
+                    self.assertTrue((xs[:, -1] == cfg.experiment.d_vocab_out).all())
+                    xs = xs[:, :-1]
+                self.assertTrue((xs < cfg.experiment.d_vocab_out).all())
+                # the same seed gives the same batches, however many workers share them
+                sharded = list(DataLoader(dataset, batch_size=None, num_workers=3))
+                for (xs1, ys1), (xs2, ys2) in zip(batches, sharded, strict=True):
+                    self.assertTrue(torch.equal(xs1, xs2))
+                    self.assertTrue(torch.equal(ys1, ys2))
+
 
 # %%
 class TestOneLayerTransformer(TestCase):
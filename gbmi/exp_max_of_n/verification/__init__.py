@@ -2,7 +2,18 @@
 import dataclasses
 from enum import Enum
 from functools import cache, reduce
-from typing import Any, ClassVar, Dict, Literal, Optional, Tuple, Union
+from typing import (
+    Any,
+    Callable,
+    ClassVar,
+    Dict,
+    Iterable,
+    Iterator,
+    Literal,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import numpy as np
 import torch
@@ -13,13 +24,14 @@ from transformer_lens import HookedTransformerConfig
 
 from gbmi.analysis_tools.plot import summarize
 from gbmi.analysis_tools.utils import make_local_tqdm
-from gbmi.utils import bits_of_type, dropnan
+from gbmi.exp_max_of_n.verification.brute_force import (
+    DEFAULT_MAX_MEMORY_BYTES,
+    forward_pass_batch_size,
+)
+from gbmi.utils import bits_of_type
 from gbmi.utils.dataclass import enumerate_dataclass_values
 from gbmi.utils.FactoredMatrix import FactoredMatrix
-from gbmi.utils.sequences import (
-    generate_all_sequences,
-    generate_all_sequences_for_model,
-)
+from gbmi.utils.sequences import generate_sequences_range, iter_all_sequences
 from gbmi.verification_tools.decomp import (
     bound_max_row_diff_by_SVD,
     max_row_diffs_per_dim,
@@ -29,16 +41,15 @@ from gbmi.verification_tools.l1h1 import all_attention_scores, all_EVOU, all_PVO
 
 
 @torch.no_grad()
-def logit_delta_of_results(
+def min_incorrect_logit_of_results(
     all_tokens: Integer[Tensor, "batch n_ctx"],  # noqa: F722
-    predicted_logits: Float[Tensor, "d_vocab_out"],  # noqa: F821
-    renderer=None,
-    histogram_all_incorrect_logit_differences: bool = False,
-    return_summary: bool = False,
-    hist_args={},
-) -> Union[float, Dict[str, Any]]:
+    predicted_logits: Float[Tensor, "batch d_vocab_out"],  # noqa: F722
+) -> Tuple[
+    Float[Tensor, "batch"], Float[Tensor, "batch d_vocab_out"]  # noqa: F821, F722
+]:
     """
-    Largest difference between logit(true_max) and logit(y) for y != true_max.
+    Returns, for each sequence, the smallest difference logit(true_max) - logit(y) for y != true_max, and the
+    differences for every y (inf at y = true_max).
     """
     (batch, n_ctx), (_batch, d_vocab_out) = all_tokens.shape, predicted_logits.shape
     assert predicted_logits.shape == (
@@ -65,17 +76,23 @@ def logit_delta_of_results(
     ), f"logits_above_correct.shape = {logits_above_correct.shape} != {(batch, d_vocab_out)} = (batch, d_vocab_out)"
     # replace correct logit indices with large number so that they don't get picked up by the min
     logits_above_correct[
-        torch.arange(logits_above_correct.shape[0]), indices_of_max.squeeze()
+        torch.arange(logits_above_correct.shape[0]), indices_of_max.squeeze(-1)
     ] = float("inf")
     min_incorrect_logit = logits_above_correct.min(dim=-1).values
     assert min_incorrect_logit.shape == (
         batch,
     ), f"min_incorrect_logit.shape = {min_incorrect_logit.shape} != {(batch,)} = (batch,)"
+    return min_incorrect_logit, logits_above_correct
 
-    if histogram_all_incorrect_logit_differences:
-        all_incorrect_logits = logits_above_correct[
-            logits_above_correct != float("inf")
-        ]
+
+def _summarize_logit_delta(
+    min_incorrect_logit: Float[Tensor, "batch"],  # noqa: F821
+    all_incorrect_logits: Optional[Float[Tensor, "n"]] = None,  # noqa: F821
+    renderer=None,
+    return_summary: bool = False,
+    hist_args={},
+) -> Union[float, Dict[str, Any]]:
+    if all_incorrect_logits is not None:
         summarize(
             all_incorrect_logits,
             name="all incorrect logit differences",
@@ -96,6 +113,135 @@ def logit_delta_of_results(
         return min_incorrect_logit.min().item()
 
 
+@torch.no_grad()
+def logit_delta_of_results(
+    all_tokens: Integer[Tensor, "batch n_ctx"],  # noqa: F722
+    predicted_logits: Float[Tensor, "d_vocab_out"],  # noqa: F821
+    renderer=None,
+    histogram_all_incorrect_logit_differences: bool = False,
+    return_summary: bool = False,
+    hist_args={},
+) -> Union[float, Dict[str, Any]]:
+    """
+    Largest difference between logit(true_max) and logit(y) for y != true_max.
+    """
+    min_incorrect_logit, logits_above_correct = min_incorrect_logit_of_results(
+        all_tokens, predicted_logits
+    )
+    return _summarize_logit_delta(
+        min_incorrect_logit,
+        (
+            logits_above_correct[logits_above_correct != float("inf")]
+            if histogram_all_incorrect_logit_differences
+            else None
+        ),
+        renderer=renderer,
+        return_summary=return_summary,
+        hist_args=hist_args,
+    )
+
+
+class LogitDeltaAccumulator:
+    """
+    Accumulates logit_delta_of_results over batches of sequences, split into n_groups groups (e.g. by gap), so that
+    the logits of all sequences never need to be resident at once.
+
+    Only the running minimum of each group is kept, unless the per-sequence minima are needed for a summary
+    (keep_values) or every incorrect logit difference is needed for a histogram (keep_all_incorrect); these are
+    kept on the CPU.
+    """
+
+    def __init__(
+        self,
+        n_groups: int = 1,
+        keep_values: bool = False,
+        keep_all_incorrect: bool = False,
+    ):
+        self.n_groups = n_groups
+        self.keep_values = keep_values
+        self.keep_all_incorrect = keep_all_incorrect
+        self.min_incorrect_logit: Optional[Tensor] = None
+        self.values: list[list[Tensor]] = [[] for _ in range(n_groups)]
+        self.all_incorrect_logits: list[list[Tensor]] = [[] for _ in range(n_groups)]
+
+    def add(
+        self,
+        all_tokens: Integer[Tensor, "batch n_ctx"],  # noqa: F722
+        predicted_logits: Float[Tensor, "batch d_vocab_out"],  # noqa: F722
+        groups: Optional[Integer[Tensor, "batch"]] = None,  # noqa: F821
+    ) -> None:
+        min_incorrect_logit, logits_above_correct = min_incorrect_logit_of_results(
+            all_tokens, predicted_logits
+        )
+        if groups is None:
+            groups = torch.zeros_like(min_incorrect_logit, dtype=torch.long)
+        groups = groups.to(min_incorrect_logit.device)
+        batch_min = torch.full(
+            (self.n_groups,),
+            float("inf"),
+            dtype=min_incorrect_logit.dtype,
+            device=min_incorrect_logit.device,
+        ).scatter_reduce(0, groups, min_incorrect_logit, "amin")
+        self.min_incorrect_logit = (
+            batch_min.cpu()
+            if self.min_incorrect_logit is None
+            else torch.minimum(self.min_incorrect_logit, batch_min.cpu())
+        )
+        if self.keep_values or self.keep_all_incorrect:
+            for group in groups.unique().tolist():
+                in_group = groups == group
+                if self.keep_values:
+                    self.values[group].append(min_incorrect_logit[in_group].cpu())
+                if self.keep_all_incorrect:
+                    group_logits = logits_above_correct[in_group]
+                    self.all_incorrect_logits[group].append(
+                        group_logits[group_logits != float("inf")].cpu()
+                    )
+
+    def result(
+        self,
+        group: int = 0,
+        renderer=None,
+        return_summary: bool = False,
+        hist_args={},
+    ) -> Union[float, Dict[str, Any]]:
+        """logit_delta_of_results on all the sequences added to group"""
+        assert not return_summary or self.keep_values, "summaries need keep_values"
+        assert self.min_incorrect_logit is not None, "no sequences were added"
+        return _summarize_logit_delta(
+            (
+                torch.cat(self.values[group])
+                if return_summary
+                else self.min_incorrect_logit[group : group + 1]
+            ),
+            (
+                torch.cat(self.all_incorrect_logits[group])
+                if self.keep_all_incorrect
+                else None
+            ),
+            renderer=renderer,
+            return_summary=return_summary,
+            hist_args=hist_args,
+        )
+
+
+@torch.no_grad()
+def _accumulate_logit_deltas(
+    model: HookedTransformer,
+    batches: Iterable[Integer[Tensor, "batch n_ctx"]],  # noqa: F722
+    accumulator: LogitDeltaAccumulator,
+    group_of: Optional[Callable[[Tensor], Tensor]] = None,
+) -> LogitDeltaAccumulator:
+    for tokens in batches:
+        predicted_logits = model(tokens)[:, -1, :].detach()
+        accumulator.add(
+            tokens,
+            predicted_logits,
+            groups=None if group_of is None else group_of(tokens),
+        )
+    return accumulator
+
+
 @torch.no_grad()
 def logit_delta(
     model: HookedTransformer,
@@ -103,40 +249,29 @@ def logit_delta(
     histogram_all_incorrect_logit_differences: bool = False,
     return_summary: bool = False,
     hist_args={},
+    batch_size: Optional[int] = None,
+    max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES,
 ) -> Union[float, Dict[str, Any]]:
     """
     Largest difference between logit(true_max) and logit(y) for y != true_max.
+    Runs the model on batch_size sequences at a time (default: as many as fit in max_memory_bytes).
     Complexity: O(d_vocab^n_ctx * fwd_pass)
     Complexity: fwd_pass = O(n_ctx * d_model + n_ctx * d_model + n_ctx * d_model^2 * d_hidden * 2 + n_ctx * d_hidden^2 + n_ctx * d_model^2 * d_hidden + n_ctx * d_hidden^2 * d_model + n_ctx * d_model + n_ctx * d_model^2 * d_vocab)
     Complexity: n_ctx^2 * d_vocab * d_model^2) + (n_ctx * d_vocab * d_model^2)
     todo fix complexity.
     """
-    n_ctx, d_vocab, d_vocab_out, d_model = (
-        model.cfg.n_ctx,
-        model.cfg.d_vocab,
-        model.cfg.d_vocab_out,
-        model.cfg.d_model,
-    )
-
-    all_tokens = generate_all_sequences_for_model(model=model)
-    assert all_tokens.shape == (
-        d_vocab**n_ctx,
-        n_ctx,
-    ), f"all_tokens.shape = {all_tokens.shape} != {(d_vocab**n_ctx, n_ctx)} = (d_vocab**n_ctx, n_ctx)"
-    predicted_logits = model(all_tokens)[:, -1, :].detach().cpu()
-    assert predicted_logits.shape == (
-        d_vocab**n_ctx,
-        d_vocab_out,
-    ), f"predicted_logits.shape = {predicted_logits.shape} != {(d_vocab**n_ctx, d_vocab_out)} = (d_vocab**n_ctx, d_vocab_out)"
-
-    return logit_delta_of_results(
-        all_tokens=all_tokens,
-        predicted_logits=predicted_logits,
-        renderer=renderer,
-        histogram_all_incorrect_logit_differences=histogram_all_incorrect_logit_differences,
-        return_summary=return_summary,
-        hist_args=hist_args,
-    )
+    if batch_size is None:
+        batch_size = forward_pass_batch_size(model, max_memory_bytes)
+    return _accumulate_logit_deltas(
+        model,
+        iter_all_sequences(
+            model.cfg.d_vocab, model.cfg.n_ctx, batch_size, device=model.W_E.device
+        ),
+        LogitDeltaAccumulator(
+            keep_values=return_summary,
+            keep_all_incorrect=histogram_all_incorrect_logit_differences,
+        ),
+    ).result(renderer=renderer, return_summary=return_summary, hist_args=hist_args)
 
 
 @torch.no_grad()
@@ -154,6 +289,72 @@ def compute_gap(
     return (maxv - second_maxv)[:, 0]
 
 
+@torch.no_grad()
+def iter_tokens_small_gap(
+    model: HookedTransformer, max_min_gap: int = 1, batch_size: Optional[int] = None
+) -> Iterator[Integer[Tensor, "batch n_ctx"]]:  # noqa: F722
+    """
+    The sequences of all_tokens_small_gap, in the same order, in batches of at most batch_size sequences (default:
+    all at once, which takes O(d_vocab^n_ctx) memory for the mask of candidate first tokens)
+
+    For each choice of the tokens after the first, the allowed first tokens are those in
+    [first_token_min, max of the rest) or [first_token_upper_min, first_token_max), selected by a mask.
+    Complexity: O(d_vocab ^ n_ctx)
+    """
+    n_ctx, d_vocab = model.cfg.n_ctx, model.cfg.d_vocab
+    device = model.W_E.device
+    n_rest = d_vocab ** (n_ctx - 1)
+    rest_batch_size = n_rest if batch_size is None else max(1, batch_size // d_vocab)
+    first_tokens = torch.arange(d_vocab, device=device)
+    for start in range(0, n_rest, rest_batch_size):
+        all_tokens_after_start = generate_sequences_range(
+            d_vocab,
+            n_ctx - 1,
+            start,
+            min(start + rest_batch_size, n_rest),
+            device=device,
+        )
+        all_tokens_after_start_max = all_tokens_after_start.max(
+            dim=-1, keepdim=True
+        ).values
+        all_tokens_after_start_max_minf = torch.where(
+            all_tokens_after_start == all_tokens_after_start_max,
+            -max_min_gap - 1,
+            all_tokens_after_start,
+        )
+        all_tokens_after_start_second_max = all_tokens_after_start_max_minf.max(
+            dim=-1, keepdim=True
+        ).values
+        gap_already_present = (
+            all_tokens_after_start_second_max
+            >= all_tokens_after_start_max - max_min_gap
+        )
+        first_token_max = (all_tokens_after_start_max + max_min_gap + 1).clamp(
+            max=d_vocab
+        )
+        first_token_upper_min = (
+            all_tokens_after_start_max + gap_already_present.long()
+        ).clamp(max=d_vocab)
+        first_token_min = torch.where(
+            gap_already_present, 0, all_tokens_after_start_max - max_min_gap
+        ).clamp(min=0)
+        allowed_first_tokens = (
+            (first_token_min <= first_tokens)
+            & (first_tokens < all_tokens_after_start_max)
+        ) | ((first_token_upper_min <= first_tokens) & (first_tokens < first_token_max))
+        rest_idxs, first_toks = allowed_first_tokens.nonzero(as_tuple=True)
+        step = batch_size or max(1, len(rest_idxs))
+        for batch in range(0, len(rest_idxs), step):
+            batch_idxs = slice(batch, batch + step)
+            yield torch.cat(
+                [
+                    first_toks[batch_idxs, None],
+                    all_tokens_after_start[rest_idxs[batch_idxs]],
+                ],
+                dim=-1,
+            )
+
+
 @torch.no_grad()
 def all_tokens_small_gap(
     model: HookedTransformer, max_min_gap: int = 1
@@ -162,77 +363,7 @@ def all_tokens_small_gap(
     All sequences of tokens with the constraint that some token z in the sequence satisfies true_max - max_min_gap <= z < true_max
     Complexity: O(d_vocab ^ (n_ctx - 1) * (max_min_gap * 2 + 1))
     """
-    n_ctx, d_vocab = model.cfg.n_ctx, model.cfg.d_vocab
-
-    all_tokens_after_start = generate_all_sequences(
-        n_digits=d_vocab, sequence_length=n_ctx - 1
-    )
-    all_tokens_after_start_max = all_tokens_after_start.max(dim=-1, keepdim=True).values
-    all_tokens_after_start_max_minf = all_tokens_after_start.clone()
-    all_tokens_after_start_max_minf[
-        all_tokens_after_start_max_minf == all_tokens_after_start_max
-    ] = (-max_min_gap - 1)
-    all_tokens_after_start_second_max = all_tokens_after_start_max_minf.max(
-        dim=-1, keepdim=True
-    ).values
-    first_token_max = all_tokens_after_start_max + max_min_gap + 1
-    gap_already_present = (
-        all_tokens_after_start_second_max >= all_tokens_after_start_max - max_min_gap
-    )
-    first_token_upper_min = all_tokens_after_start_max + gap_already_present.long()
-    first_token_min = torch.zeros_like(first_token_max)
-    first_token_min[~gap_already_present] = (
-        all_tokens_after_start_max[~gap_already_present] - max_min_gap
-    )
-    first_token_min[first_token_min < 0] = 0
-    first_token_max[first_token_max >= d_vocab] = d_vocab
-    first_token_upper_min[first_token_upper_min >= d_vocab] = d_vocab
-    assert first_token_max.shape == (
-        d_vocab ** (n_ctx - 1),
-        1,
-    ), f"first_token_max.shape = {first_token_max.shape} != {(d_vocab**(n_ctx - 1), 1)} = (d_vocab**(n_ctx - 1), 1)"
-    assert first_token_upper_min.shape == (
-        d_vocab ** (n_ctx - 1),
-        1,
-    ), f"first_token_upper_min.shape = {first_token_upper_min.shape} != {(n_ctx, 1)} = (d_vocab**(n_ctx - 1), 1)"
-    assert all_tokens_after_start_max.shape == (
-        d_vocab ** (n_ctx - 1),
-        1,
-    ), f"all_tokens_after_start_max.shape = {all_tokens_after_start_max.shape} != {(d_vocab**(n_ctx - 1), 1)} = (d_vocab**(n_ctx - 1), 1)"
-    assert first_token_min.shape == (
-        d_vocab ** (n_ctx - 1),
-        1,
-    ), f"first_token_min.shape = {first_token_min.shape} != {(d_vocab**(n_ctx - 1), 1)} = (d_vocab**(n_ctx - 1), 1)"
-    (
-        first_token_max,
-        first_token_upper_min,
-        all_tokens_after_start_max,
-        first_token_min,
-    ) = (
-        first_token_max[:, 0],
-        first_token_upper_min[:, 0],
-        all_tokens_after_start_max[:, 0],
-        first_token_min[:, 0],
-    )
-    first_token_ranges = [
-        torch.cat([torch.arange(lower, mid), torch.arange(lower_big, upper)])
-        for lower, mid, lower_big, upper in zip(
-            first_token_min,
-            all_tokens_after_start_max,
-            first_token_upper_min,
-            first_token_max,
-        )
-    ]
-    all_tokens_with_small_gap = torch.cat(
-        [
-            torch.cartesian_prod(first_tokens, *rest_tokens[:, None])
-            for first_tokens, rest_tokens in zip(
-                first_token_ranges, all_tokens_after_start
-            )
-        ]
-    )
-
-    return all_tokens_with_small_gap
+    return torch.cat(list(iter_tokens_small_gap(model, max_min_gap=max_min_gap)), dim=0)
 
 
 @torch.no_grad()
@@ -243,38 +374,27 @@ def logit_delta_small_gap_exhaustive(
     histogram_all_incorrect_logit_differences: bool = False,
     return_summary: bool = False,
     hist_args={},
+    batch_size: Optional[int] = None,
+    max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES,
 ) -> Union[float, Dict[str, Any]]:
     """
     Largest difference between logit(true_max) and logit(y) for y != true_max, with the constraint that some token z in the sequence satisfies true_max - max_min_gap <= z < true_max
+    Runs the model on batch_size sequences at a time (default: as many as fit in max_memory_bytes).
     Complexity: O(d_vocab ^ (n_ctx - 1) * (max_min_gap * 2 + 1) * fwd_pass)
     Complexity: fwd_pass = O(n_ctx * d_model + n_ctx * d_model + n_ctx * d_model^2 * d_hidden * 2 + n_ctx * d_hidden^2 + n_ctx * d_model^2 * d_hidden + n_ctx * d_hidden^2 * d_model + n_ctx * d_model + n_ctx * d_model^2 * d_vocab)
     Complexity: n_ctx^2 * d_vocab * d_model^2) + (n_ctx * d_vocab * d_model^2)
     todo fix complexity.
     """
-    n_ctx, d_vocab, d_vocab_out, d_model = (
-        model.cfg.n_ctx,
-        model.cfg.d_vocab,
-        model.cfg.d_vocab_out,
-        model.cfg.d_model,
-    )
-
-    all_tokens = all_tokens_small_gap(model, max_min_gap=max_min_gap)
-    assert (
-        len(all_tokens.shape) == 2 and all_tokens.shape[1] == n_ctx
-    ), f"all_tokens.shape = {all_tokens.shape} != (_, {n_ctx}) = (_, n_ctx)"
-    predicted_logits = model(all_tokens)[:, -1, :].detach().cpu()
-    assert (
-        len(predicted_logits.shape) == 2 and predicted_logits.shape[1] == d_vocab_out
-    ), f"predicted_logits.shape = {predicted_logits.shape} != (_, {d_vocab_out}) = (_, d_vocab_out)"
-
-    return logit_delta_of_results(
-        all_tokens=all_tokens,
-        predicted_logits=predicted_logits,
-        renderer=renderer,
-        histogram_all_incorrect_logit_differences=histogram_all_incorrect_logit_differences,
-        return_summary=return_summary,
-        hist_args=hist_args,
-    )
+    if batch_size is None:
+        batch_size = forward_pass_batch_size(model, max_memory_bytes)
+    return _accumulate_logit_deltas(
+        model,
+        iter_tokens_small_gap(model, max_min_gap=max_min_gap, batch_size=batch_size),
+        LogitDeltaAccumulator(
+            keep_values=return_summary,
+            keep_all_incorrect=histogram_all_incorrect_logit_differences,
+        ),
+    ).result(renderer=renderer, return_summary=return_summary, hist_args=hist_args)
 
 
 @torch.no_grad()
@@ -284,43 +404,36 @@ def logit_delta_by_gap(
     histogram_all_incorrect_logit_differences: bool = False,
     return_summary: bool = False,
     hist_args={},
+    batch_size: Optional[int] = None,
+    max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES,
 ) -> Dict[int, Union[float, Dict[str, Any]]]:
     """
     Largest difference between logit(true_max) and logit(y) for y != true_max, with the constraint that all non-max tokens in the sequence are strictly more than gap away from the true max, indexed by gap
+    Runs the model on batch_size sequences at a time (default: as many as fit in max_memory_bytes), keeping only the
+    running minimum for each gap unless a summary or histogram is requested.
     Complexity: O(d_vocab ^ n_ctx * fwd_pass)
     Complexity: fwd_pass = O(n_ctx * d_model + n_ctx * d_model + n_ctx * d_model^2 * d_hidden * 2 + n_ctx * d_hidden^2 + n_ctx * d_model^2 * d_hidden + n_ctx * d_hidden^2 * d_model + n_ctx * d_model + n_ctx * d_model^2 * d_vocab)
     Complexity: n_ctx^2 * d_vocab * d_model^2) + (n_ctx * d_vocab * d_model^2)
     todo fix complexity.
     """
-    n_ctx, d_vocab, d_vocab_out, d_model = (
-        model.cfg.n_ctx,
-        model.cfg.d_vocab,
-        model.cfg.d_vocab_out,
-        model.cfg.d_model,
+    d_vocab = model.cfg.d_vocab
+    if batch_size is None:
+        batch_size = forward_pass_batch_size(model, max_memory_bytes)
+    accumulator = _accumulate_logit_deltas(
+        model,
+        iter_all_sequences(
+            model.cfg.d_vocab, model.cfg.n_ctx, batch_size, device=model.W_E.device
+        ),
+        LogitDeltaAccumulator(
+            n_groups=d_vocab,
+            keep_values=return_summary,
+            keep_all_incorrect=histogram_all_incorrect_logit_differences,
+        ),
+        group_of=compute_gap,
     )
-
-    all_tokens = generate_all_sequences_for_model(model=model)
-    assert all_tokens.shape == (
-        d_vocab**n_ctx,
-        n_ctx,
-    ), f"all_tokens.shape = {all_tokens.shape} != {(d_vocab**n_ctx, n_ctx)} = (d_vocab**n_ctx, n_ctx)"
-    predicted_logits = model(all_tokens)[:, -1, :].detach().cpu()
-    assert predicted_logits.shape == (
-        all_tokens.shape[0],
-        d_vocab_out,
-    ), f"predicted_logits.shape = {predicted_logits.shape} != {(all_tokens.shape[0], d_vocab_out)} = (all_tokens.shape[0], d_vocab_out)"
-    gaps = compute_gap(all_tokens)
-    assert gaps.shape == (
-        all_tokens.shape[0],
-    ), f"gaps.shape = {gaps.shape} != {(all_tokens.shape[0],)} = (all_tokens.shape[0],)"
     return {
-        gap: logit_delta_of_results(
-            all_tokens=all_tokens[gaps == gap, :],
-            predicted_logits=predicted_logits[gaps == gap, :],
-            renderer=renderer,
-            histogram_all_incorrect_logit_differences=histogram_all_incorrect_logit_differences,
-            return_summary=return_summary,
-            hist_args=hist_args,
+        gap: accumulator.result(
+            gap, renderer=renderer, return_summary=return_summary, hist_args=hist_args
         )
         for gap in range(d_vocab)
     }
@@ -446,16 +559,141 @@ def worst_PVOU_gap_for(
         return worst_PVOU
 
 
+def _below_gap_extremes(
+    scores: Float[Tensor, "... d_vocab_k"],  # noqa: F722
+    largest_tok: Integer[Tensor, "d_vocab_max"],  # noqa: F821
+) -> Tuple[
+    Float[Tensor, "... d_vocab_max"], Float[Tensor, "... d_vocab_max"]  # noqa: F722
+]:
+    """
+    Returns the min and max of scores over key tokens <= largest_tok, for each entry of largest_tok; entries where
+    largest_tok < 0 are (inf, -inf)
+    """
+    d_vocab = scores.shape[-1]
+    index = largest_tok.clamp(0, d_vocab - 1).expand(*scores.shape[:-1], -1)
+    has_tokens = largest_tok >= 0
+    return (
+        torch.where(
+            has_tokens, scores.cummin(dim=-1).values.gather(-1, index), float("inf")
+        ),
+        torch.where(
+            has_tokens, scores.cummax(dim=-1).values.gather(-1, index), -float("inf")
+        ),
+    )
+
+
+def _valid_query_max_pairs(
+    query_toks: Integer[Tensor, "batch"], d_vocab: int, min_gap: int  # noqa: F821
+) -> Float[Tensor, "batch d_vocab_max"]:  # noqa: F722
+    """The (query_tok, max_tok) pairs filled in by all_worst_PVOU and all_worst_EVOU"""
+    max_toks = torch.arange(d_vocab, device=query_toks.device)
+    return (max_toks[None, :] == query_toks[:, None]) | (
+        max_toks[None, :] >= query_toks[:, None] + max(1, min_gap)
+    )
+
+
+@torch.no_grad()
+def worst_PVOU_for_queries(
+    query_toks: Integer[Tensor, "batch"],  # noqa: F821
+    PVOU: Float[Tensor, "n_ctx d_vocab_out"],  # noqa: F722
+    attention_score_map: Float[Tensor, "n_ctx_k d_vocab_q d_vocab_k"],  # noqa: F722
+    min_gap: int = 0,
+    optimize_max_query_comparison=True,
+) -> Float[Tensor, "batch d_vocab_max d_vocab_out"]:  # noqa: F722
+    """
+    Computes worst_PVOU_gap_for for every query token in query_toks and every max token at once, with nan for the
+    (query_tok, max_tok) pairs that all_worst_PVOU does not fill in.
+
+    The greedy choice of attention score for each position is made for all (query_tok, max_tok, non_max_output_tok)
+    at once, one position at a time.  Rather than recomputing the softmax after each choice, we keep the (unnormalized)
+    numerator and denominator of the softmax-weighted d_PVOU, relative to a fixed offset (the largest attention score
+    that can be chosen), and update them as each position's score is raised; this is done in float64, so that the
+    fixed offset does not cost precision.
+
+    Complexity: O(|query_toks| * d_vocab * d_vocab_out * n_ctx + d_vocab * d_vocab_out * n_ctx log(n_ctx))
+    """
+    n_ctx, d_vocab_out = PVOU.shape
+    _, d_vocab, _ = attention_score_map.shape
+    device = attention_score_map.device
+    max_toks = torch.arange(d_vocab, device=device)
+    scores = attention_score_map[:, query_toks, :].transpose(0, 1).double()
+    attention_to_query = scores[:, -1, :].gather(-1, query_toks[:, None])
+    # attention scores for the max token, and the extremes over the max token and tokens <= max_tok - min_gap
+    attention_to_max = scores[:, :-1, :]
+    min_below_gap, max_below_gap = _below_gap_extremes(
+        attention_to_max, max_toks - min_gap
+    )
+    min_attention_scores = torch.minimum(attention_to_max, min_below_gap)
+    max_attention_scores = torch.maximum(attention_to_max, max_below_gap)
+    if n_ctx == 2 and optimize_max_query_comparison:
+        # when query_tok != max_tok we know exactly what the sequence is
+        exact = (query_toks[:, None] != max_toks[None, :])[:, None, :]
+        min_attention_scores = torch.where(
+            exact, attention_to_max, min_attention_scores
+        )
+        max_attention_scores = torch.where(
+            exact, attention_to_max, max_attention_scores
+        )
+    min_attention_scores, max_attention_scores = (
+        min_attention_scores.transpose(1, 2),
+        max_attention_scores.transpose(1, 2),
+    )
+
+    d_PVOU: Float[Tensor, "d_vocab_max d_vocab_out n_ctx"]  # noqa: F722
+    d_PVOU = (PVOU.T[None, :, :] - PVOU.T[:d_vocab, None, :]).double()
+    # sort d_PVOU in descending order
+    _, d_PVOU_idxs = d_PVOU[..., :-1].sort(dim=-1, descending=True)
+
+    offset = torch.maximum(max_attention_scores.max(dim=-1).values, attention_to_query)
+    min_exp = (min_attention_scores - offset[..., None]).exp()
+    d_exp = (max_attention_scores - offset[..., None]).exp() - min_exp
+    query_exp = (attention_to_query - offset).exp()
+    denominator = (min_exp.sum(dim=-1) + query_exp)[..., None].expand(
+        -1, -1, d_vocab_out
+    )
+    numerator = (min_exp[:, :, None, :] * d_PVOU[None, :, :, :-1]).sum(
+        dim=-1
+    ) + query_exp[..., None] * d_PVOU[None, :, :, -1]
+    for i in d_PVOU_idxs.unbind(dim=-1):
+        # compare d_PVOU weighted by softmax with the attention score at position i at its min and at its max, and
+        # keep whichever one is worse (more positive), preferring the max on ties
+        d_exp_i = d_exp.gather(-1, i.expand(len(query_toks), -1, -1))
+        max_denominator = denominator + d_exp_i
+        max_numerator = numerator + d_exp_i * d_PVOU.gather(-1, i[..., None])[..., 0]
+        use_max = ~(numerator / denominator > max_numerator / max_denominator)
+        denominator = torch.where(use_max, max_denominator, denominator)
+        numerator = torch.where(use_max, max_numerator, numerator)
+
+    return torch.where(
+        _valid_query_max_pairs(query_toks, d_vocab, min_gap)[..., None],
+        (numerator / denominator).to(PVOU.dtype),
+        float("nan"),
+    )
+
+
+def _query_batch_size(bytes_per_query: int, max_memory_bytes: int) -> int:
+    """
+    Returns the number of query tokens per batch such that a few live tensors of bytes_per_query bytes per query
+    (roughly) fit in max_memory_bytes.
+    """
+    return max(1, max_memory_bytes // (4 * bytes_per_query))
+
+
 @torch.no_grad()
 def all_worst_PVOU(
-    model: HookedTransformer, min_gap: int = 0, tqdm=None, **kwargs
+    model: HookedTransformer,
+    min_gap: int = 0,
+    tqdm=None,
+    optimize_max_query_comparison=True,
+    query_batch_size: Optional[int] = None,
+    max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES,
 ) -> Float[Tensor, "d_vocab_q d_vocab_max d_vocab_out"]:  # noqa: F722
     """
     Returns the mixture of PVOUs with the worst (largest) value of PVOU[non_max_output_tok] - PVOU[max_tok], across all possible attention scalings for the query token and for token values <= max_tok - min_gap.
-    Complexity: O(PVOU + attention_score_map + n_ctx^2 * d_vocab^3)
-    Complexity: ~ O(n_ctx * d_vocab * d_model^2 (from PVOU) + d_vocab * d_head^2 * d_model * n_ctx (from attention_score_map) + (n_ctx * log(n_ctx) (sorting) + n_ctx^2) * d_vocab^3)
-    Complexity: (for n_ctx=2) O(PVOU + attention_score_map + n_ctx * d_vocab^2)
-    N.B. Clever caching could reduce n_ctx^2 to n_ctx, leaving n_ctx log(n_ctx) * d_vocab^3 from sorting as the dominant factor.
+    Equivalent to worst_PVOU_gap_for on every (query_tok, max_tok) pair, computed query_batch_size query tokens at a time (default: as many as fit in max_memory_bytes).
+    Complexity: O(PVOU + attention_score_map + n_ctx * d_vocab^3 + n_ctx log(n_ctx) * d_vocab^2)
+    Complexity: ~ O(n_ctx * d_vocab * d_model^2 (from PVOU) + d_vocab * d_head^2 * d_model * n_ctx (from attention_score_map) + n_ctx * d_vocab^3 + n_ctx * log(n_ctx) * d_vocab^2 (sorting))
+    Memory: O(query_batch_size * d_vocab^2 * n_ctx)
     N.B. for max_of_{two,three}, this is maybe? worse than exhaustive enumeration (oops)
     """
     local_tqdm = make_local_tqdm(tqdm)
@@ -475,22 +713,23 @@ def all_worst_PVOU(
         d_vocab,
         d_vocab,
     ), f"attention_scores.shape = {attention_score_map.shape} != {(n_ctx, d_vocab, d_vocab)} = (n_ctx, d_vocab, d_vocab)"
-    result = torch.zeros((d_vocab, d_vocab, d_vocab_out)) + float("nan")
-    for query_tok in local_tqdm(range(d_vocab), total=d_vocab):
-        for max_tok in [query_tok] + list(
-            range(query_tok + np.max([1, min_gap]), d_vocab)
-        ):
-            result[query_tok, max_tok, :] = worst_PVOU_gap_for(
-                model,
-                query_tok,
-                max_tok,
+    if query_batch_size is None:
+        query_batch_size = _query_batch_size(
+            d_vocab * d_vocab_out * n_ctx * PVOU.element_size(), max_memory_bytes
+        )
+    query_toks = torch.arange(d_vocab, device=attention_score_map.device)
+    return torch.cat(
+        [
+            worst_PVOU_for_queries(
+                query_toks_batch,
+                PVOU,
+                attention_score_map,
                 min_gap=min_gap,
-                PVOU=PVOU,
-                attention_score_map=attention_score_map,
-                **kwargs,
+                optimize_max_query_comparison=optimize_max_query_comparison,
             )
-
-    return result
+            for query_toks_batch in local_tqdm(query_toks.split(query_batch_size))
+        ]
+    )
 
 
 @torch.no_grad()
@@ -644,14 +883,153 @@ def worst_EVOU_gap_for(
         return EVOUs.max(dim=0).values
 
 
+@torch.no_grad()
+def worst_EVOU_for_queries(
+    query_toks: Integer[Tensor, "batch"],  # noqa: F821
+    EVOU: Float[Tensor, "d_vocab d_vocab_out"],  # noqa: F722
+    attention_score_map: Float[Tensor, "n_ctx_k d_vocab_q d_vocab_k"],  # noqa: F722
+    min_gap: int = 0,
+    optimize_max_query_comparison=True,
+) -> Float[Tensor, "batch d_vocab_max d_vocab_out"]:  # noqa: F722
+    """
+    Computes worst_EVOU_gap_for for every query token in query_toks and every max token at once, with nan for the
+    (query_tok, max_tok) pairs that all_worst_EVOU does not fill in.
+
+    For max_tok = query_tok = 0 with min_gap = 0, where there are no non-max tokens (and worst_EVOU_gap_for fails),
+    only the all-max row is considered.
+
+    Complexity: O(|query_toks| * d_vocab^2 * (n_ctx + d_vocab_out))
+    """
+    d_vocab, d_vocab_out = EVOU.shape
+    n_ctx, _, _ = attention_score_map.shape
+    device = attention_score_map.device
+    max_toks = torch.arange(d_vocab, device=device)
+    scores = attention_score_map[:, query_toks, :].transpose(0, 1)
+    attention_to_query = scores[:, -1, :].gather(-1, query_toks[:, None])
+    query_is_max = query_toks[:, None] == max_toks[None, :]
+    # the largest token that is not the max, and the largest attention to any such token in each position
+    max_nonmax_tok = torch.minimum(max_toks - 1, max_toks - min_gap)
+    _, max_attention_scores_without_max = _below_gap_extremes(
+        scores[:, :-1, :], max_nonmax_tok
+    )
+    max_attention_scores_without_max = max_attention_scores_without_max.transpose(1, 2)
+    attentions_to_max = scores[:, :-1, :].transpose(1, 2)
+    EVOU_query = EVOU[query_toks][:, None, None, :]
+    EVOU_max = EVOU[:d_vocab][None, :, None, :]
+
+    # the row where every key token is the max; we must subtract off the maximum to avoid overflow, as per https://github.com/pytorch/pytorch/blob/bc047ec906d8e1730e2ccd8192cef3c3467d75d1/aten/src/ATen/native/cpu/SoftMaxKernel.cpp#L115-L136
+    attention_offset = torch.maximum(
+        attentions_to_max.max(dim=-1).values, attention_to_query
+    )
+    attention_to_max_exp = (
+        (attentions_to_max - attention_offset[..., None]).exp().sum(dim=-1)
+    )
+    attention_to_query_exp = (attention_to_query - attention_offset).exp()
+    attention_sum = attention_to_max_exp + attention_to_query_exp
+    EVOUs_all_max = (
+        EVOU_max[:, :, 0] * attention_to_max_exp[..., None] / attention_sum[..., None]
+        + EVOU_query[:, :, 0]
+        * attention_to_query_exp[..., None]
+        / attention_sum[..., None]
+    )
+
+    # rows for each non-max token (indexed by non_max_tok in the third dimension); we relax attention to non-max,
+    # picking the attention to each slot from the min of largest attention to this token and largest attention to
+    # this slot
+    attention_to_max = attentions_to_max.min(dim=-1).values[..., None]
+    attention_to_query = attention_to_query[..., None]
+    max_attention_to_non_max = scores[:, :-1, :].max(dim=1).values[:, None, :, None]
+    attention_to_non_max = torch.minimum(
+        max_attention_to_non_max, max_attention_scores_without_max[:, :, None, :]
+    )
+    attention_offset = torch.maximum(
+        torch.where(
+            query_is_max[..., None],
+            attention_to_query,
+            torch.maximum(attention_to_max, attention_to_query),
+        ),
+        attention_to_non_max.max(dim=-1).values,
+    )
+    attention_to_non_max_exp = (
+        attention_to_non_max - attention_offset[..., None]
+    ).exp()
+    attention_to_non_max_exp = torch.where(
+        query_is_max[..., None],
+        attention_to_non_max_exp.sum(dim=-1),
+        # drop the smallest value in attention_to_non_max
+        attention_to_non_max_exp.sum(dim=-1)
+        - attention_to_non_max_exp.min(dim=-1).values,
+    )
+    attention_to_max_exp = torch.where(
+        query_is_max[..., None], 0, (attention_to_max - attention_offset).exp()
+    )
+    attention_to_query_exp = (attention_to_query - attention_offset).exp()
+    attention_sum = (
+        attention_to_non_max_exp + attention_to_query_exp + attention_to_max_exp
+    )
+    EVOUs = (
+        EVOU[None, None, :d_vocab, :]
+        * attention_to_non_max_exp[..., None]
+        / attention_sum[..., None]
+        + EVOU_query * attention_to_query_exp[..., None] / attention_sum[..., None]
+        + EVOU_max * attention_to_max_exp[..., None] / attention_sum[..., None]
+    )
+
+    # subtract off the max_tok EVOU, and take the worst row
+    index = max_toks[None, :, None].expand(len(query_toks), -1, 1)
+    EVOUs_all_max = EVOUs_all_max - EVOUs_all_max.gather(-1, index)
+    EVOUs = EVOUs - EVOUs.gather(-1, index[..., None].expand(-1, -1, d_vocab, -1))
+    EVOUs = torch.where(
+        (max_toks[None, :] <= max_nonmax_tok[:, None])[None, :, :, None],
+        EVOUs,
+        -float("inf"),
+    )
+    worst_EVOU = torch.maximum(EVOUs.max(dim=2).values, EVOUs_all_max)
+    # worst_EVOU_gap_for leaves the rows for tokens strictly between max_tok - min_gap and max_tok at zero
+    worst_EVOU = torch.where(
+        (max_nonmax_tok < max_toks - 1)[None, :, None],
+        worst_EVOU.clamp(min=0),
+        worst_EVOU,
+    )
+
+    if n_ctx == 2 and optimize_max_query_comparison:
+        # when query_tok != max_tok we know exactly what the sequence is
+        weights = torch.stack(
+            [attentions_to_max[..., 0], attention_to_query[..., 0].expand(-1, d_vocab)],
+            dim=-1,
+        ).softmax(dim=-1)
+        exact_EVOU = weights[..., :1] * EVOU_max[:, :, 0] + weights[..., 1:] * (
+            EVOU_query[:, :, 0]
+        )
+        exact_EVOU = exact_EVOU - exact_EVOU.gather(-1, index)
+        worst_EVOU = torch.where(~query_is_max[..., None], exact_EVOU, worst_EVOU)
+    # everything must be the max
+    all_max_EVOU = EVOU[:d_vocab] - EVOU[:d_vocab].gather(-1, max_toks[:, None])
+    worst_EVOU = torch.where(
+        (max_toks - min_gap < 0)[None, :, None], all_max_EVOU[None], worst_EVOU
+    )
+    return torch.where(
+        _valid_query_max_pairs(query_toks, d_vocab, min_gap)[..., None],
+        worst_EVOU,
+        float("nan"),
+    )
+
+
 @torch.no_grad()
 def all_worst_EVOU(
-    model: HookedTransformer, min_gap: int = 0, tqdm=None, **kwargs
+    model: HookedTransformer,
+    min_gap: int = 0,
+    tqdm=None,
+    optimize_max_query_comparison=True,
+    query_batch_size: Optional[int] = None,
+    max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES,
 ) -> Float[Tensor, "d_vocab_q d_vocab_max d_vocab_out"]:  # noqa: F722
     """
     Returns the mixture of EVOUs with the worst (largest) value of EVOU[non_max_output_tok] - EVOU[max_tok], across all possible attention scalings for the query token and for token values <= max_tok - min_gap.
+    Equivalent to worst_EVOU_gap_for on every (query_tok, max_tok) pair, computed query_batch_size query tokens at a time (default: as many as fit in max_memory_bytes).
     Complexity: O(EVOU + attention_score_map + (n_ctx + d_vocab) * d_vocab^3)
     Complexity: (for n_ctx=2) O(EVOU + attention_score_map + (n_ctx + d_vocab) * d_vocab^2)
+    Memory: O(query_batch_size * d_vocab^2 * (n_ctx + d_vocab_out))
     N.B. for max_of_{two,three}, this is maybe? worse than exhaustive enumeration (oops)
     """
     local_tqdm = make_local_tqdm(tqdm)
@@ -671,22 +1049,24 @@ def all_worst_EVOU(
         d_vocab,
         d_vocab,
     ), f"attention_scores.shape = {attention_score_map.shape} != {(n_ctx, d_vocab, d_vocab)} = (n_ctx, d_vocab, d_vocab)"
-    result = torch.zeros((d_vocab, d_vocab, d_vocab_out)) + float("nan")
-    for query_tok in local_tqdm(range(d_vocab), total=d_vocab):
-        for max_tok in [query_tok] + list(
-            range(query_tok + np.max([1, min_gap]), d_vocab)
-        ):
-            result[query_tok, max_tok, :] = worst_EVOU_gap_for(
-                model,
-                query_tok,
-                max_tok,
+    if query_batch_size is None:
+        query_batch_size = _query_batch_size(
+            d_vocab * d_vocab * (n_ctx + d_vocab_out) * EVOU.element_size(),
+            max_memory_bytes,
+        )
+    query_toks = torch.arange(d_vocab, device=attention_score_map.device)
+    return torch.cat(
+        [
+            worst_EVOU_for_queries(
+                query_toks_batch,
+                EVOU,
+                attention_score_map,
                 min_gap=min_gap,
-                EVOU=EVOU,
-                attention_score_map=attention_score_map,
-                **kwargs,
+                optimize_max_query_comparison=optimize_max_query_comparison,
             )
-
-    return result
+            for query_toks_batch in local_tqdm(query_toks.split(query_batch_size))
+        ]
+    )
 
 
 @dataclasses.dataclass
@@ -1035,24 +1415,28 @@ class LargestWrongLogitQuadraticConfig:
 
     def split_extreme_softmaxed_right_attention(
         self,
-        extreme_softmaxed_right_attention: Float[Tensor, "d_vocab_q"],  # noqa F821
+        extreme_softmaxed_right_attention: Float[Tensor, "... d_vocab_q"],  # noqa F722
         *,
-        max_tok: int,
-    ) -> Tuple[Float[Tensor, ""], Float[Tensor, "d_vocab_q"]]:  # noqa F821
+        max_tok: Optional[int] = None,
+        dim: int = -1,
+    ) -> Tuple[Float[Tensor, "..."], Float[Tensor, "... d_vocab_q"]]:  # noqa F722
         """
-        Returns (average_right_attention, right_attention_adjustment)
+        Returns (average_right_attention, right_attention_adjustment), averaging over the query dimension dim and
+        ignoring nan entries
 
         Postconditions:
-            average_right_attention is not nan, inf, -inf
+            average_right_attention is not nan, inf, -inf (unless every query is nan)
             average_right_attention + right_attention_adjustment = min_softmaxed_right_attention
         """
         average_right_attention = (
-            dropnan(extreme_softmaxed_right_attention).mean()
+            extreme_softmaxed_right_attention.nanmean(dim=dim)
             if self.attention_handling == "mean_query+diff"
-            else torch.zeros([]).to(extreme_softmaxed_right_attention)
+            else extreme_softmaxed_right_attention.new_zeros(()).expand(
+                extreme_softmaxed_right_attention.select(dim, 0).shape
+            )
         )
         right_attention_adjustment = (
-            extreme_softmaxed_right_attention - average_right_attention
+            extreme_softmaxed_right_attention - average_right_attention.unsqueeze(dim)
         )
         return average_right_attention, right_attention_adjustment
 
@@ -0,0 +1,166 @@
+import multiprocessing
+import resource
+
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from gbmi.exp_max_of_n.verification import (
+    all_tokens_small_gap,
+    all_worst_EVOU,
+    all_worst_PVOU,
+    compute_gap,
+    iter_tokens_small_gap,
+    logit_delta,
+    logit_delta_by_gap,
+    logit_delta_of_results,
+    worst_EVOU_gap_for,
+    worst_PVOU_gap_for,
+)
+from gbmi.utils.sequences import generate_all_sequences
+from gbmi.utils.testing import TestCase
+from gbmi.verification_tools.l1h1 import all_attention_scores, all_EVOU, all_PVOU
+
+
+def logit_delta_peak_memory(max_memory_bytes: int) -> int:
+    """Returns how far (in bytes) logit_delta raises this process's peak RSS above its peak before the call"""
+    torch.manual_seed(0)
+    cfg = HookedTransformerConfig(
+        n_layers=1,
+        d_model=32,
+        n_ctx=5,
+        d_head=32,
+        d_vocab=12,
+        d_mlp=128,
+        act_fn="relu",
+        device="cpu",
+    )
+    model = HookedTransformer(cfg)
+    # warm up with small batches, so that one-off allocations are not counted
+    logit_delta(model, max_memory_bytes=2**20)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    logit_delta(model, max_memory_bytes=max_memory_bytes)
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+
+
+class TestVerification(TestCase):
+    def test_all_worst_PVOU_EVOU_match_gap_for(self):
+        d_vocab = 7
+        for n_ctx in (2, 3, 4):
+            torch.manual_seed(n_ctx)
+            cfg = HookedTransformerConfig(
+                n_layers=1,
+                d_model=16,
+                n_ctx=n_ctx,
+                d_head=16,
+                d_vocab=d_vocab,
+                attn_only=True,
+                normalization_type=None,
+            )
+            model = HookedTransformer(cfg)
+            PVOU, EVOU = all_PVOU(model), all_EVOU(model)
+            attention_score_map = all_attention_scores(model)
+            for min_gap in (0, 1, 3):
+                all_PVOU_ = all_worst_PVOU(model, min_gap=min_gap, query_batch_size=3)
+                all_EVOU_ = all_worst_EVOU(
+                    model, min_gap=min_gap, max_memory_bytes=2**14
+                )
+                for query_tok in range(d_vocab):
+                    for max_tok in range(d_vocab):
+                        if max_tok != query_tok and max_tok < query_tok + max(
+                            1, min_gap
+                        ):
+                            self.assertTrue(all_PVOU_[query_tok, max_tok].isnan().all())
+                            self.assertTrue(all_EVOU_[query_tok, max_tok].isnan().all())
+                            continue
+                        msg = f"{(n_ctx, min_gap, query_tok, max_tok)}"
+                        # all_worst_PVOU reduces a batch of queries at once, so its
+                        # sums round in a different order than the per-query ones and
+                        # only agree up to float32 rounding, not bit for bit
+                        self.assertAllClose(
+                            all_PVOU_[query_tok, max_tok],
+                            worst_PVOU_gap_for(
+                                model,
+                                query_tok,
+                                max_tok,
+                                min_gap=min_gap,
+                                PVOU=PVOU,
+                                attention_score_map=attention_score_map,
+                            ),
+                            msg=msg,
+                            rtol=1e-5,
+                            atol=1e-6,
+                        )
+                        if max_tok == 0 and min_gap == 0:
+                            # worst_EVOU_gap_for has no non-max tokens to consider here
+                            continue
+                        self.assertAllClose(
+                            all_EVOU_[query_tok, max_tok],
+                            worst_EVOU_gap_for(
+                                model,
+                                query_tok,
+                                max_tok,
+                                min_gap=min_gap,
+                                EVOU=EVOU,
+                                attention_score_map=attention_score_map,
+                            ),
+                            msg=msg,
+                        )
+
+    def test_small_gap_and_by_gap_streaming(self):
+        d_vocab = 6
+        for n_ctx in (2, 3, 4):
+            torch.manual_seed(n_ctx)
+            cfg = HookedTransformerConfig(
+                n_layers=1,
+                d_model=16,
+                n_ctx=n_ctx,
+                d_head=8,
+                n_heads=2,
+                d_vocab=d_vocab,
+                d_mlp=12,
+                act_fn="relu",
+            )
+            model = HookedTransformer(cfg)
+            all_tokens = generate_all_sequences(d_vocab, n_ctx)
+            for max_min_gap in (1, 2):
+                actual = all_tokens_small_gap(model, max_min_gap=max_min_gap)
+                self.assertEqual(len(set(map(tuple, actual.tolist()))), actual.shape[0])
+                maxes = actual.max(dim=-1, keepdim=True).values
+                has_small_gap = (
+                    (actual < maxes) & (actual >= maxes - max_min_gap)
+                ).any(dim=-1)
+                # sequences whose first token ties the max of the rest are also included
+                first_ties_max = actual[:, 0] == actual[:, 1:].max(dim=-1).values
+                self.assertTrue((has_small_gap | first_ties_max).all())
+                self.assertTrue(
+                    torch.equal(
+                        torch.cat(
+                            list(
+                                iter_tokens_small_gap(
+                                    model, max_min_gap=max_min_gap, batch_size=7
+                                )
+                            )
+                        ),
+                        actual,
+                    )
+                )
+
+            predicted_logits = model(all_tokens)[:, -1, :]
+            gaps = compute_gap(all_tokens)
+            expected_by_gap = {
+                gap: logit_delta_of_results(
+                    all_tokens[gaps == gap], predicted_logits[gaps == gap]
+                )
+                for gap in range(d_vocab)
+            }
+            actual_by_gap = logit_delta_by_gap(model, batch_size=7)
+            self.assertEqual(actual_by_gap.keys(), expected_by_gap.keys())
+            for gap in expected_by_gap:
+                self.assertAllClose(actual_by_gap[gap], expected_by_gap[gap])
+
+    def test_logit_delta_stays_under_memory_cap(self):
+        # a fresh process, so that earlier tests do not hide the peak
+        max_memory_bytes = 2**26
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            peak = pool.apply(logit_delta_peak_memory, (max_memory_bytes,))
+        self.assertLess(peak, max_memory_bytes)
@@ -1,11 +1,14 @@
-from typing import Optional
+from dataclasses import dataclass, replace
+from typing import Iterator, Optional
 
 import torch
-from jaxtyping import Float
+from jaxtyping import Float, Integer
 from torch import Tensor
+from tqdm.auto import tqdm
 from transformer_lens import HookedTransformer
 
-import gbmi.utils.ein as ein
+import gbmi.utils as utils
+from gbmi.utils.sequences import generate_sequences_range
 from gbmi.verification_tools.general import EU_PU
 from gbmi.verification_tools.l1h1 import (
     all_attention_scores,
@@ -13,37 +16,36 @@ from gbmi.verification_tools.l1h1 import (
     all_PVOU_nocache,
 )
 
+DEFAULT_MAX_MEMORY_BYTES: int = 2**30
+
 
 @torch.no_grad()
 def run_model_cached(
     model: HookedTransformer,
-    inputs: Float[Tensor, "batch n_ctx"],  # noqa: F722
+    inputs: Integer[Tensor, "batch n_ctx"],  # noqa: F722
     *,
     cache: Optional[dict[str, Tensor]] = None,
-) -> Float[Tensor, "batch d_vocab"]:  # noqa: F722
+) -> Float[Tensor, "batch d_vocab_out"]:  # noqa: F722
     """
     Runs the model on the given inputs, caching matrices for amortized speedup
-    Complexity: O(|inputs| * n_ctx * d_vocab_out + d_vocab^2 * d_model + n_ctx * d_model * d_vocab)
+
+    Only the O(n_ctx * d_vocab^2) pre-softmax attention table and the O((d_vocab + n_ctx) * d_vocab_out) path
+    tables are cached, so the cache stays small even at d_vocab = 128.
+
+    Complexity: O(|inputs| * n_ctx * d_vocab_out + d_vocab^2 * d_model * n_ctx + (d_vocab + n_ctx) * d_model * d_vocab_out)
     """
     if cache is None:
         cache = {}
-    n_ctx, d_vocab = model.cfg.n_ctx, model.cfg.d_vocab
     attn_scale = model.blocks[0].attn.attn_scale
     all_attn: Float[Tensor, "n_ctx_k d_vocab_q d_vocab_k"]  # noqa: F722
-    all_attn_exp: Float[Tensor, "n_ctx_k d_vocab_max d_vocab_q d_vocab_k"]  # noqa: F722
     EVOU: Float[Tensor, "d_vocab d_vocab_out"]  # noqa: F722
     PVOU: Float[Tensor, "n_ctx d_vocab_out"]  # noqa: F722
     EUPU: Float[Tensor, "d_vocab_q d_vocab_out"]  # noqa: F722
-    if "attn_exp" not in cache:
-        all_attn = all_attention_scores(model, bias=True) / attn_scale
-        all_attn_exp = ein.array(
-            lambda pos, m, q, k: (all_attn[pos, q, k] - all_attn[pos, q, m]).exp(),
-            sizes=[n_ctx, d_vocab, d_vocab, d_vocab],
-            device=all_attn.device,
-        )
-        cache["attn_exp"] = all_attn_exp
-    else:
-        all_attn_exp = cache["attn_exp"]
+    all_attn = cache["attn"] = (
+        cache["attn"]
+        if "attn" in cache
+        else all_attention_scores(model, bias=True) / attn_scale
+    )
     EVOU = cache["EVOU"] = (
         cache["EVOU"] if "EVOU" in cache else all_EVOU_nocache(model, bias=True)
     )
@@ -53,27 +55,167 @@ def run_model_cached(
     EUPU = cache["EUPU"] = (
         cache["EUPU"] if "EUPU" in cache else EU_PU(model, bias=False)
     )
-    EPVOU_scaled: Float[Tensor, "n_ctx_k d_vocab_max d_vocab_q d_vocab_k"]  # noqa: F722
-    EPVOU_scaled = cache["EPVOU_scaled"] = (
-        cache["EPVOU_scaled"]
-        if "EPVOU_scaled" in cache
-        else ein.array(
-            lambda pos, max_tok, query_tok, key_tok: (
-                (EUPU[query_tok] + PVOU[pos] + EVOU[key_tok])
-                * all_attn_exp[pos, max_tok, query_tok, key_tok]
-            ),
-            sizes=[n_ctx, d_vocab, d_vocab, d_vocab],
-            device=all_attn.device,
-        )
+
+    inputs = inputs.to(all_attn.device)
+    positions = torch.arange(inputs.shape[-1], device=all_attn.device)
+    queries = inputs[..., -1]
+    attn: Float[Tensor, "batch n_ctx_k"]  # noqa: F722
+    attn = all_attn[positions, queries.unsqueeze(-1), inputs].softmax(dim=-1)
+    return (
+        EUPU[queries]
+        + attn @ PVOU
+        + torch.einsum("bk,bko->bo", attn, EVOU[inputs])  # noqa: F722
     )
 
-    maxes = inputs.amax(dim=-1, keepdim=True)
-    queries = inputs[..., -1].unsqueeze(-1)
-    sequences = torch.arange(n_ctx, device=EPVOU_scaled.device)
-    EPVOU_scaled_batch: Float[Tensor, "batch n_ctx_k d_vocab_out"]  # noqa: F722
-    EPVOU_scaled_batch = EPVOU_scaled[sequences, maxes, queries, inputs]
-    scale_factor: Float[Tensor, "batch 1"]  # noqa: F722
-    scale_factor = all_attn_exp[sequences, maxes, queries, inputs].sum(
-        dim=-1, keepdim=True
+
+@dataclass
+class BruteForceState:
+    """
+    Running totals of an exhaustive evaluation over all d_vocab^n_ctx sequences.
+
+    cursor is the index (in itertools.product order, as in generate_all_sequences) of the next sequence to evaluate,
+    so a partially-completed state can be saved and passed back to iter_brute_force to resume.
+    """
+
+    d_vocab: int
+    n_ctx: int
+    cursor: int = 0
+    loss_sum: float = 0.0
+    num_correct: int = 0
+    num_incorrect: int = 0
+
+    @property
+    def total_sequences(self) -> int:
+        return self.d_vocab**self.n_ctx
+
+    @property
+    def done(self) -> bool:
+        return self.cursor >= self.total_sequences
+
+    @property
+    def loss(self) -> float:
+        # nan until some sequence has been evaluated
+        return self.loss_sum / self.cursor if self.cursor else float("nan")
+
+    @property
+    def accuracy(self) -> float:
+        return self.num_correct / self.cursor if self.cursor else float("nan")
+
+
+def brute_force_batch_size(
+    model: HookedTransformer, max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES
+) -> int:
+    """
+    Returns the largest number of sequences per batch such that the per-batch working set
+    (tokens, attention, gathered EVOU rows, and logits) fits in max_memory_bytes.
+    """
+    n_ctx, d_vocab_out = model.cfg.n_ctx, model.cfg.d_vocab_out
+    element_size = model.W_E.element_size()
+    bytes_per_sequence = (
+        n_ctx * (8 + 2 * element_size + d_vocab_out * element_size)
+        + 3 * d_vocab_out * element_size
     )
-    return EPVOU_scaled_batch.sum(dim=-2) / scale_factor
+    return max(1, max_memory_bytes // bytes_per_sequence)
+
+
+def forward_pass_batch_size(
+    model: HookedTransformer, max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES
+) -> int:
+    """
+    Returns the largest number of sequences per batch such that a full model(tokens) forward pass fits in
+    max_memory_bytes: unlike run_model_cached, it holds the residual stream, the queries, keys, values, and
+    attention pattern, the MLP hidden layer, and the logits at every position.
+    """
+    cfg = model.cfg
+    d_mlp = 0 if cfg.attn_only or cfg.d_mlp is None else cfg.d_mlp
+    per_position = (
+        cfg.n_layers
+        * (
+            8 * cfg.d_model
+            + 4 * cfg.n_heads * cfg.d_head
+            + 2 * cfg.n_heads * cfg.n_ctx
+            + 4 * d_mlp
+        )
+        + 4 * cfg.d_vocab_out
+    )
+    bytes_per_sequence = cfg.n_ctx * per_position * model.W_E.element_size()
+    return max(1, max_memory_bytes // bytes_per_sequence)
+
+
+def iter_brute_force(
+    model: HookedTransformer,
+    *,
+    state: Optional[BruteForceState] = None,
+    batch_size: Optional[int] = None,
+    max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES,
+    stop: Optional[int] = None,
+    cache: Optional[dict[str, Tensor]] = None,
+    pbar: Optional[tqdm] = None,
+) -> Iterator[BruteForceState]:
+    """
+    Streams all d_vocab^n_ctx sequences through run_model_cached in index ranges, yielding the updated running
+    totals after every batch.  Sequences are generated directly from their indices, so nothing larger than a
+    single batch (plus the cached O(n_ctx * d_vocab^2) tables) is ever resident.
+
+    If batch_size is None, it is chosen from max_memory_bytes via brute_force_batch_size.
+    Evaluation starts from state.cursor (if given) and ends at stop (default: all sequences).
+
+    Complexity: O(d_vocab^n_ctx * n_ctx * d_vocab_out + d_vocab^2 * d_model * n_ctx)
+    """
+    n_ctx, d_vocab = model.cfg.n_ctx, model.cfg.d_vocab
+    if state is None:
+        state = BruteForceState(d_vocab=d_vocab, n_ctx=n_ctx)
+    assert (state.d_vocab, state.n_ctx) == (
+        d_vocab,
+        n_ctx,
+    ), f"state is for d_vocab={state.d_vocab}, n_ctx={state.n_ctx}, not d_vocab={d_vocab}, n_ctx={n_ctx}"
+    if batch_size is None:
+        batch_size = brute_force_batch_size(model, max_memory_bytes)
+    if cache is None:
+        cache = {}
+    stop = state.total_sequences if stop is None else min(stop, state.total_sequences)
+    device = model.W_E.device
+    while state.cursor < stop:
+        end = min(state.cursor + batch_size, stop)
+        xs = generate_sequences_range(d_vocab, n_ctx, state.cursor, end, device=device)
+        labels = xs.amax(dim=-1)
+        logits = run_model_cached(model, xs, cache=cache)
+        log_probs = utils.log_softmax(logits, dim=-1)
+        correct_log_probs = log_probs.gather(-1, labels.unsqueeze(-1)).squeeze(-1)
+        num_correct = int((logits.argmax(dim=-1) == labels).sum().item())
+        state = replace(
+            state,
+            cursor=end,
+            loss_sum=state.loss_sum - correct_log_probs.double().sum().item(),
+            num_correct=state.num_correct + num_correct,
+            num_incorrect=state.num_incorrect + (xs.shape[0] - num_correct),
+        )
+        if pbar is not None:
+            pbar.update(xs.shape[0])
+        yield state
+
+
+def brute_force(
+    model: HookedTransformer,
+    *,
+    state: Optional[BruteForceState] = None,
+    batch_size: Optional[int] = None,
+    max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES,
+    cache: Optional[dict[str, Tensor]] = None,
+    pbar: Optional[tqdm] = None,
+) -> BruteForceState:
+    """
+    Runs iter_brute_force to completion and returns the final totals
+    """
+    if state is None:
+        state = BruteForceState(d_vocab=model.cfg.d_vocab, n_ctx=model.cfg.n_ctx)
+    for state in iter_brute_force(
+        model,
+        state=state,
+        batch_size=batch_size,
+        max_memory_bytes=max_memory_bytes,
+        cache=cache,
+        pbar=pbar,
+    ):
+        pass
+    return state
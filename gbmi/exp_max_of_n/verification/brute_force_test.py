@@ -0,0 +1,60 @@
+import math
+
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from gbmi.exp_max_of_n.verification.brute_force import (
+    BruteForceState,
+    brute_force,
+    iter_brute_force,
+    run_model_cached,
+)
+from gbmi.utils.sequences import generate_all_sequences
+from gbmi.utils.testing import TestCase
+
+
+class TestBruteForce(TestCase):
+    def test_brute_force_matches_model(self):
+        torch.manual_seed(0)
+        cfg = HookedTransformerConfig(
+            n_layers=1,
+            attn_only=True,
+            d_vocab=8,
+            d_vocab_out=8,
+            n_ctx=4,
+            d_model=16,
+            d_head=16,
+            n_heads=1,
+            normalization_type=None,
+            device="cpu",
+        )
+        model = HookedTransformer(cfg)
+        xs = generate_all_sequences(cfg.d_vocab, cfg.n_ctx)
+        with torch.no_grad():
+            logits = model(xs)[:, -1]
+        self.assertAllClose(run_model_cached(model, xs), logits, atol=1e-5)
+
+        result = brute_force(model, batch_size=1000)
+        self.assertEqual(result.cursor, xs.shape[0])
+        self.assertEqual(
+            result.num_correct,
+            (logits.argmax(dim=-1) == xs.amax(dim=-1)).sum().item(),
+        )
+        self.assertAllClose(
+            torch.tensor(result.loss, dtype=torch.float64),
+            torch.nn.functional.cross_entropy(logits.double(), xs.amax(dim=-1)),
+            rtol=1e-6,
+        )
+
+        # resuming from a partial state gives the same totals
+        partial_state = next(iter_brute_force(model, batch_size=300))
+        self.assertEqual(partial_state.cursor, 300)
+        self.assertEqual(
+            brute_force(model, state=partial_state, max_memory_bytes=10**5),
+            result,
+        )
+
+    def test_empty_state(self):
+        state = BruteForceState(d_vocab=8, n_ctx=4)
+        self.assertTrue(math.isnan(state.loss))
+        self.assertTrue(math.isnan(state.accuracy))
@@ -15,7 +15,11 @@ from gbmi.utils.instructions import (
     PerfCollector,
     PerfCounter,
 )
-from gbmi.utils.sequences import count_sequences, count_sequences_instructions
+from gbmi.utils.sequences import (
+    count_sequences,
+    count_sequences_batched,
+    count_sequences_instructions,
+)
 from gbmi.verification_tools.general import EU_PU
 from gbmi.verification_tools.l1h1 import all_EQKE, all_EQKP, all_EVOU, all_PVOU
 from gbmi.verification_tools.utils import complexity_of
@@ -297,17 +301,224 @@ def compute_largest_wrong_logit_cubic(
     return results
 
 
+@torch.no_grad()
+def compute_largest_wrong_logit_cubic_batched(
+    extreme_softmaxed_right_attention: Float[
+        Tensor,
+        "minmax=2 attn=3 d_vocab_q d_vocab_max d_vocab_nonmax n_ctx_copies_nonmax",  # noqa: F722
+    ],
+    *,
+    EUPU: Float[Tensor, "d_vocab_q d_vocab_out"],  # noqa: F722
+    EVOU: Float[Tensor, "d_vocab_k d_vocab_out"],  # noqa: F722
+    PVOU: Float[Tensor, "n_ctx d_vocab_out"],  # noqa: F722
+    max_tok_batch_size: Optional[int] = None,
+) -> Float[
+    Tensor, "d_vocab_q d_vocab_max d_vocab_nonmax n_ctx_nonmax_copies"  # noqa: F722
+]:
+    r"""
+    Batched version of compute_largest_wrong_logit_cubic, with identical (bit-for-bit) output.
+
+    Rather than walking max_tok, nonmax_tok, n_copies_nonmax, and q_tok in Python, we fill in the result tensor
+    for max_tok_batch_size max tokens at a time with masked broadcast operations.
+
+    Complexity: O(d_vocab^3 * n_ctx^2)
+
+    Memory: O(max_tok_batch_size * d_vocab^2 * n_ctx) (all max tokens at once if max_tok_batch_size is None)
+
+    Preconditions and postconditions: as in compute_largest_wrong_logit_cubic
+    """
+    results = torch.zeros_like(
+        extreme_softmaxed_right_attention[0, 0, :, :, :, :]
+    ) + float("nan")
+    _, _, d_vocab, _, _, n_ctx = extreme_softmaxed_right_attention.shape
+    w_max = 0
+    w_nmx = 1
+    w_qry = 2
+    if max_tok_batch_size is None:
+        max_tok_batch_size = d_vocab
+    device = results.device
+    tok_range = torch.arange(d_vocab, device=device)
+    copies_range = torch.arange(n_ctx, device=device)
+
+    for start in range(0, d_vocab, max_tok_batch_size):
+        max_toks = tok_range[start : start + max_tok_batch_size]
+        cur_batch_size = max_toks.shape[0]
+        # The loop version recenters PVOU, EUPU, EVOU cumulatively, one max token
+        # at a time; we replay that here (O(d_vocab) tensor ops, no .item()) so that
+        # rounding matches exactly.
+        PVOUs, EUPUs, EVOUs = [], [], []
+        for max_tok in max_toks.tolist():
+            # N.B. recentering resumes from the last max token of the previous batch
+            PVOU = PVOU - PVOU[:, max_tok].unsqueeze(-1)
+            EUPU = EUPU - EUPU[:, max_tok].unsqueeze(-1)
+            EVOU = EVOU - EVOU[:, max_tok].unsqueeze(-1)
+            PVOUs.append(PVOU)
+            EUPUs.append(EUPU)
+            EVOUs.append(EVOU)
+        PVOU_m: Float[Tensor, "batch n_ctx d_vocab_out"] = torch.stack(  # noqa: F722
+            PVOUs
+        )
+        EUPU_m: Float[Tensor, "batch d_vocab_q d_vocab_out"] = torch.stack(
+            EUPUs
+        )  # noqa: F722
+        EVOU_m: Float[Tensor, "batch d_vocab_k d_vocab_out"] = torch.stack(
+            EVOUs
+        )  # noqa: F722
+        batch_idx = torch.arange(cur_batch_size, device=device)
+        # [batch, 1, d_vocab_out], True at the max token of each batch entry
+        is_max_out = (
+            torch.arange(EUPU_m.shape[-1], device=device)[None, :] == max_toks[:, None]
+        )[:, None, :]
+
+        PVOU_pessimized: Float[Tensor, "batch d_vocab_out"] = PVOU_m.max(  # noqa: F722
+            dim=1
+        ).values
+
+        # handle the case with only the max token
+        logits_only_max: Float[Tensor, "batch d_vocab_out"] = (  # noqa: F722
+            EUPU_m[batch_idx, max_toks, :]
+            + EVOU_m[batch_idx, max_toks, :]
+            + PVOU_pessimized
+        )
+        logits_only_max = logits_only_max - logits_only_max[
+            batch_idx, max_toks
+        ].unsqueeze(-1)
+        logits_only_max[batch_idx, max_toks] = float("-inf")
+        results[max_toks, max_toks, max_toks, 0] = logits_only_max.max(dim=-1).values
+
+        # now handle the cases with only the query token and n_ctx - 1 copies of the max token
+        cur_extreme_right_attention: Float[
+            Tensor, "minmax=2 attn=3 batch d_vocab_q"  # noqa: F722
+        ] = extreme_softmaxed_right_attention[:, :, :, max_toks, max_toks, 0].transpose(
+            -1, -2
+        )
+        logits_only_q_and_max: Float[
+            Tensor, "minmax=2 batch d_vocab_q d_vocab_out"  # noqa: F722
+        ] = (
+            EUPU_m
+            + PVOU_pessimized[:, None, :]
+            + EVOU_m[batch_idx, max_toks, :][:, None, :]
+            * cur_extreme_right_attention[:, w_max, :, :, None]
+            + EVOU_m * cur_extreme_right_attention[:, w_qry, :, :, None]
+        )
+        logits_only_q_and_max = logits_only_q_and_max - logits_only_q_and_max.gather(
+            -1,
+            max_toks[None, :, None, None].expand(*logits_only_q_and_max.shape[:-1], 1),
+        )
+        logits_only_q_and_max = logits_only_q_and_max.masked_fill(
+            is_max_out[None], float("-inf")
+        )
+        q_and_max_results: Float[Tensor, "batch d_vocab_q"] = (  # noqa: F722
+            logits_only_q_and_max.amax(dim=(0, -1))
+        )
+        is_q_below_max = tok_range[None, :] < max_toks[:, None]
+        q_idx, b_idx = torch.where(is_q_below_max.T)
+        results[q_idx, max_toks[b_idx], max_toks[b_idx], 0] = q_and_max_results[
+            b_idx, q_idx
+        ]
+
+        # precompose pessimization for EUPU over output logit
+        EUPU_per_query_pessimized: Float[Tensor, "batch d_vocab_q"] = (  # noqa: F722
+            EUPU_m.masked_fill(is_max_out, float("-inf")).max(dim=-1).values
+        )
+        # distribute PVOU over EVOU, to avoid premature pessimization
+        EPVOU_per_key_pessimized: Float[Tensor, "batch d_vocab_k"] = (  # noqa: F722
+            (EVOU_m + PVOU_pessimized[:, None, :])
+            .masked_fill(is_max_out, float("-inf"))
+            .max(dim=-1)
+            .values
+        )
+        right_attention_wrong_logits: Float[Tensor, "batch"] = (  # noqa: F821
+            EPVOU_per_key_pessimized[batch_idx, max_toks]
+        )
+
+        # now handle the cases with at least one non-max non-query token
+        # [minmax=2, d_vocab_q, batch, d_vocab_nonmax, n_ctx]
+        right_attn = extreme_softmaxed_right_attention[:, w_max, :, max_toks]
+        q_attn = extreme_softmaxed_right_attention[:, w_qry, :, max_toks]
+        wrong_attn = extreme_softmaxed_right_attention[:, w_nmx, :, max_toks]
+        nonmax_results: Float[
+            Tensor, "d_vocab_q batch d_vocab_nonmax n_ctx"  # noqa: F722
+        ] = (
+            EUPU_per_query_pessimized.T[:, :, None, None]
+            + (
+                right_attn * right_attention_wrong_logits[None, None, :, None, None]
+                + q_attn * EPVOU_per_key_pessimized.T[None, :, :, None, None]
+                + wrong_attn * EPVOU_per_key_pessimized[None, None, :, :, None]
+            )
+            .max(dim=0)
+            .values
+        )
+        q_toks = tok_range[:, None, None, None]
+        nonmax_toks = tok_range[None, None, :, None]
+        n_copies_nonmax = copies_range[None, None, None, :]
+        cur_max_toks = max_toks[None, :, None, None]
+        valid = (
+            (q_toks <= cur_max_toks)
+            & (nonmax_toks < cur_max_toks)
+            & (n_copies_nonmax >= 1)
+            & ((q_toks == cur_max_toks) | (n_copies_nonmax < n_ctx - 1))
+        )
+        results[:, max_toks] = torch.where(valid, nonmax_results, results[:, max_toks])
+    return results
+
+
+@torch.no_grad()
+def count_correct_sequences_cubic_batched(
+    largest_wrong_logit: Float[
+        Tensor, "d_vocab_q d_vocab_max d_vocab_nonmax n_ctx_nonmax_copies"  # noqa: F722
+    ],
+) -> int:
+    """
+    Loop-free version of count_correct_sequences_cubic on tensors, with identical output.
+
+    We count the permitted non-max tokens for every (q_tok, max_tok, n_copies_nonmax) at once, and then reduce
+    the counts to an exact integer with count_sequences_batched.
+    """
+    d_vocab_q, d_vocab_max, d_vocab_nonmax, n_ctx = largest_wrong_logit.shape
+    device = largest_wrong_logit.device
+    q_toks = torch.arange(d_vocab_q, device=device)[:, None, None]
+    max_toks = torch.arange(d_vocab_max, device=device)[None, :, None]
+    n_copies_nonmax = torch.arange(n_ctx, device=device)[None, None, :]
+    valid = (q_toks <= max_toks) & (
+        (q_toks == max_toks) | (n_copies_nonmax < n_ctx - 1)
+    )
+    # nan < 0 is False, so this also excludes invalid entries
+    correct = largest_wrong_logit < 0
+
+    # only max tokens (and possibly the query) in the sequence
+    max_idx = torch.arange(min(d_vocab_max, d_vocab_nonmax), device=device)
+    only_max_correct = correct[:, max_idx, max_idx, 0] & valid[:, max_idx, 0]
+    correct_count = int(only_max_correct.sum().item())
+
+    # consider wrong logits only when non-max token is less than max token
+    nonmax_below_max = (
+        torch.arange(d_vocab_nonmax, device=device)[None, :]
+        < torch.arange(d_vocab_max, device=device)[:, None]
+    )[None, :, :, None]
+    num_nonmax_tok_choices = (correct & nonmax_below_max).sum(dim=2)
+    valid_nonmax = valid & (n_copies_nonmax > 0)
+    correct_count += count_sequences_batched(
+        n_ctx - 1,
+        n_copies_nonmax.expand_as(valid_nonmax)[valid_nonmax],
+        num_nonmax_tok_choices[valid_nonmax],
+    )
+    return correct_count
+
+
 @overload
 def count_correct_sequences_cubic(
     largest_wrong_logit: Float[
         Tensor, "d_vocab_q d_vocab_max d_vocab_nonmax n_ctx_nonmax_copies"  # noqa: F722
     ],
+    batched: bool = True,
 ) -> int: ...
 
 
 @overload
 def count_correct_sequences_cubic(
     largest_wrong_logit: CountTensor,
+    batched: bool = True,
 ) -> CountTensor: ...
 
 
@@ -320,7 +531,15 @@ def count_correct_sequences_cubic(
         ],
         CountTensor,
     ],
+    batched: bool = True,
 ) -> Union[int, CountTensor]:
+    """
+    Counts the sequences that largest_wrong_logit certifies as correct.
+
+    If batched is True (and we are not counting instructions), we defer to count_correct_sequences_cubic_batched.
+    """
+    if batched and not isinstance(largest_wrong_logit, CountTensor):
+        return count_correct_sequences_cubic_batched(largest_wrong_logit)
     d_vocab_q, d_vocab_max, d_vocab_nonmax, n_ctx = largest_wrong_logit.shape
     correct_count: Union[int, CountTensor] = (
         0
@@ -420,6 +639,7 @@ def verify_proof(
     sanity_check: bool = True,
     pbar: Optional[tqdm] = None,
     include_perf: bool = False,
+    max_tok_batch_size: Optional[int] = None,
 ):
     print_thunk = lambda x: print(x())
     if isinstance(print_complexity, bool):
@@ -498,12 +718,24 @@ def verify_proof(
 
     largest_wrong_logit_cubic: Float[
         Tensor, "d_vocab_q d_vocab_max d_vocab_nonmax n_ctx_nonmax_copies"  # noqa: F722
-    ] = add_time(
-        compute_largest_wrong_logit_cubic,
-        extreme_right_attention_softmaxed_cubic,
-        EUPU=EUPU,
-        EVOU=EVOU,
-        PVOU=PVOU,
+    ] = (
+        add_time(
+            compute_largest_wrong_logit_cubic,
+            extreme_right_attention_softmaxed_cubic,
+            EUPU=EUPU,
+            EVOU=EVOU,
+            PVOU=PVOU,
+        )
+        # instruction counting tracks the reference loop implementation
+        if isinstance(EUPU, CountTensor)
+        else add_time(
+            compute_largest_wrong_logit_cubic_batched,
+            extreme_right_attention_softmaxed_cubic,
+            EUPU=EUPU,
+            EVOU=EVOU,
+            PVOU=PVOU,
+            max_tok_batch_size=max_tok_batch_size,
+        )
     )
     print_types(
         lambda: f"type(largest_wrong_logit_cubic) == {type(largest_wrong_logit_cubic)}"
@@ -0,0 +1,53 @@
+import torch
+from tqdm.auto import tqdm
+
+from gbmi.exp_max_of_n.verification.cubic import (
+    compute_extreme_softmaxed_right_attention_cubic_simple,
+    compute_largest_wrong_logit_cubic,
+    compute_largest_wrong_logit_cubic_batched,
+    count_correct_sequences_cubic,
+)
+from gbmi.utils.testing import TestCase
+
+
+class TestCubic(TestCase):
+    def test_largest_wrong_logit_batched_matches_loop(self):
+        generator = torch.Generator().manual_seed(0)
+        for d_vocab, n_ctx in [(1, 2), (5, 2), (7, 4), (9, 5)]:
+            EQKE = torch.randn(d_vocab, d_vocab, generator=generator) * 3
+            EQKP = torch.randn(d_vocab, n_ctx, generator=generator)
+            extreme_attention = compute_extreme_softmaxed_right_attention_cubic_simple(
+                EQKE, EQKP, 2.0, pbar=tqdm(disable=True)
+            )
+            kwargs = dict(
+                EUPU=torch.randn(d_vocab, d_vocab, generator=generator),
+                EVOU=torch.randn(d_vocab, d_vocab, generator=generator),
+                PVOU=torch.randn(n_ctx, d_vocab, generator=generator),
+            )
+            expected = compute_largest_wrong_logit_cubic(extreme_attention, **kwargs)
+            for max_tok_batch_size in (None, 1, 3):
+                actual = compute_largest_wrong_logit_cubic_batched(
+                    extreme_attention, max_tok_batch_size=max_tok_batch_size, **kwargs
+                )
+                self.assertTrue(
+                    torch.equal(actual.isnan(), expected.isnan()),
+                    msg=f"nan mismatch for {(d_vocab, n_ctx, max_tok_batch_size)}",
+                )
+                self.assertTrue(
+                    torch.equal(actual.nan_to_num(), expected.nan_to_num()),
+                    msg=f"value mismatch for {(d_vocab, n_ctx, max_tok_batch_size)}",
+                )
+
+    def test_count_correct_sequences_batched_matches_loop(self):
+        generator = torch.Generator().manual_seed(0)
+        for d_vocab, n_ctx in [(1, 1), (3, 2), (6, 4), (16, 5)]:
+            largest_wrong_logit = torch.randn(
+                d_vocab, d_vocab, d_vocab, n_ctx, generator=generator
+            )
+            largest_wrong_logit[
+                torch.rand(largest_wrong_logit.shape, generator=generator) < 0.1
+            ] = float("nan")
+            self.assertEqual(
+                count_correct_sequences_cubic(largest_wrong_logit),
+                count_correct_sequences_cubic(largest_wrong_logit, batched=False),
+            )
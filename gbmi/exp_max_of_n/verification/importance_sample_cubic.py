@@ -1,5 +1,5 @@
 import time
-from functools import partial
+from functools import lru_cache, partial
 from itertools import combinations
 from typing import Iterable, Literal, Optional, Tuple
 
@@ -14,6 +14,9 @@ from gbmi.exp_max_of_n.verification.brute_force import run_model_cached
 from gbmi.utils import batched
 from gbmi.utils.sequences import count_sequences, generate_all_sequences
 
+# number of sequences drawn at once by sample_include_all_keys_batches, independent of the batch size
+SAMPLE_CHUNK_SIZE = 2**16
+
 
 def probability_mass_for(
     n_ctx: int,
@@ -59,7 +62,7 @@ def sample(
         seq = torch.full((n_ctx,), max_tok, dtype=torch.long)
         seq[-1] = query_tok
         if max_tok == 0 or num_copies_nonmax == 0:
-            yield seq.to(device=device), 1.0 / nsequences
+            yield seq.to(device=device), ((1.0 / nsequences) if normalize_weight else 1)
             nsamples += 1
             continue
 
@@ -172,10 +175,265 @@ def sample_include_all_keys(
                 )
 
 
+def _randint_below(
+    high: Integer[Tensor, "..."],
+    *,
+    generator: Optional[torch.Generator] = None,
+) -> Integer[Tensor, "..."]:
+    """Draws one integer uniformly from [0, high) for each entry of high (which must be positive)"""
+    draws = torch.rand(high.shape, generator=generator, dtype=torch.float64)
+    return (draws * high).long().minimum(high - 1)
+
+
+def _fill_sequences(
+    n_ctx: int,
+    max_tok: Integer[Tensor, "batch"],  # noqa: F821
+    query_tok: Integer[Tensor, "batch"],  # noqa: F821
+    num_copies_nonmax: Integer[Tensor, "batch"],  # noqa: F821
+    largest_nonmax_tok: Integer[Tensor, "batch"],  # noqa: F821
+    *,
+    generator: Optional[torch.Generator] = None,
+) -> Integer[Tensor, "batch n_ctx"]:  # noqa: F722
+    """
+    Draws one sequence for each key, distributed as in sample: num_copies_nonmax - 1 tokens uniformly at most
+    largest_nonmax_tok, one copy of largest_nonmax_tok, max_tok everywhere else, shuffled, followed by query_tok.
+    """
+    batch = len(max_tok)
+    pos = torch.arange(n_ctx - 1)
+    other_tokens = _randint_below(
+        (largest_nonmax_tok.clamp(min=0) + 1)[:, None].expand(batch, n_ctx - 1),
+        generator=generator,
+    )
+    seqs = torch.where(
+        pos < num_copies_nonmax[:, None] - 1,
+        other_tokens,
+        torch.where(
+            pos == num_copies_nonmax[:, None] - 1,
+            largest_nonmax_tok[:, None],
+            max_tok[:, None],
+        ),
+    )
+    perm = torch.rand(batch, n_ctx - 1, generator=generator).argsort(dim=-1)
+    return torch.cat([seqs.gather(-1, perm), query_tok[:, None]], dim=-1)
+
+
+@lru_cache(maxsize=None)
+def _count_sequences_weights(
+    n_ctx: int, d_vocab: int
+) -> Float[Tensor, "n_ctx d_vocab"]:  # noqa: F722
+    """table[c, t] == count_sequences(n_ctx - 1, c, t + 1, nonmax_strict=True) for c > 0 and 1 for c == 0"""
+    return torch.tensor(
+        [
+            [
+                count_sequences(n_ctx - 1, c, t + 1, nonmax_strict=True) if c else 1
+                for t in range(d_vocab)
+            ]
+            for c in range(n_ctx)
+        ],
+        dtype=torch.float64,
+    )
+
+
+def sample_batches(
+    n_ctx: int,
+    d_vocab: int,
+    batch_size: int,
+    max_samples: Optional[int] = None,
+    *,
+    generator: Optional[torch.Generator] = None,
+    device: Optional[str | torch.device] = None,
+    normalize_weight: bool = True,
+) -> Iterable[
+    Tuple[Integer[Tensor, "batch n_ctx"], Float[Tensor, "batch"]]  # noqa: F722
+]:
+    """
+    Batched version of sample: draws the keys and sequences for batch_size samples at a time with tensor ops, and
+    yields them with their weights (float64).  The draws depend only on the generator state and batch_size.
+    """
+    nsequences = d_vocab**n_ctx
+    weight_table = _count_sequences_weights(n_ctx, d_vocab)
+    nsamples = 0
+    while max_samples is None or nsamples < max_samples:
+        batch = (
+            batch_size
+            if max_samples is None
+            else min(batch_size, max_samples - nsamples)
+        )
+        max_tok = torch.randint(0, d_vocab, (batch,), generator=generator)
+        query_tok = _randint_below(max_tok + 1, generator=generator)
+        num_copies_nonmax = _randint_below(
+            torch.where(max_tok == query_tok, n_ctx, n_ctx - 1), generator=generator
+        )
+        num_copies_nonmax[max_tok == 0] = 0
+        largest_nonmax_tok = _randint_below(max_tok.clamp(min=1), generator=generator)
+        largest_nonmax_tok[num_copies_nonmax == 0] = -1
+        seqs = _fill_sequences(
+            n_ctx,
+            max_tok,
+            query_tok,
+            num_copies_nonmax,
+            largest_nonmax_tok,
+            generator=generator,
+        )
+        weights = weight_table[num_copies_nonmax, largest_nonmax_tok.clamp(min=0)]
+        if normalize_weight:
+            weights = weights / nsequences
+        yield seqs.to(device), weights.to(device)
+        nsamples += batch
+
+
+def all_keys_cubic_batched(
+    n_ctx: int,
+    d_vocab: int,
+) -> Iterable[Integer[Tensor, "num_keys 4"]]:  # noqa: F722
+    """
+    Yields all_keys_cubic as tensors, one per max token, with -1 standing in for a largest nonmax token of None.
+    """
+    for max_tok in range(d_vocab):
+        query_tok, num_copies_nonmax, largest_nonmax_tok = (
+            x.flatten()
+            for x in torch.meshgrid(
+                torch.arange(max_tok + 1),
+                torch.arange(n_ctx),
+                torch.arange(-1, max_tok),
+                indexing="ij",
+            )
+        )
+        degenerate = (num_copies_nonmax == 0) | (max_tok == 0)
+        valid = (
+            num_copies_nonmax
+            < torch.where(
+                torch.tensor(max_tok == 0),
+                1,
+                torch.where(query_tok == max_tok, n_ctx, n_ctx - 1),
+            )
+        ) & torch.where(degenerate, largest_nonmax_tok == -1, largest_nonmax_tok >= 0)
+        yield torch.stack(
+            [
+                torch.full_like(query_tok, max_tok),
+                query_tok,
+                num_copies_nonmax,
+                largest_nonmax_tok,
+            ],
+            dim=-1,
+        )[valid]
+
+
+@lru_cache(maxsize=None)
+def _all_nonmax_patterns(
+    n_ctx: int, num_copies_nonmax: int, largest_nonmax_tok: int
+) -> Integer[Tensor, "count n_ctx_minus_1"]:  # noqa: F722
+    """
+    Returns all count_sequences(n_ctx - 1, num_copies_nonmax, largest_nonmax_tok + 1, nonmax_strict=True) placements
+    of nonmax tokens among the first n_ctx - 1 positions, with -1 marking the positions holding the max token.
+    """
+    positions = torch.tensor(
+        list(combinations(range(n_ctx - 1), num_copies_nonmax)), dtype=torch.long
+    )
+    tokens = generate_all_sequences(largest_nonmax_tok + 1, num_copies_nonmax)
+    tokens = tokens[(tokens == largest_nonmax_tok).any(dim=-1)]
+    shape = (len(positions), len(tokens), num_copies_nonmax)
+    return (
+        torch.full((len(positions), len(tokens), n_ctx - 1), -1, dtype=torch.long)
+        .scatter_(-1, positions[:, None].expand(shape), tokens[None].expand(shape))
+        .flatten(0, 1)
+    )
+
+
+def sample_include_all_keys_batches(
+    n_ctx: int,
+    d_vocab: int,
+    nsamples_per_key: int,
+    batch_size: Optional[int] = None,
+    *,
+    generator: Optional[torch.Generator] = None,
+    device: Optional[str | torch.device] = None,
+    normalize_weight: bool = True,
+) -> Iterable[
+    Tuple[Integer[Tensor, "batch n_ctx"], Float[Tensor, "batch"]]  # noqa: F722
+]:
+    """
+    Batched version of sample_include_all_keys: yields the same multiset of (sequence, weight) pairs for the keys that
+    are enumerated exhaustively, and identically distributed draws for the others, in batches of batch_size (default:
+    everything at once) sequences with their weights (float64).
+
+    The keys are processed in chunks of about SAMPLE_CHUNK_SIZE sequences, so the draws depend only on the generator
+    state, not on batch_size.
+    """
+    nsequences = d_vocab**n_ctx
+    weight_table = _count_sequences_weights(n_ctx, d_vocab)
+    keys_per_chunk = max(1, SAMPLE_CHUNK_SIZE // max(1, nsamples_per_key))
+
+    def chunks() -> Iterable[Tuple[Tensor, Tensor]]:
+        for keys in all_keys_cubic_batched(n_ctx, d_vocab):
+            for key_chunk in keys.split(keys_per_chunk):
+                max_tok, query_tok, num_copies_nonmax, largest_nonmax_tok = key_chunk.T
+                seq_count = weight_table[
+                    num_copies_nonmax, largest_nonmax_tok.clamp(min=0)
+                ]
+                exhaustive = (seq_count <= nsamples_per_key) | (num_copies_nonmax == 0)
+                for num_copies, largest in (
+                    key_chunk[exhaustive, 2:].unique(dim=0).tolist()
+                ):
+                    group = key_chunk[
+                        exhaustive
+                        & (num_copies_nonmax == num_copies)
+                        & (largest_nonmax_tok == largest)
+                    ]
+                    if num_copies == 0:
+                        patterns = torch.full((1, n_ctx - 1), -1)
+                    else:
+                        patterns = _all_nonmax_patterns(n_ctx, num_copies, largest)
+                    seqs = torch.where(
+                        patterns[None] == -1, group[:, None, :1], patterns[None]
+                    ).flatten(0, 1)
+                    seqs = torch.cat(
+                        [seqs, group[:, 1].repeat_interleave(len(patterns))[:, None]],
+                        dim=-1,
+                    )
+                    yield seqs, torch.ones(len(seqs), dtype=torch.float64)
+                sampled = key_chunk[~exhaustive].repeat_interleave(
+                    nsamples_per_key, dim=0
+                )
+                if len(sampled):
+                    seqs = _fill_sequences(n_ctx, *sampled.T, generator=generator)
+                    yield seqs, seq_count[~exhaustive].repeat_interleave(
+                        nsamples_per_key
+                    ) / nsamples_per_key
+
+    for seqs, weights in rebatch(chunks(), batch_size):
+        if normalize_weight:
+            weights = weights / nsequences
+        yield seqs.to(device), weights.to(device)
+
+
+def rebatch(
+    chunks: Iterable[Tuple[Tensor, Tensor]], batch_size: Optional[int] = None
+) -> Iterable[Tuple[Tensor, Tensor]]:
+    """
+    Re-splits a stream of (xs, weights) chunks of varying lengths into batches of exactly batch_size (default:
+    everything at once), except possibly the last
+    """
+    pending: list[Tuple[Tensor, Tensor]] = []
+    num_pending = 0
+    for xs, weights in chunks:
+        pending.append((xs, weights))
+        num_pending += len(xs)
+        while batch_size is not None and num_pending >= batch_size:
+            xs = torch.cat([x for x, _ in pending])
+            weights = torch.cat([w for _, w in pending])
+            yield xs[:batch_size], weights[:batch_size]
+            pending = [(xs[batch_size:], weights[batch_size:])]
+            num_pending -= batch_size
+    if num_pending:
+        yield torch.cat([x for x, _ in pending]), torch.cat([w for _, w in pending])
+
+
 @torch.no_grad()
-def importance_sample_model_batch(
+def importance_sample_model_tensors(
     model: HookedTransformer,
-    samples: Iterable[Tuple[Float[Tensor, "n_ctx"], float]],  # noqa: F821
+    xs: Integer[Tensor, "batch n_ctx"],  # noqa: F722
+    weights: Float[Tensor, "batch"],  # noqa: F821
     *,
     cache: Optional[dict[str, Tensor]] = None,
     device: Optional[str | torch.device] = None,
@@ -190,23 +448,20 @@ def importance_sample_model_batch(
 ]:
     """returns total_weight, unnormalized_loss, unnormalized_accuracy, num_correct, num_incorrect, incorrect_sequences, duration"""
     start = time.time()
-    samples = list(samples)
-    xs: Float[Tensor, "batch n_ctx"]  # noqa: F722
     labels: Integer[Tensor, "batch"]  # noqa: F821
-    weights: Float[Tensor, "batch"]  # noqa: F821
     logits: Float[Tensor, "batch d_vocab"]  # noqa: F722
-    xs = torch.stack([sample for sample, _ in samples], dim=0).to(device)
+    xs = xs.to(device)
     labels = xs.amax(dim=-1)
-    weights = torch.tensor([weight for _, weight in samples], device=device)
     if device is not None:
         model.to(device, print_details=False)
     logits = run_model_cached(model, xs, cache=cache)
     log_probs = utils.log_softmax(logits, dim=-1)
-    correct_log_probs = log_probs.gather(-1, labels.unsqueeze(-1)).squeeze()
+    weights = weights.to(device=log_probs.device, dtype=log_probs.dtype)
+    correct_log_probs = log_probs.gather(-1, labels.unsqueeze(-1)).squeeze(-1)
     full_accuracy = labels == logits.argmax(dim=-1)
     total_weight = weights.sum().item()
     unnormalized_loss = -correct_log_probs.dot(weights).item()
-    unnormalized_accuracy = full_accuracy.float().dot(weights).item()
+    unnormalized_accuracy = full_accuracy.to(weights.dtype).dot(weights).item()
     incorrect_sequences = xs[~full_accuracy]
     num_correct = len(xs) - len(incorrect_sequences)
     num_incorrect = len(incorrect_sequences)
@@ -222,6 +477,38 @@ def importance_sample_model_batch(
     )
 
 
+@torch.no_grad()
+def importance_sample_model_batch(
+    model: HookedTransformer,
+    samples: Iterable[Tuple[Float[Tensor, "n_ctx"], float]],  # noqa: F821
+    *,
+    cache: Optional[dict[str, Tensor]] = None,
+    device: Optional[str | torch.device] = None,
+) -> Tuple[
+    float,
+    float,
+    float,
+    int,
+    int,
+    Integer[Tensor, "batch n_ctx"],  # noqa: F722
+    float,
+]:
+    """returns total_weight, unnormalized_loss, unnormalized_accuracy, num_correct, num_incorrect, incorrect_sequences, duration"""
+    xs, weights = _stack_samples(samples)
+    return importance_sample_model_tensors(
+        model, xs, weights, cache=cache, device=device
+    )
+
+
+def _stack_samples(
+    samples: Iterable[Tuple[Float[Tensor, "n_ctx"], float]],  # noqa: F821
+) -> Tuple[Integer[Tensor, "batch n_ctx"], Float[Tensor, "batch"]]:  # noqa: F722
+    samples = list(samples)
+    return torch.stack([sample for sample, _ in samples], dim=0), torch.tensor(
+        [weight for _, weight in samples]
+    )
+
+
 @torch.no_grad()
 def importance_sample_model(
     model: HookedTransformer,
@@ -242,6 +529,40 @@ def importance_sample_model(
     ],
     Tensor | int | float,
 ]:
+    sample_batches = (
+        batched(samples, batch_size) if batch_size is not None else [samples]
+    )
+    return importance_sample_model_batches(
+        model,
+        map(_stack_samples, sample_batches),
+        cache=cache,
+        device=device,
+        pbar=pbar,
+    )
+
+
+@torch.no_grad()
+def importance_sample_model_batches(
+    model: HookedTransformer,
+    batches: Iterable[
+        Tuple[Integer[Tensor, "batch n_ctx"], Float[Tensor, "batch"]]  # noqa: F722
+    ],
+    *,
+    cache: Optional[dict[str, Tensor]] = None,
+    device: Optional[str | torch.device] = None,
+    pbar: Optional[tqdm] = None,
+) -> dict[
+    Literal[
+        "loss",
+        "accuracy",
+        "num_correct",
+        "num_incorrect",
+        "incorrect_sequences",
+        "duration",
+    ],
+    Tensor | int | float,
+]:
+    """Runs the model on each batch of (sequences, weights) as it is produced, and accumulates the weighted results"""
     total_weight = 0.0
     unnormalized_loss = 0.0
     unnormalized_accuracy = 0.0
@@ -249,12 +570,9 @@ def importance_sample_model(
     num_incorrect = 0
     incorrect_sequences_list = []
     start = time.time()
-    sample_batches = (
-        batched(samples, batch_size) if batch_size is not None else [samples]
-    )
     if cache is None:
         cache = {}
-    for sample_batch in sample_batches:
+    for xs, weights in batches:
         if pbar is not None:
             pbar.update(1)
         (
@@ -265,8 +583,8 @@ def importance_sample_model(
             cur_num_incorrect,
             cur_incorrect_sequences,
             _cur_duration,
-        ) = importance_sample_model_batch(
-            model, sample_batch, cache=cache, device=device
+        ) = importance_sample_model_tensors(
+            model, xs, weights, cache=cache, device=device
         )
         total_weight += cur_total_weight
         unnormalized_loss += cur_unnormalized_loss
@@ -314,6 +632,7 @@ def importance_sample(
     normalize_weight: bool = True,
     pbar: Optional[tqdm] = None,
     seed: Optional[int] = None,
+    batched_sampling: bool = False,
 ) -> dict[
     Literal[
         "loss",
@@ -325,10 +644,43 @@ def importance_sample(
     ],
     Tensor | int | float,
 ]:
+    """
+    Estimates the loss and accuracy of model by importance sampling.
+
+    If batched_sampling, the samples are drawn batch_size at a time by sample_batches /
+    sample_include_all_keys_batches and streamed straight into the model; the results are then reproducible for a
+    fixed seed (and, for an int nsamples, batch_size), but differ from those of the one-at-a-time samplers.
+    """
     if seed is not None:
         torch.manual_seed(seed)
         if generator is not None:
             generator.manual_seed(seed)
+    if batched_sampling:
+        if isinstance(nsamples, int):
+            batches = sample_batches(
+                model.cfg.n_ctx,
+                model.cfg.d_vocab,
+                batch_size if batch_size is not None else nsamples,
+                nsamples,
+                generator=generator,
+                device=device,
+                normalize_weight=normalize_weight,
+            )
+        else:
+            nsamples_per_key, _per_key = nsamples
+            assert _per_key == "per_key", f"{_per_key} is not 'per_key'"
+            batches = sample_include_all_keys_batches(
+                model.cfg.n_ctx,
+                model.cfg.d_vocab,
+                nsamples_per_key,
+                batch_size,
+                generator=generator,
+                device=device,
+                normalize_weight=normalize_weight,
+            )
+        return importance_sample_model_batches(
+            model, batches, cache=cache, device=device, pbar=pbar
+        )
     if isinstance(nsamples, int):
         samples = sample(
             model.cfg.n_ctx,
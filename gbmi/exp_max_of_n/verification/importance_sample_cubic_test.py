@@ -0,0 +1,100 @@
+from collections import Counter
+
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from gbmi.exp_max_of_n.verification.brute_force import brute_force
+from gbmi.exp_max_of_n.verification.importance_sample_cubic import (
+    importance_sample,
+    sample_batches,
+    sample_include_all_keys,
+    sample_include_all_keys_batches,
+)
+from gbmi.utils.sequences import count_sequences
+from gbmi.utils.testing import TestCase
+
+
+class TestImportanceSampleCubic(TestCase):
+    def test_include_all_keys_batches(self):
+        n_ctx, d_vocab = 4, 6
+        expected = Counter(
+            (tuple(x.tolist()), w)
+            for x, w in sample_include_all_keys(n_ctx, d_vocab, 10**9)
+        )
+        batches = list(sample_include_all_keys_batches(n_ctx, d_vocab, 10**9, 37))
+        self.assertTrue(all(len(xs) == 37 for xs, _ in batches[:-1]))
+        actual = Counter(
+            (tuple(x), w)
+            for xs, weights in batches
+            for x, w in zip(xs.tolist(), weights.tolist())
+        )
+        self.assertEqual(actual, expected)
+        self.assertEqual(len(actual), d_vocab**n_ctx)
+
+        # every key carries its full probability mass, however few samples it gets
+        draw = lambda batch_size: list(
+            sample_include_all_keys_batches(
+                6, 9, 3, batch_size, generator=torch.Generator().manual_seed(0)
+            )
+        )
+        self.assertAllClose(
+            sum(weights.sum() for _, weights in draw(100)),
+            torch.tensor(1.0, dtype=torch.float64),
+        )
+        self.assertTrue(
+            torch.cat([xs for xs, _ in draw(100)]).equal(
+                torch.cat([xs for xs, _ in draw(7)])
+            )
+        )
+
+    def test_sample_batches(self):
+        draw = lambda: list(
+            sample_batches(6, 9, 64, 200, generator=torch.Generator().manual_seed(0))
+        )
+        batches = draw()
+        self.assertEqual([len(xs) for xs, _ in batches], [64, 64, 64, 8])
+        for (xs, weights), (xs2, weights2) in zip(batches, draw()):
+            self.assertTrue(xs.equal(xs2) and weights.equal(weights2))
+        xs = torch.cat([xs for xs, _ in batches])
+        max_tok = xs.amax(dim=-1)
+        self.assertTrue((xs[:, -1] <= max_tok).all())
+        # the weight is the probability mass of the key, which is determined by the sequence
+        for x, w in zip(xs.tolist(), torch.cat([w for _, w in batches]).tolist()):
+            nonmax = [t for t in x[:-1] if t != max(x)]
+            count = (
+                count_sequences(5, len(nonmax), max(nonmax) + 1, nonmax_strict=True)
+                if nonmax
+                else 1
+            )
+            self.assertEqual(w, count / 9**6)
+
+    def test_importance_sample_exhaustive(self):
+        torch.manual_seed(0)
+        cfg = HookedTransformerConfig(
+            n_layers=1,
+            attn_only=True,
+            d_vocab=6,
+            d_vocab_out=6,
+            n_ctx=4,
+            d_model=16,
+            d_head=16,
+            n_heads=1,
+            normalization_type=None,
+            device="cpu",
+        )
+        model = HookedTransformer(cfg)
+        expected = brute_force(model)
+        for batched_sampling in (False, True):
+            result = importance_sample(
+                model,
+                (10**9, "per_key"),
+                batch_size=100,
+                batched_sampling=batched_sampling,
+            )
+            self.assertEqual(result["num_correct"], expected.num_correct)
+            self.assertEqual(result["num_incorrect"], expected.num_incorrect)
+            self.assertAllClose(
+                torch.tensor(result["loss"]),
+                torch.tensor(expected.loss, dtype=torch.float32),
+                rtol=1e-4,
+            )
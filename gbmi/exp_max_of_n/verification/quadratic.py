@@ -8,8 +8,9 @@ from torch import Tensor
 from transformer_lens import HookedTransformer
 
 from gbmi.exp_max_of_n.verification import LargestWrongLogitQuadraticConfig
+from gbmi.utils.instructions import CountTensor
 from gbmi.utils.lowrank import LowRankTensor
-from gbmi.utils.sequences import count_sequences
+from gbmi.utils.sequences import count_sequences, count_sequences_batched
 from gbmi.verification_tools.decomp import factor_contribution
 
 
@@ -611,6 +612,50 @@ def count_unaccounted_for_by_gap(
     return unaccounted_for
 
 
+@torch.no_grad()
+def count_correct_sequences_batched(
+    largest_wrong_logit: Float[
+        Tensor, "d_vocab_q d_vocab_max n_ctx_nonmax_copies"  # noqa: F722
+    ],
+    min_gap: Union[
+        int, Integer[Tensor, "d_vocab_q d_vocab_max n_ctx_nonmax_copies"]  # noqa: F722
+    ] = 1,
+) -> int:
+    """
+    Loop-free version of count_correct_sequences, with identical output.
+    """
+    d_vocab_q, d_vocab_max, n_ctx = largest_wrong_logit.shape
+    device = largest_wrong_logit.device
+    q_toks = torch.arange(d_vocab_q, device=device)[:, None, None]
+    max_toks = torch.arange(d_vocab_max, device=device)[None, :, None]
+    n_copies_nonmax = torch.arange(n_ctx, device=device)[None, None, :]
+    if isinstance(min_gap, int):
+        min_gap = torch.full_like(largest_wrong_logit, min_gap, dtype=torch.long)
+    else:
+        min_gap = min_gap.to(device).long()
+    # nan < 0 is False, which also catches nans
+    valid = (
+        (largest_wrong_logit < 0)
+        & (q_toks <= max_toks)
+        & ~((q_toks != max_toks) & (n_copies_nonmax == 0))
+        & ~((q_toks != max_toks) & (max_toks - q_toks < min_gap))
+        & ~((max_toks == 0) & (n_copies_nonmax > 0))
+    )
+    # N.B. Here, n_copies_nonmax DOES include the query token when it's not equal to max_tok
+    nonmax_pre_query_count = torch.where(
+        q_toks != max_toks, n_copies_nonmax - 1, n_copies_nonmax
+    ).expand_as(valid)
+    correct_count = int((valid & (nonmax_pre_query_count == 0)).sum().item())
+    # count the number of sequences of length n_ctx - 1 with nonmax_pre_query_count tokens less than or equal to max_tok - cur_min_gap and the remaining tokens equal to max_tok, where order matters
+    valid &= nonmax_pre_query_count != 0
+    correct_count += count_sequences_batched(
+        n_ctx - 1,
+        nonmax_pre_query_count[valid],
+        (max_toks - min_gap)[valid],
+    )
+    return correct_count
+
+
 @torch.no_grad()
 def count_correct_sequences(
     largest_wrong_logit: Float[
@@ -619,7 +664,10 @@ def count_correct_sequences(
     min_gap: Union[
         int, Integer[Tensor, "d_vocab_q d_vocab_max n_ctx_nonmax_copies"]  # noqa: F722
     ] = 1,
+    batched: bool = True,
 ) -> int:
+    if batched and not isinstance(largest_wrong_logit, CountTensor):
+        return count_correct_sequences_batched(largest_wrong_logit, min_gap=min_gap)
     d_vocab_q, d_vocab_max, n_ctx = largest_wrong_logit.shape
     correct_count = 0
     for q_tok in range(d_vocab_q):
@@ -222,8 +222,9 @@ class ModularFineTuningDataModule(DataModule):
         # concat a special token of value self.config.experiment.p to the end of each sequence for '='
         equals_token = self.config.experiment.p
         data = torch.cat(
-            [pairs, equals_token * torch.ones((len(pairs), 1))], dim=1
-        ).long()
+            [pairs, torch.full((len(pairs), 1), equals_token, dtype=pairs.dtype)],
+            dim=1,
+        )
         data = shuffle_data(data, rng)
 
         split_idx = int(len(data) * self.config.experiment.training_ratio)
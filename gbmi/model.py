@@ -57,6 +57,7 @@ from gbmi.utils import (
 )
 from gbmi.utils.hashing import _EXCLUDE, _json_dumps, get_hash
 from gbmi.utils.lazy import lazy
+from gbmi.utils.model_store import ModelStore, atomic_write
 
 ConfigT = TypeVar("ConfigT")
 ExpT = TypeVar("ExpT", bound="ExperimentConfig")
@@ -143,7 +144,7 @@ class Config(Generic[ExpT]):
     def get_summary_slug(self):
         return self.experiment.get_summary_slug(self)
 
-    def get_id(self):
+    def get_id(self, legacy_tensor_hash: bool = False):
         config_summary_slug = self.get_summary_slug()
         config_hash = get_hash(
             self,
@@ -152,6 +153,7 @@ class Config(Generic[ExpT]):
                     ["device"] if isinstance(obj, HookedTransformerConfig) else None
                 )
             ),
+            legacy_tensor_hash=legacy_tensor_hash,
         ).hex()
         return f"{config_summary_slug}-{config_hash}"
 
@@ -462,6 +464,7 @@ def _load_model(
     *,
     map_location: Optional[str | torch.device] = None,
     print_details: bool = True,
+    mmap: bool = False,
 ) -> Tuple[RunData, HookedTransformer]:
     model = config.experiment.get_training_wrapper().build_model(config)
     if map_location is not None:
@@ -472,6 +475,7 @@ def _load_model(
         cached_data = torch.load(
             str(model_pth_path),
             map_location=map_location,
+            mmap=mmap,
         )
         model.load_state_dict(
             cached_data.get(
@@ -508,13 +512,22 @@ def try_load_model_from_wandb_download(
     *,
     map_location: Optional[str | torch.device] = None,
     print_details: bool = True,
+    mmap: bool = False,
+    on_load: Optional[Callable[[Path], None]] = None,
 ) -> Optional[Tuple[RunData, HookedTransformer]]:
+    """on_load, if given, is called with the path of the checkpoint that was loaded"""
     model_dir = Path(model_dir)
     for model_path in list(model_dir.glob("*.pth")) + list(model_dir.glob("*.ckpt")):
         res = _load_model(
-            config, model_path, map_location=map_location, print_details=print_details
+            config,
+            model_path,
+            map_location=map_location,
+            print_details=print_details,
+            mmap=mmap,
         )
         if res is not None:
+            if on_load is not None:
+                on_load(model_path)
             return res
     return None
 
@@ -525,6 +538,8 @@ def try_load_model_from_wandb(
     *,
     map_location: Optional[str | torch.device] = None,
     print_details: bool = True,
+    mmap: bool = False,
+    on_load: Optional[Callable[[Path], None]] = None,
 ) -> Optional[Tuple[RunData, HookedTransformer]]:
     # Try loading the model from wandb
     model_dir = None
@@ -536,7 +551,12 @@ def try_load_model_from_wandb(
         logging.warning(f"Could not download model {wandb_model_path} from wandb:\n{e}")
     if model_dir is not None:
         return try_load_model_from_wandb_download(
-            config, model_dir, map_location=map_location, print_details=print_details
+            config,
+            model_dir,
+            map_location=map_location,
+            print_details=print_details,
+            mmap=mmap,
+            on_load=on_load,
         )
     else:
         return None
@@ -556,6 +576,8 @@ def train_or_load_model(
     *,
     map_location: Optional[str | torch.device] = None,
     print_details: bool = True,
+    mmap: bool = False,
+    model_store: Optional[ModelStore] = None,
 ) -> Tuple[RunData, HookedTransformer]:
     """
     Train model, or load from disk / wandb.
@@ -570,6 +592,10 @@ def train_or_load_model(
     @param model_description: Description to provide for WandB project
     @param accelerator: Accelerator to use (cpu or auto)
     @param model_version: Version of model to load from wandb (must be "latest" if force != "load")
+    @param mmap: Whether to memory-map checkpoints when loading them from disk
+    @param model_store: Local registry of checkpoints by config id (defaults to one in PROJECT_ROOT / trained_models);
+    when loading the latest version, its newest checkpoint is tried before wandb, and saved / downloaded checkpoints are
+    recorded in it
     @return:
     """
     # Seed everything
@@ -584,8 +610,11 @@ def train_or_load_model(
     # Set model save path if not provided
     datetime_str = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     run_name = f"{model_name}-{datetime_str}"
+    if model_store is None:
+        model_store = ModelStore(get_trained_model_dir(create=True))
+    explicit_model_ckpt_path = model_ckpt_path is not None
     if model_ckpt_path is None:
-        model_ckpt_path = get_trained_model_dir(create=True) / f"{run_name}.pth"
+        model_ckpt_path = model_store.path_for(run_name)
     model_ckpt_dir_path = Path(model_ckpt_path).parent
 
     # Set wandb project if not provided
@@ -600,12 +629,19 @@ def train_or_load_model(
     # If we aren't forcing a re-train:
     if force != "train":
         # Try loading the model locally
-        if os.path.exists(model_ckpt_path):
+        local_ckpt_path: Optional[Path] = None
+        if explicit_model_ckpt_path:
+            if os.path.exists(model_ckpt_path):
+                local_ckpt_path = Path(model_ckpt_path)
+        elif model_version == "latest":
+            local_ckpt_path = model_store.newest(model_name)
+        if local_ckpt_path is not None:
             res = _load_model(
                 config,
-                model_ckpt_path,
+                local_ckpt_path,
                 map_location=map_location,
                 print_details=print_details,
+                mmap=mmap,
             )
             if res is not None:
                 return res
@@ -615,6 +651,13 @@ def train_or_load_model(
             wandb_model_path,
             map_location=map_location,
             print_details=print_details,
+            mmap=mmap,
+            # remember the download, so that next time we don't need to ask wandb
+            on_load=(
+                (lambda path: model_store.register(model_name, path))
+                if model_version == "latest"
+                else None
+            ),
         )
         if res2 is not None:
             return res2
@@ -739,7 +782,8 @@ def train_or_load_model(
         }
         if overwrite_existing_ckpt or not os.path.exists(model_ckpt_path):
             print("Saving to disk...")
-            torch.save(data, model_ckpt_path)
+            atomic_write(model_ckpt_path, lambda path: torch.save(data, path))
+            model_store.register(model_name, model_ckpt_path)
 
         if run is not None:
             print("Saving to WandB...")
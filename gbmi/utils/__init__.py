@@ -51,6 +51,11 @@ from gbmi.utils.dataclass import dataclass_map
 from gbmi.utils.hashing import get_hash
 
 PROJECT_ROOT = Path(__file__).parent.parent.parent
+# where generated data (n-gram tables, Cayley tables, ...) is cached; override with $GBMI_CACHE_DIR
+CACHE_ROOT = Path(
+    os.environ.get("GBMI_CACHE_DIR")
+    or Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "gbmi"
+)
 DEFAULT_WANDB_ENTITY = "gbmi"
 
 A = TypeVar("A")
@@ -393,6 +398,16 @@ def dropnan(x: Tensor) -> Tensor:
     return x[~torch.isnan(x)]
 
 
+def masked_max(x: Tensor, mask: Tensor, dim: int) -> Tensor:
+    """The max of x over dim, among the entries where mask (broadcast against x) holds; -inf if there are none"""
+    return x.masked_fill(~mask, -torch.inf).amax(dim=dim)
+
+
+def masked_min(x: Tensor, mask: Tensor, dim: int) -> Tensor:
+    """The min of x over dim, among the entries where mask (broadcast against x) holds; inf if there are none"""
+    return x.masked_fill(~mask, torch.inf).amin(dim=dim)
+
+
 def map_values(f: Callable[[V], T], d: dict[K, V]) -> dict[K, T]:
     return {k: f(v) for k, v in d.items()}
 
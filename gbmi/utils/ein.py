@@ -1,18 +1,28 @@
 from __future__ import annotations
 
 import hashlib
-import io
-import pickle
+from collections import OrderedDict
 from contextlib import contextmanager
 from functools import partial
 from inspect import signature
-from typing import Callable, Dict, Generic, List, Optional, Set, TypeVar, Union
+from types import BuiltinFunctionType, CodeType, FunctionType, ModuleType
+from typing import (
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
-import dill
 import torch
 from functorch.dim import Dim
 from functorch.dim import Tensor as DTensor
-from functorch.dim import dims
 from torch import Tensor
 
 TensorLike = Union[Tensor, DTensor]
@@ -35,37 +45,124 @@ class ContextualCache(Generic[U, V]):
             yield self.cache
 
 
-tensor_cache: ContextualCache[str, TensorLike] = ContextualCache()
-
-
-def lambda_hash(thing: object) -> str:
-    # TODO: speed up
-    class Pickler(dill.Pickler):
-        def reducer_override(self, obj):
-            if isinstance(obj, DTensor):
-                return pickle.loads, (
-                    pickle.dumps(
-                        obj.order(*obj.dims),
-                    ),
+tensor_cache: ContextualCache[Hashable, Tuple[List[object], TensorLike]] = (
+    ContextualCache()
+)
+# the size and device inferred by tracing each expression, keyed by expression_key(..., by_value=True), so that
+# evaluating the same expression again on tensors with the same contents skips the tracing pass (the traced size can
+# depend on values, e.g. through a boolean mask); the least recently used
+# entries are evicted beyond EXPRESSION_CACHE_MAX_SIZE
+EXPRESSION_CACHE_MAX_SIZE = 1024
+expression_cache: OrderedDict[Hashable, Tuple[Optional[int], torch.device]] = (
+    OrderedDict()
+)
+
+
+class _Unkeyable(Exception):
+    pass
+
+
+def _global_names(code: CodeType) -> Iterator[str]:
+    # the names code may look up as globals, including from the nested functions and lambdas it defines
+    yield from code.co_names
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            yield from _global_names(const)
+
+
+def _digest(tensor: Tensor) -> bytes:
+    data = tensor.detach().contiguous().flatten().view(torch.uint8).cpu()
+    return hashlib.sha1(data.numpy().tobytes()).digest()
+
+
+def expression_key(
+    thing: object, *, by_value: bool = False, refs: Optional[List[object]] = None
+) -> Optional[Hashable]:
+    """
+    Returns a hashable key for thing, computed structurally rather than by serializing it: lambdas and nested functions
+    are keyed by their code object together with the keys of their defaults, closure cells, and the globals they (or
+    the functions nested in them) name;
+    tensors by identity and version counter; dims by identity and size.
+
+    If by_value, tensors are keyed by type, shape, dtype, device, and a digest of their contents and dims by size
+    instead, and None is returned if thing depends on any object that can only be keyed by identity.  Otherwise, every object keyed by identity is
+    appended to refs, so that keeping refs alive keeps the key from being reused.
+    """
+    refs = [] if refs is None else refs
+    # the order in which each container or function was first visited, so that repeated references are keyed by
+    # position rather than by id
+    seen: Dict[int, int] = {}
+
+    def by_identity(obj: object) -> Hashable:
+        if by_value:
+            raise _Unkeyable
+        refs.append(obj)
+        return ("id", id(obj))
+
+    def key(obj: object) -> Hashable:
+        if obj is None or isinstance(
+            obj, (bool, int, float, complex, str, bytes, torch.dtype, torch.device)
+        ):
+            return (type(obj), obj)
+        if isinstance(obj, Dim):
+            size = obj.size if obj.is_bound else None
+            return ("dim", size) if by_value else ("dim", by_identity(obj), size)
+        if isinstance(obj, DTensor):
+            if by_value:
+                return (
+                    "dtensor",
+                    tuple(d.size for d in obj.dims),
+                    obj.ndim,
+                    obj.dtype,
+                    obj.device,
+                    _digest(obj._tensor),
                 )
-            if isinstance(obj, torch.Tensor):
-                if "BatchedTensor" in repr(obj):
-                    return pickle.loads, (
-                        pickle.dumps(torch._C._functorch.get_unwrapped(obj)),
-                    )
-                return NotImplemented
-            if isinstance(obj, Dim):
-                # TODO: we're losing data here... pass int through if it exists.
-                return pickle.loads, (None,)
-            return NotImplemented
-
-    def dumps(obj):
-        f = io.BytesIO()
-        p = Pickler(f)
-        p.dump(obj)
-        return f.getvalue()
-
-    return hashlib.md5(dumps(thing)).hexdigest()
+            return ("dtensor", by_identity(obj))
+        if isinstance(obj, Tensor):
+            if by_value:
+                return (
+                    type(obj),
+                    tuple(obj.shape),
+                    obj.dtype,
+                    obj.device,
+                    _digest(obj),
+                )
+            return ("tensor", by_identity(obj), obj._version)
+        if isinstance(obj, ModuleType):
+            return ("module", obj.__name__)
+        if isinstance(obj, (type, BuiltinFunctionType)):
+            return obj
+        if id(obj) in seen:
+            return ("seen", seen[id(obj)])
+        seen[id(obj)] = len(seen)
+        if isinstance(obj, (tuple, list)):
+            return (type(obj), tuple(key(x) for x in obj))
+        if isinstance(obj, dict):
+            return (type(obj), tuple((key(k), key(v)) for k, v in obj.items()))
+        if isinstance(obj, partial):
+            return ("partial", key(obj.func), key(obj.args), key(obj.keywords))
+        if isinstance(obj, FunctionType) and "<" not in obj.__qualname__:
+            # module-level named functions are keyed by reference, as dill pickles them
+            return obj
+        if isinstance(obj, FunctionType):
+            code = obj.__code__
+            return (
+                code,
+                key(obj.__defaults__),
+                key(obj.__kwdefaults__),
+                tuple(key(cell.cell_contents) for cell in obj.__closure__ or ()),
+                tuple(
+                    (name, key(obj.__globals__[name]))
+                    for name in dict.fromkeys(_global_names(code))
+                    if name in obj.__globals__
+                ),
+            )
+        return by_identity(obj)
+
+    try:
+        return key(thing)
+    except _Unkeyable:
+        return None
 
 
 class ConstraintTrackingTensor(Tensor):
@@ -112,30 +209,42 @@ def _apply_single_dim(
     device=None,
 ) -> TensorLike:
     # no_dim is called if the dim we're 'iterating' over isn't in the returned expression
-    c: Dict[str, TensorLike]
+    c: Dict[Hashable, Tuple[List[object], TensorLike]]
     with tensor_cache.access() as c:
-        key = lambda_hash((f, collect, no_dim, hash(size)))
+        refs: List[object] = []
+        key = expression_key((f, collect, no_dim, size, device), refs=refs)
         if key in c:
-            return c[key]
-
-        idx = ConstraintTrackingTensor(torch.tensor(0))
-        reified = f(idx)  # type: ignore
-        if size is None:
-            constraints = getattr(idx, "_constraints", [])
-            if len(constraints) > 1:
-                # TODO: name the dimension argument with the error
-                raise ValueError(
-                    f"Error: incompatible constraints for dimension ({constraints})"
-                )
-            elif len(constraints) == 0:
-                # TODO: introduce warning if we fail
-                size = None
-            else:
-                size = list(constraints)[0]
+            return c[key][1]
 
-        dim = dims(sizes=[size])
+        plan_key = expression_key((f, size, device), by_value=True)
+        if plan_key is not None and plan_key in expression_cache:
+            expression_cache.move_to_end(plan_key)
+            size, reified_device = expression_cache[plan_key]
+        else:
+            idx = ConstraintTrackingTensor(torch.tensor(0))
+            reified = f(idx)  # type: ignore
+            reified_device = reified.device
+            if size is None:
+                constraints = getattr(idx, "_constraints", [])
+                if len(constraints) > 1:
+                    # TODO: name the dimension argument with the error
+                    raise ValueError(
+                        f"Error: incompatible constraints for dimension ({constraints})"
+                    )
+                elif len(constraints) == 0:
+                    # TODO: introduce warning if we fail
+                    size = None
+                else:
+                    size = list(constraints)[0]
+            if plan_key is not None:
+                expression_cache[plan_key] = (size, reified_device)
+                while len(expression_cache) > EXPRESSION_CACHE_MAX_SIZE:
+                    expression_cache.popitem(last=False)
+
+        # constructed directly, since dims() disassembles the calling frame to name the dim
+        dim = Dim("dim", size if size is not None else -1)
         if size is not None:
-            idx = torch.arange(size).to(reified.device if device is None else device)
+            idx = torch.arange(size).to(reified_device if device is None else device)
             xs = f(idx[dim])  # type: ignore
         else:
             xs = f(dim)
@@ -144,7 +253,7 @@ def _apply_single_dim(
         else:
             result = no_dim(xs, dim)
 
-        c[key] = result
+        c[key] = (refs, result)
         return result
 
 
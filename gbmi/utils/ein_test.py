@@ -1,5 +1,6 @@
 import os
 import sys
+from unittest import mock
 
 import functorch
 import torch
@@ -7,6 +8,13 @@ import torch
 from gbmi.utils import ein
 from gbmi.utils.testing import TestCase
 
+# rebound by test_ein_rekeys_nested_globals
+W = torch.rand(3, 2)
+
+
+def nested_rows():
+    return ein.array(lambda i: ein.array(lambda j: W[i][j]))
+
 
 class EinTest(TestCase):
     def test_ein_matmul(self):
@@ -123,3 +131,67 @@ tensor([[0, 0, 0, 0],
             test_func,
             f"""dimension {dimname} is unbound""",
         )
+
+    def test_expression_key(self):
+        make = lambda A, c: (lambda i: A[i] * c)
+        A, B = torch.rand(3), torch.rand(3)
+        key = ein.expression_key(make(A, 2))
+        self.assertEqual(ein.expression_key(make(A, 2)), key)
+        self.assertNotEqual(ein.expression_key(make(A, 3)), key)
+        self.assertNotEqual(ein.expression_key(make(B, 2)), key)
+        A.add_(1)
+        self.assertNotEqual(ein.expression_key(make(A, 2)), key)
+
+        value_key = ein.expression_key(make(A, 2), by_value=True)
+        self.assertEqual(
+            ein.expression_key(make(A.clone(), 2), by_value=True), value_key
+        )
+        self.assertNotEqual(ein.expression_key(make(B, 2), by_value=True), value_key)
+        self.assertNotEqual(
+            ein.expression_key(make(torch.rand(4), 2), by_value=True), value_key
+        )
+        self.assertIsNone(ein.expression_key(make(A, object()), by_value=True))
+
+    def test_ein_reuses_traced_expressions(self):
+        scale = lambda A, v: ein.array(lambda i, j: A[i][j] * v[j])
+        ein.expression_cache.clear()
+        A, v = torch.rand(4, 3), torch.rand(3)
+        self.assertTrue(torch.allclose(scale(A, v), A * v))
+        num_expressions = len(ein.expression_cache)
+        for _ in range(3):
+            A, v = A.clone(), v.clone()
+            self.assertTrue(torch.allclose(scale(A, v), A * v))
+        self.assertEqual(len(ein.expression_cache), num_expressions)
+        A.mul_(2)
+        self.assertTrue(torch.allclose(scale(A, v), A * v))
+
+    def test_ein_retraces_value_dependent_sizes(self):
+        # the masks have the same shape, but select different numbers of elements
+        v = torch.arange(5.0)
+        select = lambda mask: ein.array(lambda i: v[mask][i])
+        self.assertEqual(
+            select(torch.tensor([True, True, True, False, False])).tolist(),
+            [0.0, 1.0, 2.0],
+        )
+        self.assertEqual(
+            select(torch.tensor([True, True, True, True, False])).tolist(),
+            [0.0, 1.0, 2.0, 3.0],
+        )
+
+    def test_ein_rekeys_nested_globals(self):
+        global W
+        old_W = W
+        try:
+            self.assertEqual(nested_rows().shape, (3, 2))
+            W = torch.rand(5, 4)
+            self.assertEqual(nested_rows().shape, (5, 4))
+        finally:
+            W = old_W
+
+    def test_ein_expression_cache_is_bounded(self):
+        ein.expression_cache.clear()
+        with mock.patch.object(ein, "EXPRESSION_CACHE_MAX_SIZE", 2):
+            for n in range(2, 6):
+                v = torch.rand(n)
+                self.assertTrue(torch.allclose(ein.array(lambda i: v[i] * 2), v * 2))
+            self.assertEqual(len(ein.expression_cache), 2)
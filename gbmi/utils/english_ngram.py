@@ -1,6 +1,8 @@
 # %%
 from collections import Counter
 from functools import cache
+from pathlib import Path
+from typing import Optional, Union
 
 import nltk
 import nltk.corpus
@@ -8,7 +10,13 @@ import numpy as np
 from nltk import ngrams
 from nltk.corpus.reader.api import CorpusReader
 
+from gbmi.utils import CACHE_ROOT
+from gbmi.utils.model_store import atomic_write
+
 DEFAULT_CORPUS = "webtext"
+# bump whenever the contents of the cached tables change
+NGRAM_CACHE_VERSION = 1
+NGRAM_CACHE_DIR = CACHE_ROOT / "english_ngram"
 
 
 @cache
@@ -19,9 +27,38 @@ def get_corpus(corpus: str = DEFAULT_CORPUS) -> CorpusReader:
     return c
 
 
+def filter_text(
+    text: str,
+    *,
+    lower: bool = True,
+    strip_nonalpha: bool = True,
+    strip_nonalnum: bool = True,
+    strip_space: bool = True,
+    strip_nonascii: bool = True,
+) -> np.ndarray:
+    """
+    Returns the code points of text that survive the filters.
+
+    The filters are per-character predicates, so they are evaluated once per distinct character rather than once per
+    character of text.
+    """
+    text = text.lower() if lower else text
+    text = text.replace(" ", "") if strip_space else text
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    chars, inverse = np.unique(codes, return_inverse=True)
+    keep = np.ones(len(chars), dtype=bool)
+    for strip, predicate in (
+        (strip_nonalpha, str.isalpha),
+        (strip_nonalnum, str.isalnum),
+        (strip_nonascii, str.isascii),
+    ):
+        if strip:
+            keep &= np.array([predicate(chr(c)) for c in chars], dtype=bool)
+    return codes[keep[inverse.reshape(-1)]]
+
+
 @cache
-def get_ngrams(
-    n: int = 1,
+def get_text(
     *,
     corpus: str = DEFAULT_CORPUS,
     lower: bool = True,
@@ -29,30 +66,118 @@ def get_ngrams(
     strip_nonalnum: bool = True,
     strip_space: bool = True,
     strip_nonascii: bool = True,
-) -> Counter:
+) -> np.ndarray:
+    """Returns the code points of the filtered words of corpus, joined by spaces"""
     c = get_corpus(corpus)
     words = c.words()  # type: ignore
-    text = " ".join(words)
-    text = text.lower() if lower else text
-    text = text.replace(" ", "") if strip_space else text
-    text = "".join(filter(str.isalpha, text)) if strip_nonalpha else text
-    text = "".join(filter(str.isalnum, text)) if strip_nonalnum else text
-    text = "".join(filter(str.isascii, text)) if strip_nonascii else text
-    return Counter(ngrams(text, n))
+    return filter_text(
+        " ".join(words),
+        lower=lower,
+        strip_nonalpha=strip_nonalpha,
+        strip_nonalnum=strip_nonalnum,
+        strip_space=strip_space,
+        strip_nonascii=strip_nonascii,
+    )
 
 
 @cache
-def ngram_count_table(*args, **kwargs) -> np.ndarray:
-    ngrams = get_ngrams(*args, **kwargs)
-    ndim = max(len(k) for k in ngrams.keys())
-    keys = [sorted(set(k[i] for k in ngrams.keys() if len(k) > i)) for i in range(ndim)]
+def get_ngrams(
+    n: int = 1,
+    *,
+    corpus: str = DEFAULT_CORPUS,
+    lower: bool = True,
+    strip_nonalpha: bool = True,
+    strip_nonalnum: bool = True,
+    strip_space: bool = True,
+    strip_nonascii: bool = True,
+) -> Counter:
+    codes = get_text(
+        corpus=corpus,
+        lower=lower,
+        strip_nonalpha=strip_nonalpha,
+        strip_nonalnum=strip_nonalnum,
+        strip_space=strip_space,
+        strip_nonascii=strip_nonascii,
+    )
+    return Counter(ngrams(codes.tobytes().decode("utf-32-le"), n))
+
+
+def count_ngrams(codes: np.ndarray, n: int) -> np.ndarray:
+    """
+    Returns the table of counts of the n-grams of codes, indexed along each axis by the sorted characters that occur in
+    that position of some n-gram.
+
+    The n-grams are encoded as base-(number of characters) integers and counted with a single np.bincount.
+    """
+    alphabet, ids = np.unique(codes, return_inverse=True)
+    ids = ids.reshape(-1).astype(np.int64)
+    num_ngrams = len(ids) - n + 1
+    assert num_ngrams > 0, f"Cannot count {n}-grams of {len(ids)} characters"
+    flat = np.zeros(num_ngrams, dtype=np.int64)
+    for i in range(n):
+        flat = flat * len(alphabet) + ids[i : i + num_ngrams]
+    table = np.bincount(flat, minlength=len(alphabet) ** n).reshape(
+        (len(alphabet),) * n
+    )
+    keys = [np.unique(ids[i : i + num_ngrams]) for i in range(n)]
     assert (
         len(set(len(k) for k in keys)) == 1
-    ), f"All keys must have the same length, got {keys}"
-    table = np.zeros(tuple(len(k) for k in keys))
-    for k, v in ngrams.items():
-        table[tuple(ki.index(kp) for ki, kp in zip(keys, k))] = v
-    return table
+    ), f"All keys must have the same length, got {[alphabet[k] for k in keys]}"
+    return table[np.ix_(*keys)].astype(np.float64)
+
+
+def ngram_cache_path(
+    n: int,
+    *,
+    corpus: str,
+    cache_dir: Union[str, Path] = NGRAM_CACHE_DIR,
+    **filters: bool,
+) -> Path:
+    enabled = "-".join(name for name, value in filters.items() if value)
+    return (
+        Path(cache_dir)
+        / f"v{NGRAM_CACHE_VERSION}"
+        / f"{corpus}-{n}gram-{enabled or 'unfiltered'}.npy"
+    )
+
+
+@cache
+def ngram_count_table(
+    n: int = 1,
+    *,
+    corpus: str = DEFAULT_CORPUS,
+    lower: bool = True,
+    strip_nonalpha: bool = True,
+    strip_nonalnum: bool = True,
+    strip_space: bool = True,
+    strip_nonascii: bool = True,
+    cache_dir: Optional[Union[str, Path]] = NGRAM_CACHE_DIR,
+) -> np.ndarray:
+    """
+    Returns count_ngrams of the filtered corpus.
+
+    Unless cache_dir is None, the table is saved under cache_dir, keyed by (corpus, n, filters), and is memory-mapped
+    (read-only) from there by later calls in any process.
+    """
+    filters = dict(
+        lower=lower,
+        strip_nonalpha=strip_nonalpha,
+        strip_nonalnum=strip_nonalnum,
+        strip_space=strip_space,
+        strip_nonascii=strip_nonascii,
+    )
+    if cache_dir is None:
+        return count_ngrams(get_text(corpus=corpus, **filters), n)
+    path = ngram_cache_path(n, corpus=corpus, cache_dir=cache_dir, **filters)
+    if not path.exists():
+        table = count_ngrams(get_text(corpus=corpus, **filters), n)
+
+        def write(tmp_path: Path) -> None:
+            with open(tmp_path, "wb") as f:
+                np.save(f, table)
+
+        atomic_write(path, write)
+    return np.load(path, mmap_mode="r")
 
 
 @cache
@@ -0,0 +1,64 @@
+import itertools
+from collections import Counter
+
+import numpy as np
+from nltk import ngrams
+
+from gbmi.utils.english_ngram import count_ngrams, filter_text
+from gbmi.utils.testing import TestCase
+
+TEXT = "The quick brown Fox, naïve café 42 ÆON jumps over the lazy dog's back twice ẞ İ"
+
+
+def counter_table(text: str, n: int) -> np.ndarray:
+    counts = Counter(ngrams(text, n))
+    keys = [sorted(set(k[i] for k in counts.keys())) for i in range(n)]
+    table = np.zeros(tuple(len(k) for k in keys))
+    for k, v in counts.items():
+        table[tuple(ki.index(kp) for ki, kp in zip(keys, k))] = v
+    return table
+
+
+def decode(codes: np.ndarray) -> str:
+    return codes.tobytes().decode("utf-32-le")
+
+
+class TestEnglishNgram(TestCase):
+    def test_filter_text(self):
+        for lower, alpha, alnum, space, ascii in itertools.product(
+            (False, True), repeat=5
+        ):
+            text = TEXT.lower() if lower else TEXT
+            text = text.replace(" ", "") if space else text
+            text = "".join(filter(str.isalpha, text)) if alpha else text
+            text = "".join(filter(str.isalnum, text)) if alnum else text
+            text = "".join(filter(str.isascii, text)) if ascii else text
+            codes = filter_text(
+                TEXT,
+                lower=lower,
+                strip_nonalpha=alpha,
+                strip_nonalnum=alnum,
+                strip_space=space,
+                strip_nonascii=ascii,
+            )
+            self.assertEqual(decode(codes), text)
+
+    def test_count_ngrams(self):
+        # every character occurs in the middle, so each axis has the same characters
+        for text in (
+            "abab" + TEXT + "abab",
+            "abab" + decode(filter_text(TEXT)) + "abab",
+        ):
+            codes = filter_text(
+                text,
+                lower=False,
+                strip_nonalpha=False,
+                strip_nonalnum=False,
+                strip_space=False,
+                strip_nonascii=False,
+            )
+            for n in (1, 2, 3):
+                expected = counter_table(text, n)
+                actual = count_ngrams(codes, n)
+                self.assertEqual(actual.dtype, expected.dtype)
+                self.assertTrue(np.array_equal(actual, expected), msg=(text, n))
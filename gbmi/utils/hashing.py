@@ -6,6 +6,11 @@ The hashes should be stable across interpreter implementations and versions.
 
 Supports dataclass instances, datetimes, and JSON-serializable objects.
 
+Tensors and arrays are hashed by their dtype, shape, and raw bytes, and
+modules by their type, config, and state_dict.  Before this, tensors were
+hashed as nested lists of their elements and HookedTransformers by their
+__dict__; pass legacy_tensor_hash=True to reproduce those hashes.
+
 Empty dataclass fields are ignored, to allow adding new fields without
 the hash changing. Empty means one of: None, '', (), [], or {}.
 
@@ -57,6 +62,7 @@ def get_hash(
     thing: object,
     exclude_filter: ExcludeFilter = None,
     dictify_by_default: bool = False,
+    legacy_tensor_hash: bool = False,
 ) -> bytes:
     """
     Returns a stable hash for the given object.
@@ -68,11 +74,17 @@ def get_hash(
     - Collection[str] indicates exclusion of the listed attributes
     - Mapping[str, ExcludeFilter] indicates an exclusion filter to apply to specified attributes
     - Callable[[object], ExcludeFilter] indicates a filter to apply recursively to any object which is mapped to None by
+
+    legacy_tensor_hash reproduces the hashes of objects containing tensors, arrays, or HookedTransformers from before
+    tensors were hashed by their raw bytes (see the module docstring).
     """
     prefix = _VERSION.to_bytes(1, "big")
     digest = hashlib.md5(
         _json_dumps(
-            thing, exclude_filter=exclude_filter, dictify_by_default=dictify_by_default
+            thing,
+            exclude_filter=exclude_filter,
+            dictify_by_default=dictify_by_default,
+            legacy_tensor_hash=legacy_tensor_hash,
         ).encode("utf-8")
     ).digest()
     return prefix + digest[:-1]
@@ -82,10 +94,14 @@ def get_hash_ascii(
     thing: object,
     exclude_filter: ExcludeFilter = None,
     dictify_by_default: bool = False,
+    legacy_tensor_hash: bool = False,
 ) -> str:
     return base64.b64encode(
         get_hash(
-            thing, exclude_filter=exclude_filter, dictify_by_default=dictify_by_default
+            thing,
+            exclude_filter=exclude_filter,
+            dictify_by_default=dictify_by_default,
+            legacy_tensor_hash=legacy_tensor_hash,
         )
     ).decode("ascii")
 
@@ -94,6 +110,7 @@ def _json_dumps(
     thing: object,
     exclude_filter: ExcludeFilter = None,
     dictify_by_default: bool = False,
+    legacy_tensor_hash: bool = False,
 ) -> str:
     return json.dumps(
         thing,
@@ -101,6 +118,7 @@ def _json_dumps(
             _json_default,
             exclude_filter=exclude_filter,
             dictify_by_default=dictify_by_default,
+            legacy_tensor_hash=legacy_tensor_hash,
         ),
         # force formatting-related options to known values
         ensure_ascii=False,
@@ -114,6 +132,7 @@ def _json_default(
     thing: object,
     exclude_filter: ExcludeFilter = None,
     dictify_by_default: bool = False,
+    legacy_tensor_hash: bool = False,
 ) -> Any:
     if exclude_filter is True:
         return None
@@ -130,18 +149,27 @@ def _json_default(
             sorted(thing),
             exclude_filter=exclude_filter,
             dictify_by_default=dictify_by_default,
+            legacy_tensor_hash=legacy_tensor_hash,
         )
+    elif (isinstance(thing, torch.Tensor) or isinstance(thing, numpy.ndarray)) and not (
+        legacy_tensor_hash or _is_object_array(thing)
+    ):
+        return _tensor_summary(thing)
+    elif isinstance(thing, torch.nn.Module) and not legacy_tensor_hash:
+        return _module_summary(thing, exclude_filter=exclude_filter)
     elif isinstance(thing, torch.Tensor) or isinstance(thing, numpy.ndarray):
         return _json_dumps(
             thing.tolist(),
             exclude_filter=exclude_filter,
             dictify_by_default=dictify_by_default,
+            legacy_tensor_hash=legacy_tensor_hash,
         )
     elif isinstance(thing, HookedTransformer):
         return _json_dumps(
             thing.to("cpu", print_details=False).__dict__,
             exclude_filter=exclude_filter,
             dictify_by_default=dictify_by_default,
+            legacy_tensor_hash=legacy_tensor_hash,
         )
     elif isinstance(thing, type):
         return f"{thing.__module__}.{thing.__name__}"
@@ -154,6 +182,7 @@ def _json_default(
             thing.__dict__,
             exclude_filter=exclude_filter,
             dictify_by_default=dictify_by_default,
+            legacy_tensor_hash=legacy_tensor_hash,
         )
     elif (
         isinstance(thing, Callable)
@@ -165,6 +194,58 @@ def _json_default(
     raise TypeError(f"Object {thing} of type {type(thing)} is not JSON serializable")
 
 
+def _is_object_array(thing: Union[torch.Tensor, numpy.ndarray]) -> bool:
+    return isinstance(thing, numpy.ndarray) and thing.dtype.hasobject
+
+
+def _tensor_summary(thing: Union[torch.Tensor, numpy.ndarray]) -> Dict[str, Any]:
+    """
+    Summarizes a tensor or array by its dtype, shape, and a digest of its raw bytes, so that hashing it never builds
+    the nested list of its elements.
+    """
+    if isinstance(thing, torch.Tensor):
+        tensor = thing.detach()
+        if tensor.layout != torch.strided:
+            tensor = tensor.to_dense()
+        dtype, shape = str(tensor.dtype), list(tensor.shape)
+        data = (
+            tensor.resolve_conj()
+            .resolve_neg()
+            .cpu()
+            .contiguous()
+            .reshape(-1)
+            .view(torch.uint8)
+            .numpy()
+        )
+    else:
+        array = numpy.ascontiguousarray(thing)
+        dtype, shape = array.dtype.str, list(array.shape)
+        data = array.reshape(-1).view(numpy.uint8)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{dtype}{shape}".encode("utf-8"))
+    digest.update(memoryview(data))
+    return {"__tensor__": dtype, "shape": shape, "blake2b": digest.hexdigest()}
+
+
+def _module_summary(
+    thing: torch.nn.Module, exclude_filter: ExcludeFilter = None
+) -> Dict[str, Any]:
+    """
+    Summarizes a module by its type, its config (if any), and its state_dict, whose tensors are summarized in turn.
+
+    The device in the config is dropped, so that the same weights hash the same on any device.
+    """
+    cfg = getattr(thing, "cfg", None)
+    if dataclasses.is_dataclass(cfg) and not isinstance(cfg, type):
+        cfg = _dataclass_dict(cfg, exclude_filter=exclude_filter)
+        cfg.pop("device", None)
+    return {
+        "__module__": f"{type(thing).__module__}.{type(thing).__qualname__}",
+        "cfg": cfg,
+        "state_dict": dict(thing.state_dict()),
+    }
+
+
 def getattr_or_exclude(
     field_name: str, thing: object, exclude_filter: ExcludeFilter = None
 ) -> Optional[Any]:
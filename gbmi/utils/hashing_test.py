@@ -0,0 +1,45 @@
+import numpy
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from gbmi.utils.hashing import get_hash_ascii
+from gbmi.utils.testing import TestCase
+
+
+class TestHashing(TestCase):
+    def test_legacy_tensor_hash(self):
+        # computed with the list-based tensor hashing that predates legacy_tensor_hash
+        thing = ((torch.arange(6).reshape(2, 3).float(), {"a": numpy.arange(3)}), "x")
+        self.assertEqual(
+            get_hash_ascii(thing, legacy_tensor_hash=True), "AOlVQ/Htdmya0bAMKOjA6w=="
+        )
+        self.assertNotEqual(get_hash_ascii(thing), "AOlVQ/Htdmya0bAMKOjA6w==")
+        self.assertEqual(
+            get_hash_ascii({"a": 1}, legacy_tensor_hash=True), get_hash_ascii({"a": 1})
+        )
+
+    def test_tensor_hash(self):
+        x = torch.arange(6).reshape(2, 3).float()
+        self.assertEqual(get_hash_ascii(x), get_hash_ascii(x.clone()))
+        self.assertEqual(get_hash_ascii(x.T), get_hash_ascii(x.T.contiguous()))
+        for other in (x.double(), x.reshape(3, 2), x + 1, x.half(), x.bfloat16()):
+            self.assertNotEqual(get_hash_ascii(x), get_hash_ascii(other))
+        self.assertEqual(
+            get_hash_ascii(numpy.arange(3)), get_hash_ascii(numpy.arange(3).copy())
+        )
+        self.assertNotEqual(
+            get_hash_ascii(numpy.arange(3)), get_hash_ascii(numpy.arange(1, 4))
+        )
+
+    def test_module_hash(self):
+        cfg = HookedTransformerConfig(
+            n_layers=1, d_model=8, n_ctx=4, d_head=4, d_vocab=5, attn_only=True
+        )
+        torch.manual_seed(0)
+        model = HookedTransformer(cfg)
+        torch.manual_seed(0)
+        same = HookedTransformer(cfg)
+        torch.manual_seed(1)
+        different = HookedTransformer(cfg)
+        self.assertEqual(get_hash_ascii(model), get_hash_ascii(same))
+        self.assertNotEqual(get_hash_ascii(model), get_hash_ascii(different))
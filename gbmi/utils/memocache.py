@@ -4,10 +4,13 @@ import concurrent.futures
 import inspect
 import os
 import pickle
+import secrets
 import shelve
+import struct
 import tempfile
 import threading
 from contextlib import AbstractContextManager, asynccontextmanager, contextmanager
+from dataclasses import dataclass
 from pathlib import Path
 from typing import IO, Any, Callable, Optional, Tuple, TypeVar, Union
 
@@ -98,6 +101,35 @@ def write_via_temp(file_path: Union[str, Path], do_write: Callable[[IO[bytes]],
                 os.remove(backup_file_path)
 
 
+_LOG_MAGIC = b"memocache-log"
+_LOG_LENGTH = struct.Struct("<Q")
+
+
+def _log_frame(payload: bytes) -> bytes:
+    return _LOG_LENGTH.pack(len(payload)) + payload
+
+
+def _read_log_frame(f: IO[bytes]) -> Optional[bytes]:
+    """Reads one length-prefixed frame, or returns None at the end of the file or at a partially-written frame"""
+    header = f.read(_LOG_LENGTH.size)
+    if len(header) < _LOG_LENGTH.size:
+        return None
+    (length,) = _LOG_LENGTH.unpack(header)
+    payload = f.read(length)
+    return payload if len(payload) == length else None
+
+
+@dataclass
+class _LogState:
+    """How much of the append-only log we've applied to the in-memory cache"""
+
+    token: Optional[bytes] = (
+        None  # identifies the log since its last compaction; b"" if there's no log
+    )
+    offset: int = 0
+    records: int = 0
+
+
 # https://stackoverflow.com/a/63425191/377022
 _pool = concurrent.futures.ThreadPoolExecutor()
 
@@ -118,6 +150,9 @@ class Memoize:
     The cache is also thread-safe, so it can be used in a multithreaded environment.
     The cache is also exception-safe, so it won't be corrupted if there's an error.
     If use_shelf is true, Python's shelve is used to store the cache, avoiding in-memory overhead.
+    If use_log is true, new entries are appended to a log next to the cache file rather than rewriting the whole cache,
+    and each process reads only the entries appended since it last looked; once the log holds at least
+    max(log_compact_every, len(cache)) records, it is compacted into the cache file.
     """
 
     instances = {}
@@ -133,6 +168,8 @@ class Memoize:
         use_pandas: Optional[bool] = None,
         force_async: bool = False,
         use_shelf: Optional[bool] = None,
+        use_log: Optional[bool] = None,
+        log_compact_every: int = 1024,
     ):
         if use_pandas is None:
             use_pandas = USE_PANDAS
@@ -151,17 +188,31 @@ class Memoize:
             assert (
                 use_shelf is None or use_shelf == func.use_shelf
             ), f"Not equal! func.use_shelf={func.use_shelf}, use_shelf={use_shelf}"
+            self.use_log = func.use_log
+            assert (
+                use_log is None or use_log == func.use_log
+            ), f"Not equal! func.use_log={func.use_log}, use_log={use_log}"
+            self.log_file = func.log_file
+            self.log_compact_every = func.log_compact_every
+            self._log_state = func._log_state
             if name is not None:
                 Memoize.instances[name] = self
         else:
             if use_shelf is None:
                 use_shelf = False
+            if use_log is None:
+                use_log = False
+            assert not (use_shelf and use_log), "use_shelf and use_log are exclusive"
             self.func = func
             self.name = name or func.__name__
             self.cache_file = Path(
                 cache_file or (Path(Memoize.cache_base_dir) / f"{self.name}_cache.pkl")
             ).absolute()
             self.use_shelf = use_shelf
+            self.use_log = use_log
+            self.log_file = Path(f"{self.cache_file}.log")
+            self.log_compact_every = log_compact_every
+            self._log_state = _LogState()
             self.cache_file.parent.mkdir(parents=True, exist_ok=True)
             self.cache: Union[dict, shelve.Shelf[Any]] = (
                 shelve.open(str(self.cache_file.absolute())) if use_shelf else {}
@@ -192,10 +243,96 @@ class Memoize:
             with wrap_context(self.file_lock, skip=not use_lock):
                 self.cache.sync()
 
+    def _read_log(self):
+        """
+        Applies the log entries appended since we last read it to the in-memory cache.
+        If the log has been compacted since (or never read), the cache is first reloaded from the cache file.
+
+        Both the thread lock and the file lock must be held.
+        """
+        state = self._log_state
+        try:
+            f = open(self.log_file, "rb")
+        except FileNotFoundError:
+            if state.token != b"":
+                self._reload_cache_file()
+                state.token, state.offset, state.records = b"", 0, 0
+            return
+        with f:
+            header = _read_log_frame(f)
+            magic, token = pickle.loads(header) if header is not None else (None, None)
+            assert magic == _LOG_MAGIC, f"{self.log_file} is not a memocache log"
+            if token != state.token:
+                self._reload_cache_file()
+                state.token, state.offset, state.records = token, f.tell(), 0
+            f.seek(state.offset)
+            while (payload := _read_log_frame(f)) is not None:
+                op, key, val = pickle.loads(payload)
+                if op == "set":
+                    self.cache[key] = val
+                else:
+                    self.cache.pop(key, None)
+                state.offset = f.tell()
+                state.records += 1
+
+    def _reload_cache_file(self):
+        """Replaces the in-memory cache with the contents of the cache file.  The thread and file locks must be held."""
+        try:
+            with open(self.cache_file, "rb") as f:
+                disk_cache = pickle.load(f)
+        except FileNotFoundError:
+            disk_cache = {}
+        self.cache.clear()
+        self.cache.update(disk_cache)
+
+    def _start_log(self):
+        """Starts a new, empty log.  The thread and file locks must be held, and the cache file must be up to date."""
+        token = secrets.token_bytes(16)
+        write_via_temp(
+            self.log_file,
+            lambda f: f.write(_log_frame(pickle.dumps((_LOG_MAGIC, token)))),
+        )
+        self._log_state.token = token
+        self._log_state.offset = os.path.getsize(self.log_file)
+        self._log_state.records = 0
+
+    def _compact_log(self):
+        """Folds the log into the cache file.  The thread and file locks must be held, and the log must be read."""
+        write_via_temp(self.cache_file, (lambda f: pickle.dump(self.cache, f)))
+        self._start_log()
+
+    def _append_to_log(self, op: str, key: KEY, val: Any = None, use_lock: bool = True):
+        """Records cache[key] = val (op "set") or del cache[key] (op "del") in memory and in the log"""
+        with wrap_context(self.thread_lock, skip=not use_lock):
+            with wrap_context(self.file_lock, skip=not use_lock):
+                self._read_log()
+                if op == "set":
+                    self.cache[key] = val
+                else:
+                    del self.cache[key]
+                if self._log_state.token == b"":
+                    self._start_log()
+                with open(self.log_file, "r+b") as f:
+                    # drop any partially-written entry left by a crashed writer
+                    f.seek(self._log_state.offset)
+                    f.truncate()
+                    f.write(_log_frame(pickle.dumps((op, key, val))))
+                    self._log_state.offset = f.tell()
+                self._log_state.records += 1
+                if self._log_state.records >= max(
+                    self.log_compact_every, len(self.cache)
+                ):
+                    self._compact_log()
+
     def _load_cache_from_disk(self, use_lock: bool = True):
         """Loads the cache from disk.  If use_lock is True, then the cache is locked while it's being loaded."""
         if self._use_shelf_and_sync(use_lock=use_lock):
             return
+        if self.use_log:
+            with wrap_context(self.thread_lock, skip=not use_lock):
+                with wrap_context(self.file_lock, skip=not use_lock):
+                    self._read_log()
+            return
         with wrap_context(self.file_lock, skip=not use_lock):
             try:
                 with open(self.cache_file, "rb") as f:
@@ -211,6 +348,10 @@ class Memoize:
             return
         with wrap_context(self.thread_lock, skip=not use_lock):
             with wrap_context(self.file_lock, skip=not use_lock):
+                if self.use_log:
+                    self._read_log()
+                    self._compact_log()
+                    return
                 if not skip_load:
                     self._load_cache_from_disk(use_lock=False)
                 # use a tempfile so that we don't corrupt the cache if there's an error
@@ -234,6 +375,9 @@ class Memoize:
 
     def _uncache(self, key: KEY):
         """Removes a key from the cache."""
+        if self.use_log:
+            self._append_to_log("del", key)
+            return
         str_key = self._str_key_fast(key)
         with self.thread_lock:
             with self.file_lock:
@@ -280,14 +424,16 @@ class Memoize:
                 val = self.cache[key]
         except KeyError:
             val = self.func(*args, **kwargs)
-            if isinstance(self.cache, shelve.Shelf):
+            if self.use_log:
+                self._append_to_log("set", key, val)
+            elif isinstance(self.cache, shelve.Shelf):
                 with self.thread_lock:
                     self.cache[str_key] = val
             else:
                 with self.thread_lock:
                     self.cache[key] = val
-
-            self._write_cache_to_disk()
+            if not self.use_log:
+                self._write_cache_to_disk()
 
         self._update_df(key, val)
         return val
@@ -308,13 +454,16 @@ class Memoize:
                 val = self.cache[key]
         except KeyError:
             val = await self.func(*args, **kwargs)
-            if isinstance(self.cache, shelve.Shelf):
+            if self.use_log:
+                await asyncio.to_thread(self._append_to_log, "set", key, val)
+            elif isinstance(self.cache, shelve.Shelf):
                 async with async_lock(self.thread_lock):
                     self.cache[str_key] = val
+                await asyncio.to_thread(self._write_cache_to_disk)
             else:
                 async with async_lock(self.thread_lock):
                     self.cache[key] = val
-            await asyncio.to_thread(self._write_cache_to_disk)
+                await asyncio.to_thread(self._write_cache_to_disk)
 
         self._update_df(key, val)
         return val
@@ -346,7 +495,7 @@ class Memoize:
             yield Memoize(self, disk_write_only=True)
 
     def __repr__(self):
-        return f"Memoize(func={self.func!r}, name={self.name!r}, cache_file={self.cache_file!r}, use_shelf={self.use_shelf!r})"
+        return f"Memoize(func={self.func!r}, name={self.name!r}, cache_file={self.cache_file!r}, use_shelf={self.use_shelf!r}, use_log={self.use_log!r})"
 
     def __str__(self):
-        return f"Memoize(func={self.func}, name={self.name}, cache_file={self.cache_file}, use_shelf={self.use_shelf!r})"
+        return f"Memoize(func={self.func}, name={self.name}, cache_file={self.cache_file}, use_shelf={self.use_shelf!r}, use_log={self.use_log!r})"
@@ -0,0 +1,52 @@
+import pickle
+import tempfile
+from pathlib import Path
+
+from gbmi.utils.memocache import Memoize
+from gbmi.utils.testing import TestCase
+
+
+class TestMemoize(TestCase):
+    def test_log_backend(self):
+        calls = []
+
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_file = Path(cache_dir) / "square_cache.pkl"
+
+            def memoize():
+                # separate instances share nothing in memory, like separate processes
+                return Memoize(
+                    square,
+                    cache_file=cache_file,
+                    use_pandas=False,
+                    use_log=True,
+                    log_compact_every=4,
+                )
+
+            f, g = memoize(), memoize()
+            self.assertEqual([f(x) for x in range(3)], [0, 1, 4])
+            # g picks up f's entries from the log without recomputing them
+            self.assertEqual([g(x) for x in range(3)], [0, 1, 4])
+            self.assertEqual(calls, [0, 1, 2])
+
+            # a partially-written entry from a crashed writer is dropped
+            with open(f.log_file, "ab") as log:
+                log.write(b"\x05\x00")
+            self.assertEqual(g(3), 9)
+            # the fourth record compacted the log into the cache file
+            with open(cache_file, "rb") as cache:
+                self.assertEqual(len(pickle.load(cache)), 4)
+            self.assertEqual(f(3), 9)
+            self.assertEqual(calls, [0, 1, 2, 3])
+
+            f.uncache(1)
+            self.assertEqual(g(1), 1)
+            self.assertEqual(calls, [0, 1, 2, 3, 1])
+            self.assertEqual(
+                {x: memoize()(x) for x in range(4)}, {0: 0, 1: 1, 2: 4, 3: 9}
+            )
+            self.assertEqual(calls, [0, 1, 2, 3, 1])
@@ -1,7 +1,12 @@
+import hashlib
+import json
 import logging
 import pickle
 import time
+import uuid
+from abc import ABC, abstractmethod
 from contextlib import contextmanager
+from pathlib import Path
 from typing import (
     Any,
     Callable,
@@ -18,9 +23,17 @@ from typing import (
 from datasets import Dataset, DatasetDict, load_dataset
 from datasets.data_files import EmptyDatasetError
 from datasets.exceptions import DataFilesNotFoundError
+from filelock import FileLock
+from huggingface_hub import CommitOperationAdd, HfApi
+from huggingface_hub.utils import (
+    EntryNotFoundError,
+    HfHubHTTPError,
+    RepositoryNotFoundError,
+)
 
 from gbmi.utils.contextlib_extra import chain_contextmanagers_data
 from gbmi.utils.hashing import get_hash_ascii
+from gbmi.utils.model_store import atomic_write
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.WARNING)
@@ -99,15 +112,399 @@ class HFOpenDictLike(dict):
         return self.init_hash != self._gethash()
 
 
+SHARD_PREFIX = "memohf-shards"
+MANIFEST_NAME = "manifest.json"
+REVISION_NAME = "REVISION"
+KeyPath = Tuple[Any, ...]
+
+
+class ShardStoreConflict(Exception):
+    """Raised by ShardStore.commit when the store has moved on from the revision the commit was based on"""
+
+
+class ShardStore(ABC):
+    """Where HFShardedDictLike keeps its shards and manifest: a flat namespace of immutable-ish files."""
+
+    @abstractmethod
+    def revision(self) -> Optional[str]:
+        """Returns the current revision of the store, to read from and then commit on top of."""
+
+    @abstractmethod
+    def read(self, path: str, revision: Optional[str] = None) -> Optional[bytes]:
+        """Returns the contents of path (at revision, default latest), or None if it does not exist."""
+
+    def exists(self, path: str, revision: Optional[str] = None) -> bool:
+        return self.read(path, revision) is not None
+
+    @abstractmethod
+    def commit(
+        self, files: Dict[str, bytes], message: str, parent_revision: Optional[str]
+    ) -> None:
+        """
+        Writes all of files, in order (callers put the manifest last), as a single commit on top of parent_revision.
+
+        Raises ShardStoreConflict, writing nothing, if the store is no longer at parent_revision.
+        """
+
+
+class LocalShardStore(ShardStore):
+    """A local-directory stand-in for the hub, for tests and offline use."""
+
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
+        self.revision_path = self.root / REVISION_NAME
+
+    def revision(self) -> Optional[str]:
+        try:
+            return self.revision_path.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+
+    def read(self, path: str, revision: Optional[str] = None) -> Optional[bytes]:
+        # earlier revisions are not kept; a commit based on a stale read fails with ShardStoreConflict anyway
+        try:
+            return (self.root / path).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, path: str, revision: Optional[str] = None) -> bool:
+        return (self.root / path).exists()
+
+    def commit(
+        self, files: Dict[str, bytes], message: str, parent_revision: Optional[str]
+    ) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        with FileLock(self.root / f"{REVISION_NAME}.lock"):
+            if self.revision() != parent_revision:
+                raise ShardStoreConflict(
+                    f"{self.root} is at {self.revision()}, not {parent_revision}"
+                )
+            for path, data in files.items():
+                atomic_write(
+                    self.root / path, lambda tmp_path: tmp_path.write_bytes(data)
+                )
+            atomic_write(
+                self.revision_path,
+                lambda tmp_path: tmp_path.write_text(
+                    uuid.uuid4().hex, encoding="utf-8"
+                ),
+            )
+
+
+class HubShardStore(ShardStore):
+    """Shards stored as files in a Hugging Face dataset repo; each push is a single commit."""
+
+    def __init__(self, repo_id: str, repo_type: str = "dataset", **kwargs):
+        self.repo_id = repo_id
+        self.repo_type = repo_type
+        self.api = HfApi(**kwargs)
+
+    def revision(self) -> Optional[str]:
+        # we only ask for the revision in order to commit, so create the repo if need be
+        self.api.create_repo(self.repo_id, repo_type=self.repo_type, exist_ok=True)
+        return self.api.repo_info(self.repo_id, repo_type=self.repo_type).sha
+
+    def read(self, path: str, revision: Optional[str] = None) -> Optional[bytes]:
+        try:
+            local_path = self.api.hf_hub_download(
+                self.repo_id, path, repo_type=self.repo_type, revision=revision
+            )
+        except (EntryNotFoundError, RepositoryNotFoundError) as e:
+            logger.debug(e)
+            return None
+        return Path(local_path).read_bytes()
+
+    def exists(self, path: str, revision: Optional[str] = None) -> bool:
+        try:
+            return self.api.file_exists(
+                self.repo_id, path, repo_type=self.repo_type, revision=revision
+            )
+        except RepositoryNotFoundError:
+            return False
+
+    def commit(
+        self, files: Dict[str, bytes], message: str, parent_revision: Optional[str]
+    ) -> None:
+        try:
+            self.api.create_commit(
+                self.repo_id,
+                operations=[
+                    CommitOperationAdd(path_in_repo=path, path_or_fileobj=data)
+                    for path, data in files.items()
+                ],
+                commit_message=message,
+                repo_type=self.repo_type,
+                parent_commit=parent_revision,
+            )
+        except HfHubHTTPError as e:
+            # the hub answers 412 Precondition Failed when parent_commit is no longer the head
+            if e.response is not None and e.response.status_code in (409, 412):
+                raise ShardStoreConflict(str(e)) from e
+            raise
+
+
+class DeltaDict(dict):
+    """
+    A dict that records which keys were written since the last push, as paths from the root HFShardedDictLike.
+
+    Dicts created through setdefault (as hf_open_staged and merge_subdicts do for their per-dataset sub-dicts) become
+    nested DeltaDicts, so writes to them are recorded too, while creating them records only their leaves; values
+    stored with [] are leaves (replacing everything under their key) and are never tracked inside.  A nested DeltaDict shared between several roots (as merge_subdicts does) records writes in all of them.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._parents: list[Tuple["HFShardedDictLike", KeyPath]] = []
+
+    def _add_parent(self, root: "HFShardedDictLike", path: KeyPath) -> None:
+        self._parents.append((root, path))
+        for key, value in self.items():
+            if isinstance(value, DeltaDict):
+                value._add_parent(root, path + (key,))
+
+    def _touch(self, key) -> None:
+        for root, path in self._parents:
+            root.dirty.add(path + (key,))
+
+    def _attach(self, key, value):
+        if isinstance(value, DeltaDict):
+            for root, path in self._parents:
+                value._add_parent(root, path + (key,))
+        return value
+
+    def __setitem__(self, key, value):
+        self._touch(key)
+        super().__setitem__(key, self._attach(key, value))
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._touch(key)
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        if not isinstance(default, dict):
+            self[key] = default
+            return default
+        if not isinstance(default, DeltaDict):
+            child = DeltaDict()
+            child.update(default)
+            default = child
+        # only the leaves of a new sub-dict are recorded, not the sub-dict itself, so that pushing it merges with
+        # (rather than replaces) whatever another writer put under the same key
+        super().__setitem__(key, self._attach(key, default))
+        for root, path in self._parents:
+            root.dirty.update(leaf for leaf, _ in _leaves(default, path + (key,)))
+        return default
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, key, *default):
+        if key in self:
+            self._touch(key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._touch(key)
+        return key, value
+
+    def clear(self):
+        for key in self:
+            self._touch(key)
+        super().clear()
+
+
+def _leaves(d: dict, path: KeyPath = ()) -> Iterable[Tuple[KeyPath, Any]]:
+    for key, value in d.items():
+        if isinstance(value, DeltaDict):
+            yield from _leaves(value, path + (key,))
+        else:
+            yield path + (key,), value
+
+
+class HFShardedDictLike(DeltaDict):
+    """
+    A dict-like object that pushes only what changed, as content-hashed shards plus a manifest.
+
+    Each push pickles just the dirty entries into one shard named by the sha256 of its contents, and commits that
+    shard together with a manifest listing all shards in order; loading replays the shards in manifest order.  Once
+    the manifest lists compact_every shards, the next push writes a single snapshot shard instead.
+    """
+
+    def __init__(
+        self,
+        store: ShardStore,
+        repo_id: str,
+        config_name: str = "default",
+        compact_every: int = 64,
+        max_push_attempts: int = 5,
+    ):
+        super().__init__()
+        self.repo_id = repo_id
+        self.store = store
+        self.config_name = config_name
+        self.compact_every = compact_every
+        self.max_push_attempts = max_push_attempts
+        self.prefix = f"{SHARD_PREFIX}/{config_name}"
+        self.dirty: set[KeyPath] = set()
+        self.shards: list[str] = []
+        self._add_parent(self, ())
+        self._load_db()
+
+    def _read_manifest(self, revision: Optional[str] = None) -> list[str]:
+        data = self.store.read(f"{self.prefix}/{MANIFEST_NAME}", revision)
+        return [] if data is None else json.loads(data)["shards"]
+
+    def _apply_shard(self, name: str, skip: Iterable[KeyPath] = ()) -> None:
+        """Replays a shard without marking anything dirty, ignoring paths at or under skip"""
+        data = self.store.read(f"{self.prefix}/{name}")
+        assert data is not None, f"{self.repo_id} is missing shard {name}"
+        shard = pickle.loads(data)
+        skip = set(skip)
+
+        def skipped(path: KeyPath) -> bool:
+            return any(path[:i] in skip for i in range(1, len(path) + 1))
+
+        for path in shard["delete"]:
+            if skipped(path) or any(p[: len(path)] == path for p in skip):
+                continue
+            parent = self
+            for key in path[:-1]:
+                parent = parent.get(key)
+                if not isinstance(parent, dict):
+                    break
+            else:
+                dict.pop(parent, path[-1], None)
+        for path, value in shard["set"].items():
+            if skipped(path):
+                continue
+            parent = self
+            for i, key in enumerate(path[:-1]):
+                child = parent.get(key)
+                if not isinstance(child, DeltaDict):
+                    child = DeltaDict()
+                    child._add_parent(self, path[: i + 1])
+                    dict.__setitem__(parent, key, child)
+                parent = child
+            dict.__setitem__(parent, path[-1], value)
+        self.shards.append(name)
+
+    def _load_db(self) -> None:
+        for name in self._read_manifest():
+            self._apply_shard(name)
+
+    def _lookup(self, path: KeyPath) -> Tuple[bool, Any]:
+        value: Any = self
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                return False, None
+            value = value[key]
+        return True, value
+
+    def _delta(self) -> Dict[str, Any]:
+        delete, set_ = [], {}
+        for path in sorted(self.dirty, key=len):
+            found, value = self._lookup(path)
+            if not found:
+                delete.append(path)
+            elif isinstance(value, DeltaDict):
+                # a whole sub-dict was replaced; drop whatever was there before
+                delete.append(path)
+                set_.update(_leaves(value, path))
+            else:
+                set_[path] = value
+        return {"delete": delete, "set": set_}
+
+    def push_to_hub(self):
+        """
+        Pushes the entries changed since the last push (or load) as a new shard.
+
+        The commit is made on top of the revision whose manifest we merged, so a concurrent push makes it fail
+        rather than silently dropping the other push's shards from the manifest; we then merge again and retry, up
+        to max_push_attempts times.
+        """
+        if not self.dirty:
+            return
+        for attempt in range(self.max_push_attempts):
+            revision = self.store.revision()
+            # pick up shards pushed by others since we loaded; our own writes are newer
+            remote_shards = self._read_manifest(revision)
+            for name in remote_shards:
+                if name not in self.shards:
+                    self._apply_shard(name, skip=self.dirty)
+            if len(remote_shards) + 1 >= self.compact_every:
+                shard, shards = {"delete": [], "set": dict(_leaves(self))}, []
+            else:
+                shard, shards = self._delta(), list(remote_shards)
+            data = pickle.dumps(shard)
+            name = f"{hashlib.sha256(data).hexdigest()}.pkl"
+            shards.append(name)
+            files = {}
+            if not self.store.exists(f"{self.prefix}/{name}", revision):
+                files[f"{self.prefix}/{name}"] = data
+            files[f"{self.prefix}/{MANIFEST_NAME}"] = json.dumps(
+                {"shards": shards}, indent=1
+            ).encode("utf-8")
+            try:
+                self.store.commit(
+                    files,
+                    f"memohf: {len(shard['set'])} set, {len(shard['delete'])} deleted",
+                    parent_revision=revision,
+                )
+            except ShardStoreConflict as e:
+                logger.info(f"Retrying push to {self.repo_id} ({attempt + 1}): {e}")
+                continue
+            self.shards = shards
+            self.dirty.clear()
+            update_last_push_time(self.repo_id)
+            return
+        raise ShardStoreConflict(
+            f"Could not push to {self.repo_id} in {self.max_push_attempts} attempts"
+        )
+
+    @property
+    def modified(self) -> bool:
+        """Determines if the database has been modified since the last push."""
+        return bool(self.dirty)
+
+
 @contextmanager
 def hf_open(
     repo_id: str,
     name: Optional[str] = None,
     save: bool = True,
     hash_function: Callable = hash,
+    sharded: bool = False,
+    shard_store: Optional[ShardStore] = None,
     **kwargs,
 ):
-    """Context manager for opening a Hugging Face dataset in dict-like format."""
+    """
+    Context manager for opening a Hugging Face dataset in dict-like format.
+
+    If sharded (implied by passing shard_store), the data is kept as content-hashed shards (see HFShardedDictLike)
+    rather than as a DatasetDict, and only the changed entries are pushed; shard_store defaults to the hub repo.
+    The two formats are stored separately and are not converted into each other.
+    """
+    if sharded or shard_store is not None:
+        sharded_db = HFShardedDictLike(
+            shard_store if shard_store is not None else HubShardStore(repo_id),
+            repo_id,
+            config_name=name or "default",
+        )
+        try:
+            yield sharded_db
+        finally:
+            if save:
+                sharded_db.push_to_hub()
+        return
+
     try:
         # Load the dataset and keep it in memory
         logger.debug(
@@ -226,7 +623,7 @@ def hf_open_staged(
                     hf_open,
                     (repo_id,),
                     dict(save=save, hash_function=hash_function, **kwargs),
-                    ((lambda db: None, (), {}),),
+                    (lambda db: None, (), {}),
                 )
             )
         for storage_method in storage_methods:
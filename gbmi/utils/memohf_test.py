@@ -0,0 +1,155 @@
+import json
+import pickle
+import tempfile
+from pathlib import Path
+
+from gbmi.utils.memohf import (
+    HFShardedDictLike,
+    LocalShardStore,
+    ShardStoreConflict,
+    hf_open,
+    memohf,
+    uncache,
+)
+from gbmi.utils.testing import TestCase
+
+
+def shard_files(root: str) -> list[str]:
+    return sorted(p.name for p in Path(root).rglob("*.pkl"))
+
+
+def load_shard(root: str, config_name: str, name: str) -> dict:
+    return pickle.loads(
+        (Path(root) / "memohf-shards" / config_name / name).read_bytes()
+    )
+
+
+class InterleavingShardStore(LocalShardStore):
+    """Runs before_commit (once) just before the first commit, as if another writer got there first"""
+
+    def __init__(self, root, before_commit):
+        super().__init__(root)
+        self.before_commit = before_commit
+
+    def commit(self, files, message, parent_revision):
+        before_commit, self.before_commit = self.before_commit, None
+        if before_commit is not None:
+            before_commit()
+        super().commit(files, message, parent_revision)
+
+
+class TestShardedMemohf(TestCase):
+    def test_delta_push(self):
+        with tempfile.TemporaryDirectory() as root:
+            store = LocalShardStore(root)
+            calls = []
+
+            def square(x):
+                calls.append(x)
+                return {"square": x * x}
+
+            for storage_methods in ("single_data_file", "named_data_files"):
+                calls.clear()
+                for xs in ([1, 2], [2, 3]):
+                    with memohf(
+                        square,
+                        "user/repo",
+                        "squares",
+                        cache={},
+                        storage_methods=storage_methods,
+                        shard_store=store,
+                    )() as f:
+                        self.assertEqual(
+                            [f(x)["square"] for x in xs], [x * x for x in xs]
+                        )
+                self.assertEqual(calls, [1, 2, 3], msg=storage_methods)
+
+            # each push wrote one shard holding only the new entries
+            with hf_open("user/repo", shard_store=store, save=False) as db:
+                self.assertFalse(db.modified)
+                self.assertEqual(len(db.shards), 2)
+                self.assertEqual(len(db["alldata"]["squares"]), 3)
+            second = load_shard(root, "default", db.shards[1])
+            self.assertEqual(len(second["set"]), 1)
+
+            uncache(
+                3,
+                repo_id="user/repo",
+                dataset_key="squares",
+                cache={},
+                load_dataset_kwargs=dict(shard_store=store),
+            )
+            db = HFShardedDictLike(store, "user/repo")
+            self.assertEqual(len(db["alldata"]["squares"]), 2)
+
+            # compaction replaces the manifest with a single snapshot
+            db.compact_every = 1
+            db["alldata"]["squares"]["extra"] = 0
+            db.push_to_hub()
+            reloaded = HFShardedDictLike(store, "user/repo")
+            self.assertEqual(reloaded.shards, db.shards)
+            self.assertEqual(len(reloaded.shards), 1)
+            self.assertEqual(reloaded, db)
+
+    def test_concurrent_writers(self):
+        with tempfile.TemporaryDirectory() as root:
+            store = LocalShardStore(root)
+            a = HFShardedDictLike(store, "user/repo")
+            b = HFShardedDictLike(store, "user/repo")
+            a.setdefault("alldata", {})["x"] = 1
+            a.push_to_hub()
+            b.setdefault("alldata", {})["y"] = 2
+            b["alldata"]["x"] = 3
+            b.push_to_hub()
+            self.assertEqual(b["alldata"], {"x": 3, "y": 2})
+            self.assertEqual(
+                HFShardedDictLike(store, "user/repo")["alldata"], {"x": 3, "y": 2}
+            )
+            manifest = json.loads(
+                (Path(root) / "memohf-shards" / "default" / "manifest.json").read_text()
+            )
+            self.assertEqual(len(manifest["shards"]), 2)
+            self.assertEqual(len(shard_files(root)), 2)
+
+    def test_racing_push_from_empty_store(self):
+        with tempfile.TemporaryDirectory() as root:
+
+            def push_other():
+                other = HFShardedDictLike(LocalShardStore(root), "user/repo")
+                other.setdefault("alldata", {})["y"] = 2
+                other.push_to_hub()
+
+            # both writers create alldata; the retry must keep the other writer's entries under it
+            store = InterleavingShardStore(root, push_other)
+            db = HFShardedDictLike(store, "user/repo")
+            db.setdefault("alldata", {})["x"] = 1
+            db.push_to_hub()
+            self.assertEqual(
+                HFShardedDictLike(store, "user/repo")["alldata"], {"x": 1, "y": 2}
+            )
+
+    def test_racing_push_is_retried(self):
+        with tempfile.TemporaryDirectory() as root:
+
+            first = HFShardedDictLike(LocalShardStore(root), "user/repo")
+            first.setdefault("alldata", {})["z"] = 0
+            first.push_to_hub()
+
+            def push_other():
+                other = HFShardedDictLike(LocalShardStore(root), "user/repo")
+                other["alldata"]["y"] = 2
+                other.push_to_hub()
+
+            # the other push lands between our read of the manifest and our commit
+            store = InterleavingShardStore(root, push_other)
+            db = HFShardedDictLike(store, "user/repo")
+            db["alldata"]["x"] = 1
+            db.push_to_hub()
+            self.assertEqual(
+                HFShardedDictLike(store, "user/repo")["alldata"],
+                {"x": 1, "y": 2, "z": 0},
+            )
+
+            stale = LocalShardStore(root)
+            with self.assertRaises(ShardStoreConflict):
+                stale.commit({"file": b""}, "stale", parent_revision=None)
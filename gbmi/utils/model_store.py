@@ -0,0 +1,119 @@
+"""
+A local, content-addressed registry of model checkpoints.
+
+Checkpoints are keyed by model id (in practice Config.get_id(), which hashes the full config).  An index file in the
+store directory maps each id to its checkpoints, oldest first, so finding the newest checkpoint for an id is a dict
+lookup rather than a directory scan or a wandb query.  The index and the checkpoints are written atomically
+(write to a temporary file, then rename), so concurrent readers never see a partial file, and updates to the index
+hold a lock file, so concurrent writers never drop each other's entries.
+
+Contains no business logic.
+"""
+
+from __future__ import annotations
+
+import glob
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Union
+
+from filelock import FileLock
+
+INDEX_NAME = "index.json"
+CHECKPOINT_SUFFIX = ".pth"
+
+
+def atomic_write(path: Union[str, Path], write: Callable[[Path], None]) -> None:
+    """Calls write on a temporary file next to path, then atomically renames it to path"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".tmp"
+    )
+    os.close(fd)
+    tmp_path = Path(tmp_name)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+class ModelStore:
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
+        self.index_path = self.root / INDEX_NAME
+        self.index_lock_path = self.root / f"{INDEX_NAME}.lock"
+        self._index: Dict[str, List[str]] = {}
+        self._index_mtime_ns: Optional[int] = None
+
+    def _read_index(self) -> Dict[str, List[str]]:
+        """Returns the on-disk index, rereading it only if it changed since we last read it"""
+        try:
+            mtime_ns = self.index_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            self._index, self._index_mtime_ns = {}, None
+            return self._index
+        if mtime_ns != self._index_mtime_ns:
+            with open(self.index_path, encoding="utf-8") as f:
+                self._index = json.load(f)
+            self._index_mtime_ns = mtime_ns
+        return self._index
+
+    def _write_index(self, index: Dict[str, List[str]]) -> None:
+        def write(tmp_path: Path) -> None:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(index, f, indent=1, sort_keys=True)
+
+        atomic_write(self.index_path, write)
+        self._index, self._index_mtime_ns = index, self.index_path.stat().st_mtime_ns
+
+    def _relative(self, path: Union[str, Path]) -> str:
+        path = Path(path).absolute()
+        try:
+            return str(path.relative_to(self.root.absolute()))
+        except ValueError:
+            return str(path)
+
+    def path_for(self, run_name: str) -> Path:
+        return self.root / f"{run_name}{CHECKPOINT_SUFFIX}"
+
+    def checkpoints(self, model_id: str) -> List[Path]:
+        """Returns the registered checkpoints for model_id that still exist, oldest first"""
+        return [
+            path
+            for path in (self.root / p for p in self._read_index().get(model_id, []))
+            if path.exists()
+        ]
+
+    def register(self, model_id: str, path: Union[str, Path]) -> None:
+        """Records path as the newest checkpoint for model_id"""
+        entry = self._relative(path)
+        self.root.mkdir(parents=True, exist_ok=True)
+        with FileLock(self.index_lock_path):
+            # reread so that we don't clobber entries added by other processes since our last read
+            self._index_mtime_ns = None
+            index = dict(self._read_index())
+            entries = [p for p in index.get(model_id, []) if p != entry]
+            index[model_id] = entries + [entry]
+            self._write_index(index)
+
+    def newest(self, model_id: str) -> Optional[Path]:
+        """
+        Returns the newest checkpoint for model_id, or None.
+
+        Checkpoints saved in root as f"{model_id}-{suffix}.pth" before the index existed are found by a one-time scan
+        (the newest being the last in sort order, as the suffix is a timestamp) and then registered.
+        """
+        checkpoints = self.checkpoints(model_id)
+        if checkpoints:
+            return checkpoints[-1]
+        unindexed = sorted(
+            self.root.glob(f"{glob.escape(model_id)}-*{CHECKPOINT_SUFFIX}")
+        )
+        if not unindexed:
+            return None
+        self.register(model_id, unindexed[-1])
+        return unindexed[-1]
@@ -0,0 +1,67 @@
+import multiprocessing
+import tempfile
+from pathlib import Path
+
+import torch
+
+from gbmi.utils.model_store import ModelStore, atomic_write
+from gbmi.utils.testing import TestCase
+
+
+def register_many(root: str, worker: int) -> None:
+    store = ModelStore(root)
+    for i in range(20):
+        store.register(f"model-{worker}-{i}", store.path_for(f"run-{worker}-{i}"))
+
+
+def save(path: Path, value: int) -> None:
+    atomic_write(path, lambda tmp_path: torch.save({"value": value}, tmp_path))
+
+
+class TestModelStore(TestCase):
+    def test_newest(self):
+        with tempfile.TemporaryDirectory() as root:
+            store = ModelStore(root)
+            self.assertIsNone(store.newest("model-a"))
+
+            # checkpoints saved before the index existed are found by name
+            save(store.path_for("model-a-2024-01-01_00-00-00"), 1)
+            save(store.path_for("model-a-2024-02-01_00-00-00"), 2)
+            save(store.path_for("model-ab-2024-03-01_00-00-00"), 3)
+            self.assertEqual(
+                store.newest("model-a"), store.path_for("model-a-2024-02-01_00-00-00")
+            )
+
+            # registered checkpoints take precedence, and the index persists
+            elsewhere = Path(root) / "downloads" / "model.pth"
+            save(elsewhere, 4)
+            store.register("model-a", elsewhere)
+            self.assertEqual(ModelStore(root).newest("model-a"), elsewhere)
+            self.assertEqual(torch.load(elsewhere, mmap=True)["value"], 4)
+
+            # deleted checkpoints fall back to the previous one
+            elsewhere.unlink()
+            self.assertEqual(
+                ModelStore(root).newest("model-a"),
+                store.path_for("model-a-2024-02-01_00-00-00"),
+            )
+            self.assertEqual(
+                [p.name for p in Path(root).iterdir() if p.name.startswith(".")], []
+            )
+
+    def test_concurrent_register(self):
+        with tempfile.TemporaryDirectory() as root:
+            context = multiprocessing.get_context("fork")
+            workers = [
+                context.Process(target=register_many, args=(root, worker))
+                for worker in range(4)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            index = ModelStore(root)._read_index()
+            self.assertEqual(
+                set(index),
+                {f"model-{worker}-{i}" for worker in range(4) for i in range(20)},
+            )
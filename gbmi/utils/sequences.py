@@ -1,6 +1,15 @@
-import itertools
 import math
-from typing import Callable, Generic, TypeVar, Union, overload
+from functools import lru_cache
+from typing import (
+    Callable,
+    Generic,
+    Iterator,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+    overload,
+)
 
 import torch
 from jaxtyping import Float, Integer
@@ -8,16 +17,88 @@ from torch import Tensor
 from torch.utils.data import Dataset
 from transformer_lens import HookedTransformer
 
+import gbmi.utils as utils
 from gbmi.utils.instructions import InstructionCount
 
 T = TypeVar("T")
 
 
+def sequences_of_indices(
+    indices: Integer[Tensor, "..."],  # noqa: F722
+    n_digits: int,
+    sequence_length: int,
+    *,
+    little_endian: bool = False,
+    dtype: Optional[torch.dtype] = torch.long,
+) -> Integer[Tensor, "... sequence_length"]:  # noqa: F722
+    """
+    Decodes each index into its sequence_length base-n_digits digits.
+
+    The first position is the most significant digit (itertools.product order), unless little_endian, in which case it
+    is the least significant digit.  dtype=None means the smallest integer dtype holding n_digits - 1.
+    """
+    if dtype is None:
+        dtype = utils.smallest_dtype_holding(max(n_digits - 1, 0), allow_negative=False)
+    place_values = n_digits ** torch.arange(
+        sequence_length, dtype=torch.long, device=indices.device
+    )
+    if not little_endian:
+        place_values = place_values.flip(dims=(0,))
+    return ((indices.long()[..., None] // place_values) % n_digits).to(dtype)
+
+
+def generate_sequences_range(
+    n_digits: int,
+    sequence_length: int,
+    start: int,
+    stop: int,
+    device: Optional[Union[str, torch.device]] = None,
+    dtype: Optional[torch.dtype] = torch.long,
+) -> Integer[Tensor, "stop-start sequence_length"]:  # noqa: F722
+    """
+    Returns generate_all_sequences(n_digits, sequence_length)[start:stop], without generating the other sequences
+    """
+    indices = torch.arange(start, stop, dtype=torch.long, device=device)
+    return sequences_of_indices(indices, n_digits, sequence_length, dtype=dtype)
+
+
 def generate_all_sequences(
-    n_digits: int, sequence_length: int = 2
+    n_digits: int,
+    sequence_length: int = 2,
+    device: Optional[Union[str, torch.device]] = None,
+    dtype: Optional[torch.dtype] = torch.long,
 ) -> Integer[Tensor, "n_seqs sequence_length"]:  # noqa: F722
-    data = list(itertools.product(range(n_digits), repeat=sequence_length))
-    return torch.tensor(data).long()
+    """
+    Returns all n_digits ** sequence_length sequences, in itertools.product(range(n_digits), repeat=sequence_length) order
+    """
+    return generate_sequences_range(
+        n_digits, sequence_length, 0, n_digits**sequence_length, device, dtype
+    )
+
+
+def iter_all_sequences(
+    n_digits: int,
+    sequence_length: int,
+    chunk_size: int,
+    start: int = 0,
+    stop: Optional[int] = None,
+    device: Optional[Union[str, torch.device]] = None,
+    dtype: Optional[torch.dtype] = torch.long,
+) -> Iterator[Integer[Tensor, "chunk_size sequence_length"]]:  # noqa: F722
+    """
+    Yields generate_all_sequences(n_digits, sequence_length)[start:stop] in chunks of at most chunk_size sequences
+    """
+    if stop is None:
+        stop = n_digits**sequence_length
+    for chunk_start in range(start, stop, chunk_size):
+        yield generate_sequences_range(
+            n_digits,
+            sequence_length,
+            chunk_start,
+            min(chunk_start + chunk_size, stop),
+            device,
+            dtype,
+        )
 
 
 def generate_all_sequences_for_model(
@@ -47,19 +128,14 @@ class SequenceDataset(Dataset[Tensor]):
     def __getitem__(
         self, index: Union[int, slice]
     ) -> Union[Tensor, Float[Tensor, "seq_len"]]:  # noqa: F821
-        # Convert the index to a sequence of numbers
+        # Convert the index to a sequence of numbers, least significant digit first
         if isinstance(index, slice):
-            start, stop, stride = index.indices(self.length)
-            sequence = []
-            for i in range(start, stop, stride):
-                sequence.append(self[i])
-            return torch.stack(sequence, dim=0)
+            indices = torch.arange(*index.indices(self.length), dtype=torch.long)
         else:
-            sequence = []
-            for _ in range(self.seq_len):
-                sequence.append(index % self.vocab_size)
-                index = index // self.vocab_size
-            return torch.tensor(sequence, dtype=torch.long)
+            indices = torch.tensor(index, dtype=torch.long)
+        return sequences_of_indices(
+            indices, self.vocab_size, self.seq_len, little_endian=True
+        )
 
 
 class ThunkedDataset(Generic[T], Dataset[Callable[[], T]]):
@@ -92,6 +168,58 @@ def count_sequences(
     return combinations * token_variations
 
 
+@lru_cache(maxsize=None)
+def count_sequences_table(
+    sequence_length: int,
+    max_nonmax_count: int,
+    max_num_nonmax_tok_choices: int,
+) -> Tuple[Tuple[int, ...], ...]:
+    """
+    Returns table[nonmax_count][num_nonmax_tok_choices] == count_sequences(sequence_length, nonmax_count, num_nonmax_tok_choices)
+    for 0 <= nonmax_count <= max_nonmax_count and 0 <= num_nonmax_tok_choices <= max_num_nonmax_tok_choices, as exact Python ints.
+    """
+    return tuple(
+        tuple(
+            count_sequences(sequence_length, nonmax_count, num_nonmax_tok_choices)
+            for num_nonmax_tok_choices in range(max_num_nonmax_tok_choices + 1)
+        )
+        for nonmax_count in range(max_nonmax_count + 1)
+    )
+
+
+def count_sequences_batched(
+    sequence_length: int,
+    nonmax_count: Integer[Tensor, "..."],  # noqa: F722
+    num_nonmax_tok_choices: Integer[Tensor, "..."],  # noqa: F722
+) -> int:
+    """
+    Computes sum(count_sequences(sequence_length, c, k) for c, k in zip(nonmax_count, num_nonmax_tok_choices)) exactly.
+
+    Negative num_nonmax_tok_choices count as 0 choices.  We histogram the (nonmax_count, num_nonmax_tok_choices) pairs
+    with a single bincount and contract the histogram against count_sequences_table in Python ints, so the result
+    never overflows int64 no matter how large the individual counts get.
+    """
+    nonmax_count = nonmax_count.flatten().long().cpu()
+    num_nonmax_tok_choices = num_nonmax_tok_choices.flatten().long().cpu().clamp(min=0)
+    if nonmax_count.numel() == 0:
+        return 0
+    max_nonmax_count = int(nonmax_count.max().item())
+    max_num_nonmax_tok_choices = int(num_nonmax_tok_choices.max().item())
+    table = count_sequences_table(
+        sequence_length, max_nonmax_count, max_num_nonmax_tok_choices
+    )
+    histogram = torch.bincount(
+        nonmax_count * (max_num_nonmax_tok_choices + 1) + num_nonmax_tok_choices,
+        minlength=(max_nonmax_count + 1) * (max_num_nonmax_tok_choices + 1),
+    ).view(max_nonmax_count + 1, max_num_nonmax_tok_choices + 1)
+    return sum(
+        multiplicity * count
+        for multiplicities, counts in zip(histogram.tolist(), table)
+        for multiplicity, count in zip(multiplicities, counts)
+        if multiplicity
+    )
+
+
 def count_sequences_instructions(
     sequence_length: int,
     nonmax_count: int,
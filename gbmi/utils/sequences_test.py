@@ -0,0 +1,49 @@
+import itertools
+
+import torch
+
+from gbmi.utils.sequences import (
+    SequenceDataset,
+    count_sequences,
+    count_sequences_batched,
+    generate_all_sequences,
+    iter_all_sequences,
+)
+from gbmi.utils.testing import TestCase
+
+
+class TestSequences(TestCase):
+    def test_count_sequences_batched(self):
+        nonmax_count = torch.tensor([0, 1, 3, 9, 9, 2])
+        num_nonmax_tok_choices = torch.tensor([0, 5, -2, 127, 127, 1])
+        self.assertEqual(
+            count_sequences_batched(9, nonmax_count, num_nonmax_tok_choices),
+            sum(
+                count_sequences(9, c, k)
+                for c, k in zip(nonmax_count.tolist(), num_nonmax_tok_choices.tolist())
+            ),
+        )
+        # the total does not fit in int64
+        self.assertGreater(
+            count_sequences_batched(9, nonmax_count, num_nonmax_tok_choices), 2**63
+        )
+
+    def test_generate_all_sequences(self):
+        for n_digits, sequence_length in [(1, 3), (3, 1), (4, 3), (5, 0)]:
+            expected = torch.tensor(
+                list(itertools.product(range(n_digits), repeat=sequence_length))
+            ).long()
+            actual = generate_all_sequences(n_digits, sequence_length)
+            self.assertTrue(torch.equal(actual.view(expected.shape), expected))
+            chunked = torch.cat(list(iter_all_sequences(n_digits, sequence_length, 7)))
+            self.assertTrue(torch.equal(chunked.view(expected.shape), expected))
+        self.assertEqual(generate_all_sequences(4, 3, dtype=None).dtype, torch.uint8)
+
+    def test_sequence_dataset(self):
+        dataset = SequenceDataset(seq_len=3, vocab_size=4)
+        # position 0 is the least significant digit
+        expected = generate_all_sequences(4, 3).flip(dims=(-1,))
+        self.assertTrue(torch.equal(dataset[:], expected))
+        self.assertTrue(torch.equal(dataset[5:40:3], expected[5:40:3]))
+        self.assertTrue(torch.equal(dataset[27], expected[27]))
+        self.assertTrue(torch.equal(dataset[-1], expected[-1]))
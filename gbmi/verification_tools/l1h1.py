@@ -2,7 +2,6 @@ import math
 from functools import cache
 from typing import Optional, Union
 
-import numpy as np
 import torch
 from fancy_einsum import einsum
 from jaxtyping import Float
@@ -232,7 +231,10 @@ def all_EQKP(
 
 
 @torch.no_grad()
-def find_all_d_attention_scores(model: HookedTransformer, min_gap: int = 1) -> Union[
+def find_all_d_attention_scores(
+    model: HookedTransformer, min_gap: int = 1, reduce_over_keys: bool = False
+) -> Union[
+    Float[Tensor, "d_vocab_q"],  # noqa: F821
     Float[Tensor, "d_vocab_q d_vocab_k"],  # noqa: F722
     Float[
         Tensor,
@@ -243,11 +245,20 @@ def find_all_d_attention_scores(model: HookedTransformer, min_gap: int = 1) -> U
     If input tokens are x, y, with x - y > min_gap, the minimum values of
     score(x) - score(y).
 
+    Entries that do not correspond to a valid sequence (the max and non-max in the same position, a key token in the
+    query position other than the query token, or tokens closer than min_gap) are inf.
+
+    If reduce_over_keys, returns only the minimum over everything but the query token, without materializing the
+    full table when n_ctx > 2.
+
     Complexity: O(d_vocab * d_model^2 * n_ctx + d_vocab^min(3,n_ctx) * n_ctx^min(2,n_ctx-1))
+    Complexity (reduce_over_keys): O(d_vocab * d_model^2 * n_ctx + d_vocab^2 * n_ctx^2)
     Returns: d_attention_score indexed by
-        if n_ctx <= 2:
+        if reduce_over_keys:
+            (d_vocab_q,)
+        elif n_ctx <= 2:
             (d_vocab_q, d_vocab_k)
-        if n_ctx > 2:
+        else:
             (d_vocab_q, n_ctx_max, n_ctx_non_max, d_vocab_k_max, d_vocab_k_nonmax)
     """
     n_ctx, d_vocab = model.cfg.n_ctx, model.cfg.d_vocab
@@ -258,44 +269,61 @@ def find_all_d_attention_scores(model: HookedTransformer, min_gap: int = 1) -> U
         d_vocab,
     ), f"x_scores.shape = {x_scores.shape} != {(n_ctx, d_vocab, d_vocab)} = (n_ctx, d_vocab, d_vocab)"
     # x_scores[pos, qt, kt] is the score from query token qt to key token kt at position pos
+    tokens = torch.arange(d_vocab, device=x_scores.device)
+    inf = torch.tensor(float("inf"), dtype=x_scores.dtype, device=x_scores.device)
 
     if n_ctx <= 2:
         # when there are only two cases, it must be the case that either the max is in the query slot, or the non-max is in the query slot
-        scores = torch.zeros((d_vocab, d_vocab)) + float("inf")
-        for q_tok in range(d_vocab):
-            for k_tok in range(d_vocab):
-                if np.abs(k_tok - q_tok) >= min_gap:
-                    # q_tok is always in the last position
-                    scores[q_tok, k_tok] = (
-                        x_scores[0, q_tok, k_tok].item()
-                        - x_scores[-1, q_tok, q_tok].item()
-                    ) * np.sign(k_tok - q_tok)
-    else:
-        # when there are more than two cases, we need to consider all cases
-        scores = torch.zeros((d_vocab, n_ctx, n_ctx, d_vocab, d_vocab)) + float("inf")
-        for q_tok in range(d_vocab):
-            for pos_of_max in range(n_ctx):
-                for k_tok_max in range(d_vocab):
-                    if pos_of_max == n_ctx - 1 and k_tok_max != q_tok:
-                        continue
-                    for pos_of_non_max in range(n_ctx):
-                        if pos_of_max == pos_of_non_max:
-                            continue
-                        for k_tok_non_max in range(k_tok_max - (min_gap - 1)):
-                            if pos_of_non_max == n_ctx - 1 and k_tok_non_max != q_tok:
-                                continue
-                            scores[
-                                q_tok,
-                                pos_of_max,
-                                pos_of_non_max,
-                                k_tok_max,
-                                k_tok_non_max,
-                            ] = (
-                                x_scores[pos_of_max, q_tok, k_tok_max].item()
-                                - x_scores[pos_of_non_max, q_tok, k_tok_non_max].item()
-                            )
-
-    return scores
+        # q_tok is always in the last position
+        k_minus_q = tokens[None, :] - tokens[:, None]
+        scores = torch.where(
+            k_minus_q.abs() >= min_gap,
+            (x_scores[0] - x_scores[-1].diagonal()[:, None]) * k_minus_q.sign(),
+            inf,
+        )
+        return scores.min(dim=-1).values if reduce_over_keys else scores
+
+    # when there are more than two cases, we need to consider all cases
+    scores_by_q: Float[Tensor, "d_vocab_q n_ctx d_vocab_k"]  # noqa: F722
+    scores_by_q = x_scores.transpose(0, 1)
+    # only the query token may sit in the query position
+    valid: Float[Tensor, "d_vocab_q n_ctx d_vocab_k"]  # noqa: F722
+    valid = (torch.arange(n_ctx, device=x_scores.device) != n_ctx - 1)[
+        None, :, None
+    ] | (tokens[:, None] == tokens[None, :])[:, None, :]
+    distinct_positions = ~torch.eye(n_ctx, dtype=torch.bool, device=x_scores.device)
+
+    if not reduce_over_keys:
+        gap_ok = tokens[None, :] < tokens[:, None] - (min_gap - 1)
+        mask = (
+            distinct_positions[None, :, :, None, None]
+            & gap_ok[None, None, None, :, :]
+            & valid[:, :, None, :, None]
+            & valid[:, None, :, None, :]
+        )
+        return torch.where(
+            mask,
+            scores_by_q[:, :, None, :, None] - scores_by_q[:, None, :, None, :],
+            inf,
+        )
+
+    # min over k_tok_non_max <= k_tok_max - min_gap of (max score - non-max score) is
+    # max score - (max over k_tok_non_max <= k_tok_max - min_gap of non-max score)
+    non_max_scores = torch.where(valid, scores_by_q, -inf).cummax(dim=-1).values
+    largest_non_max = tokens - min_gap
+    best_non_max: Float[Tensor, "d_vocab_q n_ctx d_vocab_k_max"]  # noqa: F722
+    best_non_max = torch.where(
+        largest_non_max >= 0,
+        non_max_scores[..., largest_non_max.clamp(0, d_vocab - 1)],
+        -inf,
+    )
+    scores = torch.where(
+        distinct_positions[None, :, :, None],
+        torch.where(valid, scores_by_q, inf)[:, :, None, :]
+        - best_non_max[:, None, :, :],
+        inf,
+    )
+    return scores.flatten(start_dim=1).min(dim=-1).values
 
 
 @torch.no_grad()
@@ -306,12 +334,10 @@ def find_min_d_attention_score(
     If input tokens are x, y, with x - y > min_gap, the minimum value of
     score(x) - score(y).
 
-    Complexity: O(d_vocab * d_model^2 * n_ctx + d_vocab^min(3,n_ctx) * n_ctx^min(2,n_ctx-1))
+    Complexity: O(d_vocab * d_model^2 * n_ctx + d_vocab^2 * n_ctx^2)
     Returns: float if reduce_over_query else torch.Tensor[d_vocab] (indexed by query token)
     """
-    scores = find_all_d_attention_scores(model, min_gap=min_gap)
-    while len(scores.shape) != 1:
-        scores = scores.min(dim=-1).values
+    scores = find_all_d_attention_scores(model, min_gap=min_gap, reduce_over_keys=True)
     if reduce_over_query:
         scores = scores.min(dim=0).values.item()
     return scores
@@ -0,0 +1,67 @@
+import torch
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from gbmi.verification_tools.l1h1 import (
+    all_attention_scores,
+    find_all_d_attention_scores,
+    find_min_d_attention_score,
+)
+from gbmi.utils.testing import TestCase
+
+
+def find_all_d_attention_scores_loop(
+    model: HookedTransformer, min_gap: int = 1
+) -> torch.Tensor:
+    n_ctx, d_vocab = model.cfg.n_ctx, model.cfg.d_vocab
+    x_scores = all_attention_scores(model)
+    if n_ctx <= 2:
+        scores = torch.zeros((d_vocab, d_vocab)) + float("inf")
+        for q_tok in range(d_vocab):
+            for k_tok in range(d_vocab):
+                if abs(k_tok - q_tok) >= min_gap:
+                    scores[q_tok, k_tok] = (
+                        x_scores[0, q_tok, k_tok].item()
+                        - x_scores[-1, q_tok, q_tok].item()
+                    ) * (1 if k_tok > q_tok else -1 if k_tok < q_tok else 0)
+        return scores
+    scores = torch.zeros((d_vocab, n_ctx, n_ctx, d_vocab, d_vocab)) + float("inf")
+    for q_tok in range(d_vocab):
+        for pos_of_max in range(n_ctx):
+            for k_tok_max in range(d_vocab):
+                if pos_of_max == n_ctx - 1 and k_tok_max != q_tok:
+                    continue
+                for pos_of_non_max in range(n_ctx):
+                    if pos_of_max == pos_of_non_max:
+                        continue
+                    for k_tok_non_max in range(k_tok_max - (min_gap - 1)):
+                        if pos_of_non_max == n_ctx - 1 and k_tok_non_max != q_tok:
+                            continue
+                        scores[
+                            q_tok, pos_of_max, pos_of_non_max, k_tok_max, k_tok_non_max
+                        ] = (
+                            x_scores[pos_of_max, q_tok, k_tok_max].item()
+                            - x_scores[pos_of_non_max, q_tok, k_tok_non_max].item()
+                        )
+    return scores
+
+
+class TestL1H1(TestCase):
+    def test_find_all_d_attention_scores_matches_loop(self):
+        for n_ctx in (2, 3, 4):
+            cfg = HookedTransformerConfig(
+                n_layers=1, d_model=8, n_ctx=n_ctx, d_head=8, d_vocab=6, attn_only=True
+            )
+            torch.manual_seed(n_ctx)
+            model = HookedTransformer(cfg)
+            for min_gap in (0, 1, 2, 6):
+                expected = find_all_d_attention_scores_loop(model, min_gap=min_gap)
+                actual = find_all_d_attention_scores(model, min_gap=min_gap)
+                self.assertTrue(torch.equal(actual, expected), msg=(n_ctx, min_gap))
+                while expected.ndim > 1:
+                    expected = expected.min(dim=-1).values
+                self.assertTrue(
+                    torch.equal(
+                        find_min_d_attention_score(model, min_gap=min_gap), expected
+                    ),
+                    msg=(n_ctx, min_gap),
+                )